@@ -1,19 +1,42 @@
 import subprocess
 import threading
+import concurrent.futures
+import queue
 import time
 import os
-import glob
 import re
 import json
+import hashlib
 import shutil
+import secrets
+import statistics
+import signal
+import sys
+import functools
 from flask import Flask, request, Response, jsonify, send_file, abort
 import traceback
 from urllib.parse import quote
 from wsgiref.util import FileWrapper  # 用于流式传输
+from image_list import load_image_list, parse_ref, ImageListError, DEFAULT_REPO
+from applog import LogWriter
+from metrics import MetricsRegistry, GAUGE
+from tracing import TaskTrace, ProcessSampler, read_proc_io
+from blob_store import BlobStore, IMAGE_REFS, PACKAGE_REFS
+from registry_client import check_image_tar
+from disk_admission import (DiskAdmission, SizeEstimator, evict_image_tars, evict_packages, format_size,
+                            PACKAGE_RETENTION_SECONDS)
+from zip_package import StreamingZipWriter, VirtualZip, FORMAT_VERSION, local_header, package_digest, write_package
+from image_meta import image_meta, image_sub_blocks, cached_image_meta, file_meta
+from inventory import Inventory, InventoryError, resolve_digests, split_by_inventory
+from installer import INSTALL_SCRIPT, render_install_script, write_install_script
+from blockmap import VERSION as BLOCKMAP_VERSION, assemble_blockmap, write_blockmap, read_header as read_blockmap_header
+from volumes import MIN_VOLUME_MB, VolumeDigest
+from task_store import (StatusStore, OutputLog, BuildQueue, BuildJournal, BuildHistory, write_json, read_json,
+                        OUTPUT_FILE, TRACE_FILE, JOURNAL_FILE, REQUEST_FILE, STREAM_FILE, PACKAGE_FILE, INDEX_FILE,
+                        INVENTORY_FILE, SKIPPED_FILE, BLOCKMAP_FILE, VOLUMES_FILE)
 
 # 初始化Flask应用
 app = Flask(__name__, static_folder='.', static_url_path='')
-build_status = {}  # 存储构建任务状态（SSE实时更新用）
 
 # -------------------------- 基础配置（与项目结构对齐） --------------------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -22,24 +45,259 @@ LATEST_LIST_DIR = os.path.join(BASE_DIR, 'latest_image_list')  # 镜像列表目
 PATCH_LIST_PATH = os.path.join(LATEST_LIST_DIR, 'patch_image_tag_list.txt')  # 镜像列表文件
 PULL_SCRIPT_PATH = os.path.join(BASE_DIR, 'pull_save.sh') # 镜像拉取脚本
 LOG_DIR = os.path.join(BASE_DIR, 'logs')                  # 日志目录
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')           # 指标数据目录（多worker共享）
+TASK_RECORDS_DIR = os.path.join(BASE_DIR, 'task_records') # 任务记录目录（状态/输出/轨迹/构建队列）
+BLOB_STORE_DIR = os.path.join(BASE_DIR, 'blobs')          # blob存储（镜像layer按sha256只存一份）
+# 构建执行方式：inline（默认，web进程内的调度线程执行构建，python app.py 使用）
+#              external（gunicorn：构建由独立的构建进程执行，web worker只负责提交和推送进度）
+BUILDER_MODE = os.environ.get('BUILDER_MODE', 'inline')
+BUILD_CONCURRENCY = int(os.environ.get('BUILD_CONCURRENCY', 2))  # 同时执行的构建数
+MAX_BUILD_ATTEMPTS = 3  # 构建被中断（服务重启/机器故障）后最多恢复执行的次数
+ADMISSION_RETRY_SECONDS = 15  # 磁盘空间不足排队时，重新检查的间隔（秒）
+# 升级包形式：zip（默认，打包为文件）/ virtual（只记录清单，下载时由 image_tar 中的镜像tar拼出zip，不占额外磁盘）
+# 单次构建可用 /build?virtual=1 或 virtual=0 覆盖
+PACKAGE_MODE = os.environ.get('PACKAGE_MODE', 'zip')
+IMAGE_REPO = os.environ.get('IMAGE_REPO', DEFAULT_REPO)  # 镜像仓库前缀（与 pull_save.sh 一致）
+IMAGE_META_WORKERS = 2         # 镜像保存后计算校验值的线程数（与拉取同时进行）
+IMAGE_CHUNK_SIZE = 1024 * 1024  # 单个镜像下载的读取块大小
+MAX_INVENTORY_BYTES = 16 * 1024 * 1024  # 上传的现场镜像清单大小上限
+REGISTRY_TOKEN_CACHE = os.environ.get('REGISTRY_TOKEN_CACHE', os.path.join(BASE_DIR, 'registry_auth', 'tokens.json'))
+OUTPUT_TAIL_LINES = 200        # 每个任务保留的子进程输出行数（内存上限）
+OUTPUT_MAX_LINE = 4096         # 单行输出最大长度（超长行截断）
 
 # 确保目录存在（首次运行自动创建）
 for dir_path in [IMAGE_TAR_DIR, LATEST_LIST_DIR, LOG_DIR]:
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
 
+build_status = StatusStore(TASK_RECORDS_DIR)  # 构建任务状态（文件存储，所有进程共享）
+build_queue = BuildQueue(TASK_RECORDS_DIR)    # 待构建任务队列
+build_history = BuildHistory(TASK_RECORDS_DIR)  # 已完成构建的耗时记录（构建计划估算耗时用）
+blob_store = BlobStore(BLOB_STORE_DIR)        # 镜像blob存储（pull_save.sh写入，升级包引用）
+disk_admission = DiskAdmission(IMAGE_TAR_DIR)  # 构建开始前按估算的峰值占用预留磁盘空间
+size_estimator = SizeEstimator(               # 估算参数与 pull_save.sh 的环境变量一致
+    IMAGE_TAR_DIR, blob_store, IMAGE_REPO,
+    pull_backend=os.environ.get('PULL_BACKEND', 'nerdctl'),
+    store_enabled=os.environ.get('BLOB_STORE_ENABLED', '1') != '0',
+    token_cache_path=REGISTRY_TOKEN_CACHE
+)
+task_output = {}  # 本进程执行中任务的子进程输出（OutputLog，写入 task_records/<task_id>/output.log）
+task_traces = {}  # 本进程执行中任务的执行轨迹（结束后写入 task_records/<task_id>/trace.json）
+blockmap_jobs = set()             # 正在后台生成块校验文件的任务（构建时未生成块校验文件的升级包）
+blockmap_lock = threading.Lock()
+BLOCKMAP_RETRY_SECONDS = 10       # 块校验文件生成中时建议客户端的重试间隔
+
+# 执行轨迹中的时间线编号（同一编号显示为一行）
+TRACE_TID_STAGE = 0      # 构建阶段
+TRACE_TID_IMAGE = 1      # 单个镜像的拉取/保存
+TRACE_TID_PULL = 100     # pull_save.sh 进程树
+
+# 异步日志（队列 + 单写入线程，按大小轮转并gzip压缩历史分段）
+log_writer = LogWriter(os.path.join(LOG_DIR, 'app.log'))
+
+# Prometheus指标（/metrics）
+BUILD_SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+metrics = MetricsRegistry(METRICS_DIR)
+metrics.counter('builder_builds_total', "构建任务数（outcome=success/error）")
+metrics.histogram('builder_build_duration_seconds', "构建总耗时（秒）", buckets=BUILD_SECONDS_BUCKETS)
+metrics.histogram('builder_build_stage_seconds', "构建各阶段耗时（stage=list_check/pull/save/package）",
+                  buckets=BUILD_SECONDS_BUCKETS)
+metrics.counter('builder_bytes_total', "字节数（kind=pulled/saved/served/package_cloned/package_copied）")
+metrics.counter('builder_image_cache_total', "镜像缓存查询次数（result=hit/miss）")
+metrics.counter('builder_pull_retries_total', "镜像拉取/保存命令的重试次数（reason=error/timeout）")
+metrics.counter('builder_pull_failures_total', "重试后仍失败的镜像拉取/保存命令数")
+metrics.counter('builder_admission_total', "构建磁盘准入结果（result=admitted/deferred/rejected）")
+metrics.counter('builder_disk_evicted_bytes_total', "磁盘空间不足时回收的字节数（kind=blobs/image_tars/packages）")
+metrics.gauge('builder_sse_connections', "活跃的SSE进度连接数")
+metrics.gauge('builder_active_downloads', "进行中的升级包下载数")
+metrics.histogram('builder_versions_request_seconds', "/versions 接口耗时（秒）")
+
+
+def collect_runtime_metrics(total):
+    """抓取时计算的指标：image_tar可用磁盘空间、镜像缓存命中率"""
+    usage = shutil.disk_usage(IMAGE_TAR_DIR)
+    hits = metrics.get_value(total, 'builder_image_cache_total', result='hit')
+    misses = metrics.get_value(total, 'builder_image_cache_total', result='miss')
+    running = sum(1 for task_id in build_status.task_ids()
+                  if build_status.get(task_id, {}).get('status') == 'progress')
+    queued = len(build_queue.pending())
+    blob_bytes, blob_count = blob_store.usage()
+    return [
+        ('builder_queue_depth', GAUGE, "排队等待构建的任务数", {}, queued),
+        ('builder_running_builds', GAUGE, "执行中（含排队）的构建任务数", {}, running),
+        ('builder_image_tar_free_bytes', GAUGE, "image_tar目录所在磁盘的可用空间（字节）", {}, usage.free),
+        ('builder_image_cache_hit_ratio', GAUGE, "镜像缓存命中率", {},
+         hits / (hits + misses) if hits + misses else 0),
+        ('builder_blob_store_bytes', GAUGE, "blob存储总大小（字节）", {}, blob_bytes),
+        ('builder_blob_store_blobs', GAUGE, "blob存储中的blob数", {}, blob_count),
+    ]
+
+
+metrics.register_collector(collect_runtime_metrics)
+
 
 # -------------------------- 工具函数 --------------------------
-def write_log(content, level="INFO"):
-    """写日志（含时间戳，同时输出到文件和控制台）"""
-    log_file = os.path.join(LOG_DIR, 'app.log')
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-    log_line = f"[{timestamp}] [{level}] {content}\n"
-    # 写入文件
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(log_line)
-    # 打印到控制台
-    print(log_line.strip())
+def write_log(content, level="INFO", task_id=None, **fields):
+    """写日志（入队后立即返回，由写入线程批量写入JSON行日志文件并输出到控制台）"""
+    log_writer.log(content, level=level, task_id=task_id, **fields)
+
+
+class PullTracker(object):
+    """根据pull_save.sh的输出行统计每个镜像的拉取/保存耗时、缓存命中和字节数，并记录镜像级轨迹"""
+
+    def __init__(self, trace=None, journal=None):
+        self.finished = 0          # 已完成（保存成功或命中缓存）的镜像数
+        self.pull_seconds = 0.0
+        self.save_seconds = 0.0
+        self.pulled_images = 0     # 新拉取（未命中缓存）的镜像数和tar字节数
+        self.pulled_bytes = 0
+        self.trace = trace
+        self.journal = journal     # 每个镜像拉取/保存完成时记入构建日志（断点恢复用）
+        self._pid = None
+        self._started = {}         # 'pull'/'save' -> (开始时间, 镜像, 开始时的IO统计)
+        self._timed_out = False    # 上一次失败是否为超时（决定重试计数的reason）
+        self.last_saved = None     # 最近完成的镜像tar路径（边构建边打包时追加到升级包）
+
+    def attach(self, pid):
+        """run_streaming 启动子进程后回调，用于读取 /proc/<pid>/io"""
+        self._pid = pid
+
+    def _begin(self, kind, target, now):
+        self._started[kind] = (now, target, read_proc_io(self._pid) if self._pid else {})
+
+    def _end(self, kind, now):
+        """结束一个拉取/保存区间，返回耗时"""
+        if kind not in self._started:
+            return 0.0
+        start, target, io_before = self._started.pop(kind)
+        if self.trace is not None:
+            io_after = read_proc_io(self._pid) if self._pid else {}
+            self.trace.add_span(
+                f"{kind} {target.rsplit('/', 1)[-1]}", kind, start, now, tid=TRACE_TID_IMAGE,
+                target=target, pid=self._pid,
+                read_bytes=io_after.get('read_bytes', 0) - io_before.get('read_bytes', 0),
+                write_bytes=io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0)
+            )
+        return now - start
+
+    def _record_saved(self, save_file, cached=False):
+        if self.journal is not None and os.path.exists(save_file):
+            self.journal.record('saved', image=os.path.basename(save_file), size=os.path.getsize(save_file),
+                                cached=cached)
+
+    def feed(self, line):
+        """处理一行输出，镜像完成时返回True"""
+        now = time.time()
+        if "开始拉取镜像：" in line:
+            self._begin('pull', line.split("开始拉取镜像：", 1)[1].strip(), now)
+            metrics.inc('builder_image_cache_total', result='miss')
+        elif "镜像拉取成功" in line:
+            self.pull_seconds += self._end('pull', now)
+            if self.journal is not None:
+                self.journal.record('pulled', ref=line.split("镜像拉取成功：", 1)[-1].strip())
+        elif "开始保存镜像到：" in line:
+            self._begin('save', line.split("开始保存镜像到：", 1)[1].strip(), now)
+        elif "镜像保存成功" in line:
+            self.save_seconds += self._end('save', now)
+            save_file = line.split("镜像保存成功：", 1)[-1].strip()
+            if os.path.exists(save_file):
+                # 新拉取的镜像：拉取字节数按保存的tar大小近似统计
+                size = os.path.getsize(save_file)
+                self.pulled_images += 1
+                self.pulled_bytes += size
+                metrics.inc('builder_bytes_total', size, kind='pulled')
+                metrics.inc('builder_bytes_total', size, kind='saved')
+            self._record_saved(save_file)
+            self.last_saved = save_file
+            self.finished += 1
+            return True
+        elif "秒后重试" in line:
+            metrics.inc('builder_pull_retries_total', reason='timeout' if self._timed_out else 'error')
+            self._timed_out = False
+        elif "超时（" in line and "已终止" in line:
+            self._timed_out = True
+        elif "失败（已尝试" in line:
+            metrics.inc('builder_pull_failures_total')
+            self._timed_out = False
+        elif "镜像已缓存" in line:
+            metrics.inc('builder_image_cache_total', result='hit')
+            save_file = line.split("跳过拉取：", 1)[-1].strip()
+            if self.trace is not None:
+                self.trace.add_span("cache hit", "cache", now, now, tid=TRACE_TID_IMAGE, target=save_file)
+            self._record_saved(save_file, cached=True)
+            self.last_saved = save_file
+            self.finished += 1
+            return True
+        return False
+
+
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+
+def run_streaming(cmd, task_id, stage, on_line=None, on_start=None, trace_tid=None):
+    """执行子进程并逐行消费输出（stderr合并到stdout）：
+    每行实时写日志、追加到任务输出缓冲，并回调on_line；退出码非0时抛出异常（附最近输出）。
+    任务有执行轨迹且指定了trace_tid时，采样子进程树的CPU/IO写入轨迹"""
+    output = get_task_output(task_id)
+    trace = task_traces.get(task_id)
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        errors='replace',
+        bufsize=1,
+        env=dict(os.environ, AUTO_PACKING_BASE_DIR=BASE_DIR)  # 脚本与app使用同一基础目录
+    )
+    sampler = None
+    if trace is not None and trace_tid is not None:
+        sampler = ProcessSampler(trace, proc.pid, stage, trace_tid).start()
+    if on_start:
+        on_start(proc.pid)
+    rusage = None
+    try:
+        while True:
+            line = proc.stdout.readline(OUTPUT_MAX_LINE)
+            if not line:
+                break
+            # 去掉颜色控制符；进度条类输出（\r覆盖）只保留最后一段
+            line = ANSI_ESCAPE_RE.sub('', line).rstrip('\r\n').rsplit('\r', 1)[-1]
+            if not line.strip():
+                continue
+            output.append(line)
+            write_log(f"[{stage}] {line}", task_id=task_id, stage=stage)
+            if on_line:
+                on_line(line)
+    finally:
+        proc.stdout.close()
+        # 用wait4回收子进程，同时拿到其（含已回收后代进程的）CPU时间和内存峰值
+        _, wait_status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(wait_status):
+            proc.returncode = -os.WTERMSIG(wait_status)
+        else:
+            proc.returncode = os.WEXITSTATUS(wait_status)
+        returncode = proc.returncode
+        if sampler is not None:
+            sampler.stop(rusage)
+
+    if returncode != 0:
+        tail = '\n'.join(output.tail())
+        raise Exception(f"{stage}失败（退出码{returncode}），最近输出：\n{tail}")
+
+
+def get_task_output(task_id):
+    """本进程中任务的输出日志（首次调用时创建）"""
+    if task_id not in task_output:
+        task_output[task_id] = OutputLog(os.path.join(build_status.task_dir(task_id), OUTPUT_FILE),
+                                         maxlen=OUTPUT_TAIL_LINES)
+    return task_output[task_id]
+
+
+def save_trace(task_id):
+    """把执行轨迹写入任务目录（其他进程通过 /builds/<task_id>/trace 读取）"""
+    trace = task_traces.get(task_id)
+    if trace is not None:
+        write_json(os.path.join(build_status.task_dir(task_id), TRACE_FILE), trace.to_chrome())
 
 
 def get_oss_versions():
@@ -81,24 +339,263 @@ def get_oss_versions():
         return []
 
 
-def run_build_task(task_id, current_version, target_version):
-    """核心构建任务：拉取镜像→打包升级包"""
+def package_file_name(current_version, target_version, task_id):
+    return f"upgrade_{current_version}_to_{target_version}_{task_id}.zip"
+
+
+class PackageStreamer(object):
+    """边构建边打包（/build?stream=1）：每个镜像保存完成后由后台线程追加到升级包（不压缩、只追加），
+    拉取和打包同时进行，下载端可以同时读取已写出的部分"""
+
+    def __init__(self, path, tar_names):
+        self.path = path
+        self._names = set(tar_names)
+        self._added = set()
+        self._queue = queue.Queue()
+        self._error = None
+        if os.path.exists(path):
+            os.remove(path)  # 上次中断时未完成的升级包（新建文件，正在读取旧文件的下载端据此发现并断开）
+        self._file = open(path, 'wb')
+        self._writer = StreamingZipWriter(self._file)
+        self._thread = threading.Thread(target=self._run, name="package-streamer", daemon=True)
+        self._thread.start()
+
+    def add(self, path, arcname=None):
+        """追加一个文件（每个镜像只追加一次，不在本次镜像列表中的忽略）"""
+        name = arcname or os.path.basename(path)
+        if arcname is None and name not in self._names or name in self._added:
+            return
+        self._added.add(name)
+        self._queue.put((path, arcname))
+
+    def missing(self):
+        return sorted(self._names - self._added)
+
+    @property
+    def entries(self):
+        """已写出的条目（ZipEntry，按写出顺序），finish 之后为升级包的全部条目"""
+        return self._writer.entries
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._writer.add_file(*item)
+            except (IOError, OSError) as e:
+                self._error = e
+
+    def finish(self):
+        """等待所有条目写完并写出中央目录，返回升级包大小"""
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise Exception(f"打包失败：{self._error}")
+            return self._writer.close()
+        finally:
+            self._file.close()
+
+    def abort(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def image_url(entry):
+    """单个镜像tar的下载地址（/images/<镜像名>/<标签或digest>，镜像名含命名空间，如 ns/deepflow-server）"""
+    return f"/images/{quote(entry.name, safe='/')}/{quote(entry.tag or entry.digest, safe='')}"
+
+
+def write_virtual_package(task_id, package_name, entry_metas):
+    """生成虚拟升级包清单（不复制镜像tar，条目信息取自文件元数据，按条目名排序），返回升级包大小"""
+    task_dir = build_status.task_dir(task_id)
+    entries = [dict((key, meta[key]) for key in ('name', 'path', 'size', 'mtime_ns', 'mode', 'crc'))
+               for meta in sorted(entry_metas, key=lambda meta: meta['name'])]
+    size = VirtualZip(entries).size
+    write_json(os.path.join(task_dir, PACKAGE_FILE), {"name": package_name, "size": size, "entries": entries})
+    return size
+
+
+def package_block_files(zip_entries, image_metas):
+    """升级包中镜像tar条目的数据位置和子块记录缓存（blockmap.assemble_blockmap 用），按偏移排序；
+    与元数据不一致的条目不列出（拼块校验文件时从升级包读取）"""
+    metas = dict((meta['name'], meta) for meta in image_metas)
+    files = []
+    for entry in zip_entries:
+        meta = metas.get(entry.name)
+        if meta is None or meta['size'] != entry.size or meta['crc'] != entry.crc:
+            continue
+        files.append((entry.offset + len(local_header(entry.name, entry.offset)), entry.size,
+                      image_sub_blocks(IMAGE_TAR_DIR, entry.name)))
+    return sorted(files)
+
+
+def package_images(image_entries, image_metas):
+    """升级包中每个镜像的索引项（升级包索引和安装脚本共用）"""
+    return [{
+        "name": entry.short_name,
+        "tag": entry.tag,
+        "ref": entry.ref(IMAGE_REPO),
+        "repository": entry.repository(IMAGE_REPO),
+        "file": meta['name'],
+        "size": meta['size'],
+        "sha256": meta['sha256'],       # 镜像tar文件的sha256（下载后、加载前校验）
+        "digest": meta.get('manifest'),  # 镜像manifest digest
+        "config": meta.get('config'),    # 镜像配置digest（镜像ID）
+        "url": image_url(entry),
+    } for entry, meta in zip(image_entries, image_metas)]
+
+
+def write_package_index(task_id, package_name, digest, images, list_copy, skipped=None):
+    """升级包索引：每个镜像的大小、校验值、digest和单独下载地址，现场工具据此只下载缺少的镜像"""
+    with open(list_copy, 'r', encoding='utf-8') as f:
+        image_list = f.read()
+    write_json(os.path.join(build_status.task_dir(task_id), INDEX_FILE), {
+        "task_id": task_id,
+        "package_name": package_name,
+        "package_url": f"/download/{task_id}",
+        "package_digest": digest,           # 升级包内容摘要（边构建边打包的升级包条目顺序不固定，为None）
+        "install_url": f"/builds/{task_id}/{INSTALL_SCRIPT}",
+        "blockmap_url": f"/builds/{task_id}/blockmap",   # 块校验文件（持有旧升级包时增量下载）
+        "created": time.time(),
+        "image_list": image_list,
+        "images": images,
+        "skipped": skipped or [],           # 现场已有、未打包的镜像
+    })
+
+
+def load_virtual_package(task_id):
+    """读取虚拟升级包清单并确认引用的文件未变化，返回 (清单, 问题描述)，可用时问题描述为None"""
+    manifest = read_json(os.path.join(build_status.task_dir(task_id), PACKAGE_FILE))
+    if manifest is None:
+        return None, "升级包清单不存在"
+    for entry in manifest['entries']:
+        try:
+            st = os.stat(entry['path'])
+        except OSError:
+            return manifest, f"镜像文件已被清理：{entry['name']}"
+        if st.st_size != entry['size'] or st.st_mtime_ns != entry['mtime_ns']:
+            return manifest, f"镜像文件已变化：{entry['name']}"
+    return manifest, None
+
+
+def virtual_package_tars():
+    """未超过保留期的虚拟升级包引用的镜像tar文件名（磁盘回收时保留）"""
+    names = set()
+    now = time.time()
+    for task_id in build_status.task_ids():
+        status = build_status.get(task_id) or {}
+        if not status.get('virtual') or status.get('evicted'):
+            continue
+        path = os.path.join(build_status.task_dir(task_id), PACKAGE_FILE)
+        try:
+            if now - os.path.getmtime(path) >= PACKAGE_RETENTION_SECONDS:
+                continue
+        except OSError:
+            continue
+        manifest = read_json(path) or {}
+        names.update(entry['name'] for entry in manifest.get('entries', []))
+    return names
+
+
+def apply_inventory(task_id, image_entries):
+    """按提交时上传的现场镜像清单排除现场已有的镜像，返回 (需要打包的镜像, [被跳过的镜像说明])；没有清单时原样返回。
+    结果写入 skipped_images.json，磁盘准入和构建（含断点恢复）复用同一结果，仓库只查询一次"""
+    task_dir = build_status.task_dir(task_id)
+    inventory_data = read_json(os.path.join(task_dir, INVENTORY_FILE))
+    if inventory_data is None:
+        return image_entries, []
+    result = read_json(os.path.join(task_dir, SKIPPED_FILE))
+    if result is not None:
+        # 按跳过的文件名过滤（此后镜像列表新增的镜像照常打包）
+        skipped_names = {item['tar_name'] for item in result['skipped']}
+        return [entry for entry in image_entries if entry.tar_name not in skipped_names], result['skipped']
+    inventory = Inventory.from_dict(inventory_data)
+    digests = (resolve_digests(image_entries, IMAGE_TAR_DIR, IMAGE_REPO, REGISTRY_TOKEN_CACHE)
+               if inventory.digests else {})
+    kept, skipped = split_by_inventory(image_entries, inventory, digests, IMAGE_REPO)
+    unresolved = [entry.tar_name for entry in image_entries if digests.get(entry.tar_name, []) is None]
+    if unresolved:
+        write_log(f"任务[{task_id}]{len(unresolved)}个镜像无法从仓库确定digest，照常打包：{', '.join(unresolved)}",
+                  level="WARN", task_id=task_id)
+    write_json(os.path.join(task_dir, SKIPPED_FILE), {
+        "inventory_images": len(inventory),
+        "included": [entry.tar_name for entry in kept],
+        "unresolved": unresolved,     # 无法确定digest、照常打包的镜像
+        "skipped": skipped
+    })
+    return kept, skipped
+
+
+def run_build_task(task_id, current_version, target_version, stream=False, virtual=False, volume_size=0):
+    """核心构建任务：拉取镜像→打包升级包（stream=True 时边拉取边打包；virtual=True 时只生成虚拟升级包清单；
+    volume_size>0 时按此大小（字节）生成分卷清单）"""
+    task_start = time.time()
+    trace = task_traces[task_id] = TaskTrace(task_id)
+    trace.name_track(TRACE_TID_STAGE, "构建阶段")
+    trace.name_track(TRACE_TID_IMAGE, "镜像拉取/保存")
+    task_dir = build_status.task_dir(task_id)
+    journal = BuildJournal(os.path.join(task_dir, JOURNAL_FILE))
+    attempt = len(journal.steps('started')) + 1
+    streamer = None
+    zip_entries = None    # 本次写出的升级包条目（块校验文件由此拼出；复用上次的升级包时为None）
+    checksums = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_META_WORKERS)
     try:
-        # 1. 初始化任务状态
+        # 1. 初始化任务状态（构建日志中已有记录 → 上次执行被中断，从断点恢复）
+        if attempt > MAX_BUILD_ATTEMPTS:
+            raise Exception(f"构建已被中断{attempt - 1}次，不再自动恢复，请重新提交")
+        journal.record('started', attempt=attempt)
         build_status[task_id] = {
             "status": "progress",
             "percent": 0,
-            "message": "初始化构建任务，检查依赖"
+            "message": "初始化构建任务，检查依赖" if attempt == 1 else f"构建被中断，从断点恢复（第{attempt}次执行）"
         }
-        write_log(f"任务[{task_id}]启动：{current_version} → {target_version}")
+        if attempt == 1:
+            write_log(f"任务[{task_id}]启动：{current_version} → {target_version}", task_id=task_id)
+        else:
+            write_log(f"任务[{task_id}]从断点恢复（第{attempt}次执行）：{current_version} → {target_version}",
+                      level="WARN", task_id=task_id)
         time.sleep(1)
 
         # 2. 检查核心依赖
+        stage_start = time.time()
         if not os.path.exists(PATCH_LIST_PATH):
             raise Exception(f"镜像列表文件缺失：{PATCH_LIST_PATH}（请检查OSS同步脚本）")
         if not os.path.exists(PULL_SCRIPT_PATH):
             raise Exception(f"拉取脚本缺失：{PULL_SCRIPT_PATH}")
-        
+        # 解析镜像列表（格式错误的行记录诊断后跳过）
+        try:
+            image_entries, diagnostics = load_image_list(PATCH_LIST_PATH)
+        except ImageListError as e:
+            raise Exception(str(e))
+        for diagnostic in diagnostics:
+            write_log(f"任务[{task_id}]镜像列表：{diagnostic}", level="WARN", task_id=task_id)
+        metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='list_check')
+        trace.add_span("list_check", "stage", stage_start, time.time(), tid=TRACE_TID_STAGE,
+                       images=len(image_entries), diagnostics=len(diagnostics))
+
+        # 提交时上传了现场镜像清单：现场已有的镜像不拉取、不打包（跳过的镜像记入 skipped_images.json）
+        pull_list_path = PATCH_LIST_PATH
+        skipped = None
+        if os.path.exists(os.path.join(task_dir, INVENTORY_FILE)):
+            stage_start = time.time()
+            with trace.span("inventory", "stage", tid=TRACE_TID_STAGE, images=len(image_entries)):
+                image_entries, skipped = apply_inventory(task_id, image_entries)
+            metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='inventory')
+            pull_list_path = os.path.join(task_dir, 'pull_list.txt')
+            with open(pull_list_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(entry.ref('') + '\n' for entry in image_entries))
+            write_log(f"任务[{task_id}]现场已有{len(skipped)}个镜像，不拉取、不打包："
+                      f"{', '.join(item['tar_name'] for item in skipped) or '无'}", task_id=task_id)
+
+        if attempt > 1:
+            reused = verify_saved_images(task_id, journal, image_entries)
+            write_log(f"任务[{task_id}]复用已保存的镜像{reused}/{len(image_entries)}个", task_id=task_id)
+
         build_status[task_id] = {
             "status": "progress",
             "percent": 20,
@@ -106,15 +603,44 @@ def run_build_task(task_id, current_version, target_version):
         }
         time.sleep(1)
 
-        # 3. 调用pull_save.sh拉取镜像
-        pull_result = subprocess.run(
-            ["/bin/bash", PULL_SCRIPT_PATH, "-d", IMAGE_TAR_DIR],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        write_log(f"镜像拉取输出：\n{pull_result.stdout}")
+        # 生成升级包文件名
+        upgrade_package = package_file_name(current_version, target_version, task_id)
+        upgrade_path = os.path.join(IMAGE_TAR_DIR, upgrade_package)
+        packaged = journal.steps('packaged')
+        if virtual:
+            package_reusable = bool(packaged) and load_virtual_package(task_id)[1] is None
+        else:
+            package_reusable = (packaged and os.path.exists(upgrade_path)
+                                and os.path.getsize(upgrade_path) == packaged[-1]['size'])
+        if stream and not package_reusable:
+            streamer = PackageStreamer(upgrade_path, [entry.tar_name for entry in image_entries])
+
+        # 3. 调用pull_save.sh拉取镜像（逐行读取输出，按已完成镜像数推进进度20%→70%）
+        tracker = PullTracker(trace, journal)
+
+        def on_pull_line(line):
+            if tracker.feed(line):
+                if streamer is not None:
+                    streamer.add(tracker.last_saved)
+                # 镜像保存完成后即计算校验值（升级包索引、虚拟升级包用），与后续镜像的拉取同时进行
+                checksums.submit(image_meta, IMAGE_TAR_DIR, os.path.basename(tracker.last_saved))
+                build_status[task_id] = {
+                    "status": "progress",
+                    "percent": 20 + 50 * tracker.finished // len(image_entries),
+                    "message": f"镜像拉取中（{tracker.finished}/{len(image_entries)}）"
+                }
+
+        pull_start = time.time()
+        with trace.span("pull_save", "stage", tid=TRACE_TID_STAGE):
+            if image_entries:
+                run_streaming(
+                    ["/bin/bash", PULL_SCRIPT_PATH, "-d", IMAGE_TAR_DIR, "-f", pull_list_path],
+                    task_id, "镜像拉取", on_line=on_pull_line, on_start=tracker.attach, trace_tid=TRACE_TID_PULL
+                )
+        pull_save_seconds = time.time() - pull_start
+        metrics.observe('builder_build_stage_seconds', tracker.pull_seconds, stage='pull')
+        save_trace(task_id)
+        metrics.observe('builder_build_stage_seconds', tracker.save_seconds, stage='save')
         build_status[task_id] = {
             "status": "progress",
             "percent": 70,
@@ -122,45 +648,150 @@ def run_build_task(task_id, current_version, target_version):
         }
         time.sleep(2)
 
-        # 4. 打包升级包（含镜像.tar + 镜像列表）
-        os.chdir(IMAGE_TAR_DIR)
-        tar_files = glob.glob("*.tar")  # 获取所有镜像文件
-        if not tar_files:
-            raise Exception(f"镜像目录{IMAGE_TAR_DIR}无镜像文件（拉取失败）")
-        
-        # 临时复制镜像列表到打包目录
-        temp_patch_list = os.path.join(IMAGE_TAR_DIR, 'patch_image_tag_list.txt')
-        shutil.copy2(PATCH_LIST_PATH, temp_patch_list)
-        tar_files.append(temp_patch_list)
+        # 4. 打包升级包（只含当前列表中的镜像.tar + 镜像列表，目录中的历史镜像不打包）
+        tar_files = [os.path.join(IMAGE_TAR_DIR, entry.tar_name) for entry in image_entries]
+        missing = [os.path.basename(path) for path in tar_files if not os.path.exists(path)]
+        if missing:
+            raise Exception(f"镜像目录{IMAGE_TAR_DIR}缺少镜像文件（拉取失败）：{', '.join(missing)}")
+        # 镜像列表复制到任务目录（打包、升级包索引用；之后列表文件更新不影响本次构建的升级包）
+        list_copy = os.path.join(task_dir, 'patch_image_tag_list.txt')
+        shutil.copy2(PATCH_LIST_PATH, list_copy)
+        # 镜像tar之外打包的文件：镜像列表、跳过的镜像说明（上传了现场镜像清单时）、安装脚本
+        extra_files = [list_copy] + ([os.path.join(task_dir, SKIPPED_FILE)] if skipped is not None else [])
 
-        # 生成升级包文件名
-        upgrade_package = f"upgrade_{current_version}_to_{target_version}_{task_id}.zip"
-        upgrade_path = os.path.join(IMAGE_TAR_DIR, upgrade_package)
+        def collect_image_metas():
+            """等待后台的校验值计算完成，补上未通过输出识别到的镜像（已缓存的不再读取）"""
+            stage_start = time.time()
+            with trace.span("checksum", "stage", tid=TRACE_TID_STAGE, images=len(image_entries)):
+                checksums.shutdown(wait=True)
+                metas = [image_meta(IMAGE_TAR_DIR, entry.tar_name) for entry in image_entries]
+            metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='checksum')
+            return metas
 
-        # 执行打包（-j：不保留目录结构）
-        zip_result = subprocess.run(
-            ["zip", "-j", upgrade_path] + tar_files,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        write_log(f"打包输出：\n{zip_result.stdout}")
+        # 安装脚本中的sha256、虚拟升级包条目的CRC都来自校验值，先等待后台计算完成
+        image_metas = collect_image_metas()
+        images = package_images(image_entries, image_metas)
+        # 安装脚本（现场并行加载镜像，加载前校验sha256，跳过本机已有的镜像）
+        install_script = os.path.join(task_dir, INSTALL_SCRIPT)
+        write_install_script(install_script, images)
+        extra_files.append(install_script)
+        # 升级包内容摘要（按条目名排序生成的升级包逐字节由条目内容决定；边构建边打包按镜像完成顺序追加，不计算）
+        entry_metas = image_metas + [file_meta(path) for path in extra_files]
+        digest = None if stream else package_digest(entry_metas)
+
+        # 执行打包（-j：不保留目录结构）；上次执行已打包完成且升级包完好时直接复用
+        if package_reusable:
+            write_log(f"任务[{task_id}]升级包已在上次执行中打包完成，直接复用", task_id=task_id)
+        elif virtual:
+            # 虚拟升级包：只记录清单，下载时由镜像tar拼出zip
+            stage_start = time.time()
+            with trace.span("package", "stage", tid=TRACE_TID_STAGE, files=len(tar_files) + len(extra_files),
+                            virtual=True):
+                package_size = write_virtual_package(task_id, upgrade_package, entry_metas)
+            metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='package')
+            journal.record('packaged', package=os.path.join(task_dir, PACKAGE_FILE),
+                           size=package_size, virtual=True)
+        elif streamer is not None:
+            # 边构建边打包：镜像已在拉取过程中追加，补上未通过输出识别到的镜像和镜像列表等文件
+            stage_start = time.time()
+            with trace.span("package", "stage", tid=TRACE_TID_STAGE, files=len(tar_files) + len(extra_files),
+                            streaming=True):
+                for name in streamer.missing():
+                    streamer.add(os.path.join(IMAGE_TAR_DIR, name))
+                for path in extra_files:
+                    streamer.add(path, os.path.basename(path))
+                package_size = streamer.finish()
+                zip_entries = streamer.entries
+                streamer = None
+            metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='package')
+            journal.record('packaged', package=upgrade_path, size=package_size)
+        else:
+            # 不压缩（镜像layer已压缩），条目按文件名排序、时间和权限固定，内容相同的构建生成相同的升级包；
+            # CRC取自校验值，未变化的镜像不再读取（支持reflink时与镜像tar共享数据块）
+            stage_start = time.time()
+            with trace.span("package", "stage", tid=TRACE_TID_STAGE, files=len(tar_files) + len(extra_files)):
+                package_size, cloned, copied = write_package(upgrade_path, entry_metas)
+            # write_package 与按相同顺序拼出的虚拟zip逐字节相同，条目位置由此得到（块校验文件用）
+            zip_entries = VirtualZip(sorted(entry_metas, key=lambda meta: meta['name'])).entries
+            metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='package')
+            metrics.inc('builder_bytes_total', cloned, kind='package_cloned')
+            metrics.inc('builder_bytes_total', copied, kind='package_copied')
+            write_log(f"任务[{task_id}]升级包写出完成：reflink共享{cloned/1024/1024:.1f}MB，"
+                      f"复制{copied/1024/1024:.1f}MB，耗时{time.time() - stage_start:.1f}s", task_id=task_id)
+            journal.record('packaged', package=upgrade_path, size=package_size)
 
-        # 清理临时文件
-        os.remove(temp_patch_list)
+        # 记录升级包引用的blob（升级包存在期间这些layer不会被回收），并按磁盘预算回收无引用的blob
+        package_ref = os.path.join(task_dir, PACKAGE_FILE) if virtual else upgrade_path
+        record_package_blobs(task_id, package_ref, image_entries)
+        # 升级包索引（每个镜像可通过 /images/<镜像名>/<标签> 单独下载）
+        write_package_index(task_id, upgrade_package, digest, images, list_copy, skipped)
+        # 块校验文件（增量下载用）：由各镜像tar缓存的子块记录加上文件头等少量字节拼出，不读取整个升级包；
+        # 分卷时（各卷不另存文件，通过 /download/<task_id>?volume=<序号> 下载）需要各卷的sha256，
+        # 读一遍升级包同时计算两者。复用上次打包的升级包时条目位置未知，同样读一遍升级包
+        if virtual:
+            package = VirtualZip(read_json(os.path.join(task_dir, PACKAGE_FILE))['entries'])
+            package_size, read_range, zip_entries = package.size, package.iter_range, package.entries
+        else:
+            package_size = os.path.getsize(upgrade_path)
+            read_range = lambda start, end: read_file_range(upgrade_path, start, end, IMAGE_CHUNK_SIZE)
+        blockmap_path = os.path.join(task_dir, BLOCKMAP_FILE)
+        etag = package_etag(digest, None if virtual else upgrade_path)
+        volumes = None
+        stage_start = time.time()
+        with trace.span("blockmap", "stage", tid=TRACE_TID_STAGE, volume_size=volume_size):
+            if volume_size or zip_entries is None:
+                volume_digest = VolumeDigest(task_id, upgrade_package, package_size, volume_size) if volume_size else None
+                write_blockmap(blockmap_path, package_size, read_range, etag,
+                               on_chunk=volume_digest.update if volume_digest else None)
+                volumes = volume_digest.manifest() if volume_digest else None
+                if volumes:
+                    write_json(os.path.join(task_dir, VOLUMES_FILE), volumes)
+            else:
+                assemble_blockmap(blockmap_path, package_size, read_range, etag,
+                                  package_block_files(zip_entries, image_metas))
+        metrics.observe('builder_build_stage_seconds', time.time() - stage_start, stage='blockmap')
 
         # 5. 构建完成
-        build_status[task_id] = {
+        status = {
             "status": "complete",
             "percent": 100,
-            "message": f"构建成功！含{len(tar_files)-1}个镜像+1个列表文件",
+            "message": f"构建成功！含{len(tar_files)}个镜像+镜像列表和安装脚本",
             "complete": True,
             "download_url": f"/download/{task_id}",
-            "package_path": upgrade_path,
-            "package_name": upgrade_package
+            "index_url": f"/builds/{task_id}/index.json",
+            "package_name": upgrade_package,
+            "package_digest": digest
         }
-        write_log(f"任务[{task_id}]完成，升级包：{upgrade_package}")
+        if skipped:
+            status.update(skipped=len(skipped), message=f"{status['message']}，跳过现场已有的{len(skipped)}个镜像")
+        if volumes:
+            status.update(volumes=len(volumes['volumes']), volumes_url=f"/builds/{task_id}/{VOLUMES_FILE}",
+                          message=f"{status['message']}，分为{len(volumes['volumes'])}卷")
+        if virtual:
+            status.update(virtual=True, message=f"{status['message']}（虚拟升级包，下载时生成）")
+        else:
+            status["package_path"] = upgrade_path
+        build_status[task_id] = status
+        journal.record('complete')
+        write_log(f"任务[{task_id}]完成，升级包：{upgrade_package}", task_id=task_id)
+        metrics.inc('builder_builds_total', outcome='success')
+        metrics.observe('builder_build_duration_seconds', time.time() - task_start)
+        if attempt == 1:
+            # 从断点恢复的构建耗时不完整，不计入历史
+            try:
+                build_history.append({
+                    "task_id": task_id,
+                    "finished": time.time(),
+                    "seconds": round(time.time() - task_start, 3),
+                    "images": len(image_entries),
+                    "pulled_images": tracker.pulled_images,
+                    "pulled_bytes": tracker.pulled_bytes,
+                    "pull_save_seconds": round(pull_save_seconds, 3),
+                    "package_bytes": journal.steps('packaged')[-1]['size'],
+                    "mode": 'virtual' if virtual else ('stream' if stream else 'zip')
+                })
+            except (IOError, OSError) as e:
+                write_log(f"任务[{task_id}]构建历史写入失败：{e}", level="WARN", task_id=task_id)
 
     except Exception as e:
         # 构建失败处理
@@ -170,12 +801,308 @@ def run_build_task(task_id, current_version, target_version):
             "percent": 0,
             "message": f"构建失败：{error_msg}",
             "complete": True,
-            "error": True
+            "error": True,
+            "output_tail": get_task_output(task_id).tail()
         }
-        write_log(f"任务[{task_id}]失败：{error_msg}", level="ERROR")
+        journal.record('failed', error=error_msg)
+        write_log(f"任务[{task_id}]失败：{error_msg}", level="ERROR", task_id=task_id)
+        metrics.inc('builder_builds_total', outcome='error')
+    finally:
+        if streamer is not None:
+            streamer.abort()
+        checksums.shutdown(wait=False)
+        save_trace(task_id)
+        # 释放本进程中的任务资源（状态/输出/轨迹均已落盘）
+        output = task_output.pop(task_id, None)
+        if output is not None:
+            output.close()
+        task_traces.pop(task_id, None)
+
+
+def verify_saved_images(task_id, journal, image_entries):
+    """恢复执行前检查上次已保存的镜像tar：完好的复用（pull_save.sh按缓存跳过），损坏的删除后重新拉取"""
+    saved = {entry['image']: entry for entry in journal.steps('saved')}
+    reused = 0
+    for entry in image_entries:
+        path = os.path.join(IMAGE_TAR_DIR, entry.tar_name)
+        if not os.path.exists(path):
+            continue
+        record = saved.get(entry.tar_name)
+        if record is not None and os.path.getsize(path) != record['size']:
+            problem = f"大小与保存时不一致（{os.path.getsize(path)} != {record['size']}）"
+        else:
+            problem = check_image_tar(path)
+        if problem:
+            write_log(f"任务[{task_id}]镜像{entry.tar_name}{problem}，删除后重新拉取", level="WARN", task_id=task_id)
+            os.remove(path)
+        else:
+            reused += 1
+    return reused
+
+
+def recover_interrupted_tasks():
+    """调度启动时把上次被中断（已认领、未结束）的任务重新排队，从断点继续"""
+    queued = set(build_queue.pending())
+    for task_id in build_status.task_ids():
+        status = build_status.get(task_id) or {}
+        if status.get('complete') or task_id in queued:
+            continue
+        if not os.path.exists(os.path.join(build_status.task_dir(task_id), REQUEST_FILE)):
+            continue
+        if build_queue.requeue(task_id):
+            build_status[task_id] = dict(status, message="服务重启，构建等待恢复")
+            write_log(f"任务[{task_id}]在上次运行中被中断，重新排队恢复", level="WARN", task_id=task_id)
+
+
+def record_package_blobs(task_id, package_path, image_entries):
+    blobs = []
+    for entry in image_entries:
+        image_ref = blob_store.get_ref(IMAGE_REFS, entry.tar_name)
+        if image_ref is not None:
+            blobs.extend(image_ref.get('blobs', []))
+    if blobs:
+        blob_store.put_ref(PACKAGE_REFS, task_id, blobs, package=package_path)
+    result = blob_store.gc()
+    if result['removed_blobs'] or result['stale_refs']:
+        write_log(f"任务[{task_id}]blob存储回收：删除{result['removed_blobs']}个blob，"
+                  f"释放{result['freed_bytes'] / 1024 / 1024:.1f}MB，清理失效引用{result['stale_refs']}个", task_id=task_id)
+
+
+# -------------------------- 磁盘准入 --------------------------
+def reclaim_disk(task_id, needed, image_entries):
+    """回收磁盘空间（blob存储无引用的blob → 可从blob存储恢复的历史镜像tar → 超过保留期的升级包），返回释放的字节数"""
+    freed_total = 0
+    blob_bytes = blob_store.usage()[0]
+    result = blob_store.gc(max(blob_bytes - needed, 0))
+    freed_total += result['freed_bytes']
+    metrics.inc('builder_disk_evicted_bytes_total', result['freed_bytes'], kind='blobs')
+    if result['removed_blobs']:
+        write_log(f"任务[{task_id}]磁盘空间不足，回收无引用的blob{result['removed_blobs']}个，"
+                  f"释放{format_size(result['freed_bytes'])}", level="WARN", task_id=task_id)
+
+    if freed_total < needed:
+        keep = {entry.tar_name for entry in image_entries} | virtual_package_tars()
+        removed, freed = evict_image_tars(IMAGE_TAR_DIR, blob_store, keep, needed - freed_total)
+        freed_total += freed
+        metrics.inc('builder_disk_evicted_bytes_total', freed, kind='image_tars')
+        if removed:
+            write_log(f"任务[{task_id}]磁盘空间不足，清理历史镜像tar{removed}个（可从blob存储恢复），"
+                      f"释放{format_size(freed)}", level="WARN", task_id=task_id)
+
+    if freed_total < needed:
+        packages = []
+        for other_id in build_status.task_ids():
+            status = build_status.get(other_id) or {}
+            if status.get('status') == 'complete' and status.get('package_path') and not status.get('evicted'):
+                packages.append((other_id, status['package_path']))
+        evicted, freed = evict_packages(packages, needed - freed_total)
+        freed_total += freed
+        metrics.inc('builder_disk_evicted_bytes_total', freed, kind='packages')
+        for other_id in evicted:
+            status = build_status.get(other_id) or {}
+            build_status[other_id] = dict(status, evicted=True, message="升级包已超过保留期并被清理（磁盘空间不足），请重新构建")
+        if evicted:
+            write_log(f"任务[{task_id}]磁盘空间不足，清理超过保留期的升级包{len(evicted)}个（{', '.join(evicted)}），"
+                      f"释放{format_size(freed)}", level="WARN", task_id=task_id)
+    return freed_total
+
+
+def admit_build(task_id, stop_event=None):
+    """构建开始前的磁盘准入：估算峰值占用并预留空间；空间不足时先回收，
+    仍不足且有其他构建在执行时排队等待，否则拒绝。返回是否开始构建（拒绝/停止时返回False）"""
+    try:
+        image_entries, _ = load_image_list(PATCH_LIST_PATH)
+    except (ImageListError, IOError, OSError):
+        return True   # 镜像列表的问题由构建任务报告
+    # 只估算需要打包的镜像（现场已有的不拉取、不打包）
+    image_entries, _ = apply_inventory(task_id, image_entries)
+    estimate = size_estimator.estimate(image_entries)
+    needed = estimate.peak_bytes
+    write_log(f"任务[{task_id}]{estimate.describe()}", task_id=task_id)
+    deferred = False
+    while True:
+        if disk_admission.try_admit(task_id, needed):
+            metrics.inc('builder_admission_total', result='admitted')
+            return True
+        reclaim_disk(task_id, needed - disk_admission.available(), image_entries)
+        if disk_admission.try_admit(task_id, needed):
+            metrics.inc('builder_admission_total', result='admitted')
+            return True
+
+        available = max(disk_admission.available(), 0)
+        if disk_admission.running() == 0:
+            # 没有其他构建占用预留空间，等待也不会有更多空间
+            message = (f"磁盘空间不足：{estimate.describe()}，回收后可用{format_size(available)}"
+                       f"（另需保留{format_size(disk_admission.reserve_bytes)}），请清理 {IMAGE_TAR_DIR} 所在磁盘后重试")
+            build_status[task_id] = {
+                "status": "error",
+                "percent": 0,
+                "message": f"构建失败：{message}",
+                "complete": True,
+                "error": True
+            }
+            write_log(f"任务[{task_id}]被拒绝：{message}", level="ERROR", task_id=task_id)
+            metrics.inc('builder_admission_total', result='rejected')
+            metrics.inc('builder_builds_total', outcome='error')
+            return False
+
+        if not deferred:
+            deferred = True
+            build_status[task_id] = {
+                "status": "progress",
+                "percent": 0,
+                "message": f"磁盘空间不足，排队等待其他构建完成（预计需要{format_size(needed)}，"
+                           f"当前可用{format_size(available)}）"
+            }
+            write_log(f"任务[{task_id}]磁盘空间不足，等待其他构建完成：预计需要{format_size(needed)}，"
+                      f"可用{format_size(available)}", level="WARN", task_id=task_id)
+            metrics.inc('builder_admission_total', result='deferred')
+        if stop_event is not None and stop_event.wait(ADMISSION_RETRY_SECONDS):
+            # 构建进程停止：放回队列，重启后重新准入
+            build_queue.requeue(task_id)
+            return False
+        if stop_event is None:
+            time.sleep(ADMISSION_RETRY_SECONDS)
+
+
+# -------------------------- 构建调度（队列 → 构建线程） --------------------------
+_dispatcher_lock = threading.Lock()
+_dispatcher_started = False
+
+
+def run_dispatcher(stop_event=None):
+    """构建调度循环：从队列认领任务，最多 BUILD_CONCURRENCY 个并发执行"""
+    slots = threading.BoundedSemaphore(BUILD_CONCURRENCY)
+    write_log(f"构建调度启动（pid={os.getpid()}，并发数={BUILD_CONCURRENCY}）")
+    recover_interrupted_tasks()
+
+    def run_task(task):
+        try:
+            if admit_build(task['task_id'], stop_event):
+                run_build_task(task['task_id'], task['current'], task['target'], stream=task.get('stream', False),
+                               virtual=task.get('virtual', False), volume_size=task.get('volume_size', 0))
+        finally:
+            disk_admission.release(task['task_id'])
+            slots.release()
+
+    while stop_event is None or not stop_event.is_set():
+        build_queue.heartbeat()
+        if not slots.acquire(timeout=1):
+            continue
+        task = build_queue.claim()
+        if task is None:
+            slots.release()
+            time.sleep(0.5)
+            continue
+        threading.Thread(target=run_task, args=(task,), name=f"build-{task['task_id']}", daemon=True).start()
+
+    # 停止：等待进行中的构建结束（期间继续心跳，web worker照常接受提交，新任务排队等待重启后的构建进程）
+    for _ in range(BUILD_CONCURRENCY):
+        while not slots.acquire(timeout=1):
+            build_queue.heartbeat()
+    write_log("构建调度已停止")
+
+
+def ensure_dispatcher():
+    """inline模式：在当前进程中启动调度线程（只启动一次）"""
+    global _dispatcher_started
+    if BUILDER_MODE != 'inline' or _dispatcher_started:
+        return
+    with _dispatcher_lock:
+        if not _dispatcher_started:
+            threading.Thread(target=run_dispatcher, name="build-dispatcher", daemon=True).start()
+            _dispatcher_started = True
+
+
+# -------------------------- 构建计划 --------------------------
+PLAN_HISTORY_BUILDS = 20                   # 估算耗时参考的最近构建数
+PLACEHOLDER_SHA256 = '0' * 64              # 未缓存镜像的校验值占位（长度与真实值相同，只影响安装脚本的大小估算）
+PLAN_ACTIONS = {'cached': 'cached', 'blob_store': 'restore', 'registry': 'pull', 'default': 'pull'}
+
+
+def expected_package_size(image_entries, sizes):
+    """按镜像tar大小计算升级包大小：与打包时相同的zip布局（条目按文件名排序、4KB对齐），
+    镜像列表副本和安装脚本按当前内容计算（未缓存镜像的校验值按占位计算）"""
+    images = []
+    for entry in image_entries:
+        meta = cached_image_meta(IMAGE_TAR_DIR, entry.tar_name) or {}
+        images.append({"file": entry.tar_name, "sha256": meta.get('sha256') or PLACEHOLDER_SHA256,
+                       "digest": meta.get('manifest') or f"sha256:{PLACEHOLDER_SHA256}",
+                       "config": meta.get('config') or f"sha256:{PLACEHOLDER_SHA256}",
+                       "repository": entry.repository(IMAGE_REPO), "tag": entry.tag})
+    files = [(entry.tar_name, sizes[entry.tar_name]) for entry in image_entries]
+    files.append(('patch_image_tag_list.txt', os.path.getsize(PATCH_LIST_PATH)))
+    files.append((INSTALL_SCRIPT, len(render_install_script(images).encode('utf-8'))))
+    return VirtualZip([{"name": name, "path": None, "size": size, "crc": 0, "mode": 0o100644}
+                       for name, size in sorted(files)]).size
+
+
+def estimate_build_seconds(pull_bytes):
+    """按最近的构建历史估算耗时：固定开销（总耗时 - 拉取保存耗时）取中位数，
+    需要拉取的字节数按历史拉取速率折算；没有可参考的历史时返回的 seconds 为None并说明原因"""
+    records = build_history.recent(PLAN_HISTORY_BUILDS)
+    if not records:
+        return {"seconds": None, "reason": "暂无构建历史"}
+    overhead = statistics.median(record['seconds'] - record['pull_save_seconds'] for record in records)
+    pulled = [record for record in records if record.get('pulled_bytes')]
+    rate = (sum(record['pulled_bytes'] for record in pulled) / max(sum(record['pull_save_seconds'] for record in pulled), 0.001)
+            if pulled else None)
+    if pull_bytes and rate is None:
+        return {"seconds": None, "reason": "最近的构建都命中缓存，没有可参考的拉取速率", "history_builds": len(records)}
+    if pull_bytes:
+        pull_seconds = pull_bytes / rate
+    else:
+        cached = [record['pull_save_seconds'] for record in records if not record.get('pulled_bytes')]
+        pull_seconds = statistics.median(cached) if cached else 0.0
+    return {
+        "seconds": round(overhead + pull_seconds, 1),
+        "overhead_seconds": round(overhead, 1),
+        "pull_seconds": round(pull_seconds, 1),
+        "pull_mb_per_s": round(rate / 1024 / 1024, 1) if rate else None,
+        "history_builds": len(records)
+    }
+
+
+def build_plan(image_entries):
+    """构建计划：每个镜像的处理方式（cached 已缓存 / restore 从blob存储生成tar / pull 从仓库拉取）和大小，
+    预计的升级包大小、磁盘占用和耗时。只读镜像列表、本地缓存和构建历史，不访问仓库"""
+    estimate = size_estimator.estimate(image_entries, offline=True)
+    images = []
+    summary = {"images": len(image_entries), "cached": 0, "restore": 0, "pull": 0,
+               "cached_bytes": 0, "restore_bytes": 0, "pull_bytes": 0}
+    items = {item['file']: item for item in estimate.items}
+    for entry in image_entries:
+        item = items[entry.tar_name]
+        action = PLAN_ACTIONS[item['source']]
+        images.append(dict(entry.to_dict(IMAGE_REPO), action=action, size=item['size'], size_source=item['source'],
+                           write_bytes=item['write_bytes']))
+        summary[action] += 1
+        summary[f"{action}_bytes"] += item['size']
+    summary.update(
+        image_bytes=estimate.image_bytes,
+        package_bytes=expected_package_size(image_entries, {name: item['size'] for name, item in items.items()}),
+        disk_peak_bytes=estimate.peak_bytes,
+        disk_available_bytes=max(disk_admission.available(), 0),
+        estimated_sizes=estimate.sources.get('default', 0)   # 按平均大小估算的镜像数（大小可能偏差较大）
+    )
+    # 从blob存储生成tar与拉取同在拉取保存阶段，耗时按拉取速率保守估计
+    return images, summary, estimate_build_seconds(summary['restore_bytes'] + summary['pull_bytes'])
 
 
 # -------------------------- Flask路由 --------------------------
+TASK_ID_PATTERN = re.compile(r'^task_\d+_[0-9a-f]+$')  # 与 build() 生成的任务ID格式一致
+
+
+def task_route(view):
+    """URL中带 task_id 的路由：task_id 格式不符时直接返回404（task_id 会拼进 task_records/ 下的路径）"""
+    @functools.wraps(view)
+    def wrapper(task_id, *args, **kwargs):
+        if not TASK_ID_PATTERN.match(task_id):
+            return f"任务ID格式错误：{task_id}", 404
+        return view(task_id, *args, **kwargs)
+    return wrapper
+
+
 @app.route('/')
 def index():
     """前端页面入口"""
@@ -185,50 +1112,152 @@ def index():
 @app.route('/versions')
 def versions():
     """获取版本列表接口（前端下拉框用）"""
-    versions = get_oss_versions()
+    with metrics.timer('builder_versions_request_seconds'):
+        versions = get_oss_versions()
     return jsonify({'success': True, 'versions': versions})
 
 
-@app.route('/build')
+@app.route('/build', methods=['GET', 'POST'])
 def build():
-    """构建接口（SSE实时返回进度）"""
+    """构建接口（SSE实时返回进度）；stream=1 时边构建边打包，提交后即可通过 /download/<task_id>?stream=1 开始下载；
+    virtual=1 时生成虚拟升级包（默认取 PACKAGE_MODE）。
+    volume_mb=<每卷大小MB> 时另外生成分卷清单，各卷通过 /download/<task_id>?volume=<序号> 并行下载。
+    POST 时请求体（或表单文件 inventory）为现场已有镜像清单（如 nerdctl images --format json 的输出），
+    现场已有的镜像不拉取、不打包：
+        curl -N --data-binary @inventory.json 'http://<服务地址>/build?current=<当前版本>&target=<目标版本>'"""
     # 获取前端参数
     current = request.args.get('current')
     target = request.args.get('target')
+    stream = request.args.get('stream') == '1'
+    virtual = request.args.get('virtual', '1' if PACKAGE_MODE == 'virtual' else '0') == '1'
     if not current or not target:
         return jsonify({'success': False, 'message': "请选择当前版本和目标版本"}), 400
-    
-    # 生成任务ID（时间戳）
-    task_id = f"task_{int(time.time())}"
-    # 启动构建线程
-    build_thread = threading.Thread(
-        target=run_build_task,
-        args=(task_id, current, target),
-        daemon=True
-    )
-    build_thread.start()
+    if stream and virtual:
+        return jsonify({'success': False, 'message': "虚拟升级包不支持边构建边下载（构建完成即可下载），请去掉 stream=1 或加 virtual=0"}), 400
+    volume_mb = request.args.get('volume_mb', '0')
+    if not volume_mb.isdigit() or 0 < int(volume_mb) < MIN_VOLUME_MB:
+        return jsonify({'success': False, 'message': f"每卷大小（volume_mb）须为不小于{MIN_VOLUME_MB}的整数（MB）"}), 400
+    inventory = None
+    if request.method == 'POST':
+        if (request.content_length or 0) > MAX_INVENTORY_BYTES:
+            return jsonify({'success': False, 'message': f"现场镜像清单超过{MAX_INVENTORY_BYTES // 1024 // 1024}MB"}), 413
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('inventory')
+            data = upload.read() if upload is not None else b''
+        else:
+            data = request.get_data()
+        try:
+            inventory = Inventory.parse(data.decode('utf-8'))
+        except (InventoryError, UnicodeDecodeError) as e:
+            return jsonify({'success': False, 'message': f"现场镜像清单无法解析：{e}"}), 400
+        if not len(inventory):
+            return jsonify({'success': False, 'message': "现场镜像清单为空"}), 400
+
+    # 构建进程未运行时直接拒绝（否则任务会一直排队）
+    ensure_dispatcher()
+    if BUILDER_MODE == 'external' and not build_queue.builder_alive():
+        return jsonify({'success': False, 'message': "构建服务未运行，请联系管理员"}), 503
+
+    # 生成任务ID（时间戳 + 随机后缀，同一秒内的并发请求不会冲突）
+    task_id = f"task_{int(time.time())}_{secrets.token_hex(3)}"
+    # 提交到构建队列（由构建进程/调度线程执行，web worker只负责推送进度）
+    status = {
+        "status": "progress",
+        "percent": 0,
+        "message": "已提交，排队等待构建"
+    }
+    if stream:
+        package_name = package_file_name(current, target, task_id)
+        os.makedirs(build_status.task_dir(task_id), exist_ok=True)
+        write_json(os.path.join(build_status.task_dir(task_id), STREAM_FILE), {
+            "package_path": os.path.join(IMAGE_TAR_DIR, package_name),
+            "package_name": package_name
+        })
+        status["stream_url"] = f"/download/{task_id}?stream=1"
+    if inventory is not None:
+        os.makedirs(build_status.task_dir(task_id), exist_ok=True)
+        write_json(os.path.join(build_status.task_dir(task_id), INVENTORY_FILE), inventory.to_dict())
+    build_status[task_id] = status
+    build_queue.submit(task_id, {"current": current, "target": target, "stream": stream, "virtual": virtual,
+                                 "volume_size": int(volume_mb) * 1024 * 1024})
+    write_log(f"任务[{task_id}]已提交：{current} → {target}"
+              + (f"（现场镜像清单{len(inventory)}项）" if inventory is not None else ""), task_id=task_id)
+
+    # 返回SSE响应
+    return sse_response(task_id)
 
-    # SSE生成器：实时推送状态
+
+@app.route('/builds/plan')
+def plan():
+    """构建计划（不提交构建）：将打包哪些镜像、哪些已缓存、哪些需要拉取及其大小，预计的升级包大小和构建耗时。
+    只读镜像列表、本地缓存元数据和构建历史，不访问仓库，毫秒级返回：
+        curl 'http://<服务地址>/builds/plan?current=<当前版本>&target=<目标版本>'"""
+    start = time.time()
+    current = request.args.get('current')
+    target = request.args.get('target')
+    if not current or not target:
+        return jsonify({'success': False, 'message': "请选择当前版本和目标版本"}), 400
+    try:
+        image_entries, diagnostics = load_image_list(PATCH_LIST_PATH)
+    except ImageListError as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+    except (IOError, OSError):
+        return jsonify({'success': False, 'message': f"镜像列表文件缺失：{PATCH_LIST_PATH}（请检查OSS同步脚本）"}), 500
+    images, summary, estimate = build_plan(image_entries)
+    return jsonify({
+        'success': True,
+        'current': current,
+        'target': target,
+        'images': images,
+        'summary': summary,
+        'estimate': estimate,
+        'diagnostics': [str(diagnostic) for diagnostic in diagnostics],
+        'elapsed_ms': round((time.time() - start) * 1000, 1)
+    })
+
+
+@app.route('/builds/<task_id>/events')
+@task_route
+def build_events(task_id):
+    """订阅已有构建任务的进度（SSE，格式与 /build 相同）"""
+    if task_id not in build_status:
+        return jsonify({'success': False, 'message': f"任务{task_id}不存在"}), 404
+    return sse_response(task_id)
+
+
+def sse_response(task_id):
+    """SSE实时推送任务状态（data）和子进程输出（event: log），事件中的ts为服务端时间戳"""
     def sse_generator():
         last_percent = -1
-        while True:
-            if task_id not in build_status:
-                time.sleep(0.3)
-                continue
-            
-            status = build_status[task_id]
-            # 状态变化或任务结束时推送
-            if status["percent"] != last_percent or status["status"] in ["complete", "error"]:
-                last_percent = status["percent"]
-                yield f"data: {json.dumps(status)}\n\n"
-            
-            # 任务结束，关闭连接
-            if status.get("complete"):
-                yield "event: close\ndata: 任务结束\n\n"
-                break
-            time.sleep(1)
+        last_message = None
+        output_path = os.path.join(build_status.task_dir(task_id), OUTPUT_FILE)
+        output_offset = 0
+        with metrics.track('builder_sse_connections'):
+            while True:
+                status = build_status.get(task_id)
+                if status is None:
+                    time.sleep(0.3)
+                    continue
+
+                # 推送新增的子进程输出行（event: log），按文件偏移增量读取
+                items, output_offset = OutputLog.read_from(output_path, output_offset)
+                for item in items:
+                    payload = json.dumps({'line': item['line'], 'ts': item['ts']}, ensure_ascii=False)
+                    yield f"event: log\ndata: {payload}\n\n"
+
+                # 状态变化或任务结束时推送
+                if (status["percent"] != last_percent or status["message"] != last_message
+                        or status["status"] in ["complete", "error"]):
+                    last_percent = status["percent"]
+                    last_message = status["message"]
+                    yield f"data: {json.dumps(dict(status, task_id=task_id, ts=time.time()))}\n\n"
+
+                # 任务结束，关闭连接
+                if status.get("complete"):
+                    yield "event: close\ndata: 任务结束\n\n"
+                    break
+                time.sleep(1)
 
-    # 返回SSE响应
     return Response(
         sse_generator(),
         mimetype='text/event-stream',
@@ -236,95 +1265,242 @@ def build():
     )
 
 
+class DownloadAborted(Exception):
+    """边构建边下载时构建失败或升级包被重写：中断连接（不发送结束块），客户端据此判断下载不完整"""
+
+
+def stream_building_package(task_id, package_path, package_name):
+    """边构建边下载：按写入进度发送升级包已写出的部分，构建完成（中央目录写出）后结束响应。
+    不带 Content-Length（分块传输），不支持Range；中途断开后可在构建完成后用普通下载续传"""
+    chunk_size = 1024 * 1024
+
+    def generate():
+        with metrics.track('builder_active_downloads'):
+            f = None
+            inode = None
+            try:
+                while True:
+                    status = build_status.get(task_id) or {}
+                    if f is None and os.path.exists(package_path):
+                        f = open(package_path, 'rb')
+                        inode = os.fstat(f.fileno()).st_ino
+                    if f is not None:
+                        chunk = f.read(chunk_size)
+                        if chunk:
+                            yield chunk
+                            metrics.inc('builder_bytes_total', len(chunk), kind='served')
+                            continue
+                        try:
+                            current_inode = os.stat(package_path).st_ino
+                        except OSError:
+                            current_inode = None
+                        if current_inode != inode:
+                            raise DownloadAborted(f"升级包已被重写（构建从断点恢复）：{package_name}")
+                    if status.get('error'):
+                        raise DownloadAborted(f"构建失败：{status.get('message')}")
+                    if status.get('complete') and f is None:
+                        raise DownloadAborted(f"升级包不存在：{package_name}")
+                    if status.get('complete'):
+                        # 完成前升级包已全部写出；再读一次确认没有剩余
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            write_log(f"任务{task_id}边构建边下载完成：{package_name}", task_id=task_id)
+                            return
+                        yield chunk
+                        metrics.inc('builder_bytes_total', len(chunk), kind='served')
+                        continue
+                    time.sleep(0.5)
+            except DownloadAborted as e:
+                write_log(f"任务{task_id}边构建边下载中断：{e}", "WARN", task_id=task_id)
+                raise
+            finally:
+                if f is not None:
+                    f.close()
+
+    encoded_name = quote(package_name, safe='')
+    headers = {
+        'Content-Type': 'application/zip',
+        'Content-Disposition': f"attachment; filename=\"{encoded_name}\"; filename*=UTF-8''{encoded_name}",
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # 反向代理不缓冲，数据写出即发送
+    }
+    write_log(f"开始边构建边下载任务{task_id}：{package_name}", "INFO", task_id=task_id)
+    return Response(generate(), headers=headers, status=200)
+
+
+def parse_range(range_header, size):
+    """解析Range请求头（bytes=start-end、bytes=start-、bytes=-后缀长度），返回 (start, end)，范围无效时返回None"""
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec or '-' not in spec:
+        return None   # 不支持多段范围
+    start_str, end_str = [value.strip() for value in spec.split('-', 1)]
+    try:
+        if start_str:
+            start = int(start_str)
+            end = min(int(end_str), size - 1) if end_str else size - 1
+        else:
+            start, end = max(size - int(end_str), 0), size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end:
+        return None
+    return start, end
+
+
+def read_file_range(path, start, end, chunk_size):
+    with open(path, 'rb') as f:
+        f.seek(start)  # 定位到起始位置（支持续传）
+        while True:
+            # 计算本次读取的实际块大小（最后一块可能小于chunk_size）
+            read_size = min(chunk_size, end - f.tell() + 1)
+            if read_size <= 0:
+                break
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def range_response(file_name, size, read_range, etag=None, content_type='application/zip', extra_headers=None):
+    """文件下载响应（支持Range续传）：read_range(start, end) 按顺序生成 [start, end] 范围的字节。
+    请求带 If-Range 且与当前ETag不一致（文件已变化）时忽略Range，返回完整内容"""
+    range_header = request.headers.get('Range')
+    if range_header and request.headers.get('If-Range') not in (None, etag):
+        range_header = None
+    start, end = 0, size - 1
+    if range_header:
+        parsed = parse_range(range_header, size)
+        if parsed is None:
+            return "无效的请求范围", 416, {'Content-Range': f"bytes */{size}"}
+        start, end = parsed
+
+    # 文件名编码（支持中文和特殊字符）
+    encoded_name = quote(file_name, safe='')
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f"attachment; filename=\"{encoded_name}\"; filename*=UTF-8''{encoded_name}",
+        'Accept-Ranges': 'bytes',  # 声明支持断点续传
+        'Content-Length': str(end - start + 1),  # 本次传输的大小
+    }
+    if etag:
+        headers['ETag'] = etag
+    headers.update(extra_headers or {})
+    if range_header:
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+
+    def generate():
+        with metrics.track('builder_active_downloads'):
+            for chunk in read_range(start, end):
+                yield chunk
+                metrics.inc('builder_bytes_total', len(chunk), kind='served')
+
+    return Response(generate(), headers=headers, status=206 if range_header else 200)
+
+
+def package_etag(digest, path=None):
+    """升级包的ETag：内容摘要；没有摘要（边构建边打包）时随文件变化（续传时客户端可用 If-Range 确认文件未被重写）"""
+    if digest:
+        return f'"{digest}"'
+    st = os.stat(path)
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def package_source(task_id, chunk_size):
+    """已完成构建的升级包，返回 (升级包信息, None) 或 (None, (错误信息, HTTP状态码))
+
+    升级包信息：{name, size, read_range(start, end), etag, virtual}（下载、块校验文件共用）
+    """
+    # 1. 检查任务状态
+    status = build_status.get(task_id)
+    if status is None or status['status'] != 'complete':
+        msg = f"任务{task_id}不存在或未完成"
+        write_log(f"下载失败：{msg}", "ERROR", task_id=task_id)
+        return None, (msg, 404)
+    if status.get('evicted'):
+        return None, (status.get('message', "升级包已被清理，请重新构建"), 410)
+    package_name = status.get('package_name', f"upgrade_{task_id}.zip")
+    if status.get('virtual'):
+        # 虚拟升级包：按清单由镜像tar拼出zip（清单中记录的文件被清理或变化时不可用）
+        manifest, problem = load_virtual_package(task_id)
+        if problem:
+            write_log(f"任务{task_id}虚拟升级包不可用：{problem}", "WARN", task_id=task_id)
+            return None, (f"升级包不可用（{problem}），请重新构建", 410)
+        package = VirtualZip(manifest['entries'])
+        # 没有内容摘要（之前版本生成）的清单按清单和格式版本算ETag，格式变化后续传会从头下载
+        digest = status.get('package_digest') or hashlib.sha256(
+            (FORMAT_VERSION + json.dumps(manifest['entries'], sort_keys=True)).encode('utf-8')).hexdigest()[:32]
+        return {"name": package_name, "size": package.size, "read_range": package.iter_range,
+                "etag": f'"{digest}"', "virtual": True}, None
+
+    # 2. 安全校验（限制只能下载 image_tar 目录内的文件）
+    package_path = status.get('package_path')
+    if not package_path:
+        return None, ("升级包路径未配置", 500)
+    abs_path = os.path.abspath(package_path)
+    if not abs_path.startswith(os.path.abspath(IMAGE_TAR_DIR)):
+        write_log(f"非法下载请求：{abs_path}", "ERROR")
+        return None, ("禁止访问", 403)
+
+    # 3. 文件存在性和权限检查
+    if not os.path.exists(abs_path):
+        return None, (f"文件不存在：{package_name}", 404)
+    if not os.access(abs_path, os.R_OK):
+        write_log(f"无读取权限：{abs_path}", "ERROR")
+        return None, ("服务器无权限读取文件", 500)
+
+    # 4. ETag为升级包内容摘要，没有摘要时随文件变化
+    return {"name": package_name, "size": os.path.getsize(abs_path), "virtual": False,
+            "etag": package_etag(status.get('package_digest'), abs_path),
+            "read_range": lambda start, end: read_file_range(abs_path, start, end, chunk_size)}, None
+
+
+def volume_response(task_id, source, number):
+    """下载升级包的一卷（升级包中的一段字节，支持Range续传，ETag为该卷的sha256）"""
+    manifest = read_json(os.path.join(build_status.task_dir(task_id), VOLUMES_FILE))
+    if manifest is None:
+        return f"任务{task_id}未分卷（提交构建时加 volume_mb=<每卷大小MB>）", 404
+    if not number.isdigit() or not 1 <= int(number) <= len(manifest['volumes']):
+        return f"分卷序号错误：{number}（共{len(manifest['volumes'])}卷）", 404
+    if manifest['size'] != source['size']:
+        return "升级包已变化，分卷清单失效，请重新构建", 410
+    volume = manifest['volumes'][int(number) - 1]
+    offset = volume['offset']
+    write_log(f"开始下载任务{task_id}分卷：{volume['file']}（大小：{volume['size']/1024/1024:.2f}MB）",
+              "INFO", task_id=task_id)
+    return range_response(volume['file'], volume['size'],
+                          lambda start, end: source['read_range'](offset + start, offset + end),
+                          f'"sha256:{volume["sha256"]}"', content_type='application/octet-stream')
+
+
 @app.route('/download/<task_id>')
+@task_route
 def download(task_id):
+    """下载升级包（支持Range续传）；stream=1 且构建未完成时边构建边下载"""
     global build_status
     # 配置：设置每次读取的块大小（10MB，平衡性能和内存占用）
     CHUNK_SIZE = 100 * 1024 * 1024  # 10MB
     # 安全目录：限制只能下载此目录内的文件
-    SAFE_DIR = "/home/auto_packing_no_delete/image_tar"
+    SAFE_DIR = IMAGE_TAR_DIR
 
     try:
-        # 1. 检查任务状态
-        if task_id not in build_status or build_status[task_id]['status'] != 'complete':
-            msg = f"任务{task_id}不存在或未完成"
-            write_log(f"下载失败：{msg}", "ERROR")
-            return msg, 404
-
-        status = build_status[task_id]
-        package_path = status.get('package_path')
-        package_name = status.get('package_name', f"upgrade_{task_id}.zip")
-
-        # 2. 安全校验
-        if not package_path:
-            return "升级包路径未配置", 500
-            
-        # 转换为绝对路径并检查是否在安全目录内
-        abs_path = os.path.abspath(package_path)
-        if not abs_path.startswith(os.path.abspath(SAFE_DIR)):
-            write_log(f"非法下载请求：{abs_path}", "ERROR")
-            abort(403)  # 禁止访问目录外文件
-
-        # 3. 文件存在性和权限检查
-        if not os.path.exists(abs_path):
-            return f"文件不存在：{package_name}", 404
-            
-        if not os.access(abs_path, os.R_OK):
-            write_log(f"无读取权限：{abs_path}", "ERROR")
-            return "服务器无权限读取文件", 500
-
-        # 4. 获取文件大小（用于进度显示和续传）
-        file_size = os.path.getsize(abs_path)
-
-        # 5. 处理续传请求（支持断点续传）
-        range_header = request.headers.get('Range', None)
-        start = 0
-        end = file_size - 1
-
-        if range_header:
-            # 解析Range请求头（格式：bytes=start-end）
-            range_str = range_header.split('=')[1]
-            if '-' in range_str:
-                start_str, end_str = range_str.split('-')
-                start = int(start_str) if start_str else 0
-                end = int(end_str) if end_str else file_size - 1
-
-            # 验证范围有效性
-            if start < 0 or end >= file_size or start > end:
-                return "无效的请求范围", 416  # 416 表示范围不合法
-
-        # 6. 文件名编码（支持中文和特殊字符）
-        encoded_name = quote(package_name, safe='')
-
-        # 7. 构建响应头
-        headers = {
-            'Content-Type': 'application/zip',
-            'Content-Disposition': f"attachment; filename=\"{encoded_name}\"; filename*=UTF-8''{encoded_name}",
-            'Accept-Ranges': 'bytes',  # 声明支持断点续传
-            'Content-Length': str(end - start + 1),  # 本次传输的大小
-        }
+        # 边构建边下载（构建完成后按普通下载处理，支持Range）
+        status = build_status.get(task_id)
+        if request.args.get('stream') == '1' and status is not None and not status.get('complete'):
+            stream_info = read_json(os.path.join(build_status.task_dir(task_id), STREAM_FILE))
+            if stream_info is None:
+                return f"任务{task_id}未开启边构建边下载（提交构建时加 stream=1）", 409
+            if not os.path.abspath(stream_info['package_path']).startswith(os.path.abspath(SAFE_DIR)):
+                abort(403)
+            return stream_building_package(task_id, stream_info['package_path'], stream_info['package_name'])
 
-        # 8. 处理部分内容响应（续传）
-        status_code = 206 if range_header else 200
-        if range_header:
-            headers['Content-Range'] = f"bytes {start}-{end}/{file_size}"
-
-        # 9. 流式传输文件（核心优化：避免一次性加载大文件到内存）
-        def file_stream():
-            with open(abs_path, 'rb') as f:
-                f.seek(start)  # 定位到起始位置（支持续传）
-                while True:
-                    # 计算本次读取的实际块大小（最后一块可能小于CHUNK_SIZE）
-                    read_size = min(CHUNK_SIZE, end - f.tell() + 1)
-                    if read_size <= 0:
-                        break
-                    chunk = f.read(read_size)
-                    if not chunk:
-                        break
-                    yield chunk
-
-        write_log(f"开始下载任务{task_id}：{package_name}（大小：{file_size/1024/1024:.2f}MB）", "INFO")
-        return Response(file_stream(), headers=headers, status=status_code)
+        source, error = package_source(task_id, CHUNK_SIZE)
+        if error:
+            return error
+        if request.args.get('volume'):
+            return volume_response(task_id, source, request.args['volume'])
+        write_log(f"开始下载任务{task_id}：{source['name']}（{'虚拟升级包，' if source['virtual'] else ''}"
+                  f"大小：{source['size']/1024/1024:.2f}MB）", "INFO", task_id=task_id)
+        return range_response(source['name'], source['size'], source['read_range'], source['etag'])
 
     except Exception as e:
         error_msg = f"下载异常：{str(e)}"
@@ -333,11 +1509,136 @@ def download(task_id):
     
 
 
+@app.route('/builds/<task_id>/index.json')
+@task_route
+def build_index(task_id):
+    """升级包索引：每个镜像的大小、sha256、digest和单独下载地址（upgrade_client.py 据此只下载缺少的镜像）"""
+    index = read_json(os.path.join(build_status.task_dir(task_id), INDEX_FILE))
+    if index is None:
+        return f"任务{task_id}不存在或未完成", 404
+    return jsonify(index)
+
+
+@app.route(f'/builds/<task_id>/{INSTALL_SCRIPT}')
+@task_route
+def build_install_script(task_id):
+    """升级包中的安装脚本（upgrade_client.py 只下载镜像时一并下载）"""
+    path = os.path.join(build_status.task_dir(task_id), INSTALL_SCRIPT)
+    if not os.path.exists(path):
+        return f"任务{task_id}不存在或未完成", 404
+    return send_file(path, mimetype='text/x-shellscript', as_attachment=True, attachment_filename=INSTALL_SCRIPT)
+
+
+@app.route(f'/builds/<task_id>/{VOLUMES_FILE}')
+@task_route
+def build_volumes(task_id):
+    """分卷清单：每卷的文件名、偏移、大小、sha256和下载地址（upgrade_client.py --volumes 据此并行下载并拼接）"""
+    manifest = read_json(os.path.join(build_status.task_dir(task_id), VOLUMES_FILE))
+    if manifest is None:
+        return f"任务{task_id}不存在、未完成或未分卷", 404
+    return jsonify(manifest)
+
+
+def generate_blockmap(task_id, path, source):
+    """后台生成块校验文件（同一任务同时只有一个线程生成）"""
+    start = time.time()
+    try:
+        blocks = write_blockmap(path, source['size'], source['read_range'], source['etag'])
+        write_log(f"任务{task_id}块校验文件生成完成：{blocks}块，耗时{time.time() - start:.1f}s", task_id=task_id)
+    except (IOError, OSError) as e:
+        write_log(f"任务{task_id}块校验文件生成失败：{e}", "ERROR", task_id=task_id)
+    finally:
+        with blockmap_lock:
+            blockmap_jobs.discard(task_id)
+
+
+@app.route('/builds/<task_id>/blockmap')
+@task_route
+def build_blockmap(task_id):
+    """升级包的块校验文件（upgrade_client.py --old 据此只下载与旧升级包不同的块），构建时生成；
+    没有或已失效时（之前版本构建的升级包）在后台生成，返回202和Retry-After，不占用请求线程读取整个升级包"""
+    source, error = package_source(task_id, IMAGE_CHUNK_SIZE)
+    if error:
+        return error
+    path = os.path.join(build_status.task_dir(task_id), BLOCKMAP_FILE)
+    header = read_blockmap_header(path)
+    if (header is None or header.get('version') != BLOCKMAP_VERSION or header.get('etag') != source['etag']
+            or header.get('size') != source['size']):
+        with blockmap_lock:
+            started = task_id not in blockmap_jobs
+            blockmap_jobs.add(task_id)
+        if started:
+            threading.Thread(target=generate_blockmap, args=(task_id, path, source), daemon=True).start()
+        response = Response("块校验文件生成中，请稍后重试", status=202, mimetype='text/plain')
+        response.headers['Retry-After'] = str(BLOCKMAP_RETRY_SECONDS)
+        return response
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True, attachment_filename=BLOCKMAP_FILE)
+
+
+
+@app.route('/images/<path:name>/<tag>')
+def download_image(name, tag):
+    """单独下载镜像tar（支持Range续传），tag 也可以是 sha256:<digest>；ETag为文件的sha256（已计算时）"""
+    entry, error = parse_ref(f"{name}@{tag}" if tag.startswith('sha256:') else f"{name}:{tag}")
+    if entry is None:
+        return f"镜像名或标签格式错误：{error}", 400
+    path = os.path.join(IMAGE_TAR_DIR, entry.tar_name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return f"镜像未缓存：{entry.tar_name}", 404
+    meta = cached_image_meta(IMAGE_TAR_DIR, entry.tar_name)
+    etag = f'"sha256:{meta["sha256"]}"' if meta else f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    write_log(f"开始下载镜像：{entry.tar_name}（大小：{st.st_size/1024/1024:.2f}MB）", "INFO")
+    return range_response(entry.tar_name, st.st_size,
+                          lambda start, end: read_file_range(path, start, end, IMAGE_CHUNK_SIZE), etag,
+                          content_type='application/x-tar',
+                          extra_headers={'X-Image-Digest': meta['manifest']} if meta and meta.get('manifest') else None)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus指标接口（汇总所有worker进程）"""
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/builds/<task_id>/trace')
+@task_route
+def build_trace(task_id):
+    """导出构建任务的执行轨迹（Chrome trace-event JSON，可在 chrome://tracing 或 Perfetto 中打开）"""
+    trace = task_traces.get(task_id)
+    data = trace.to_chrome() if trace is not None else read_json(
+        os.path.join(build_status.task_dir(task_id), TRACE_FILE))
+    if data is None:
+        return f"任务{task_id}不存在或无执行轨迹", 404
+    response = jsonify(data)
+    response.headers['Content-Disposition'] = f"attachment; filename=\"trace_{task_id}.json\""
+    return response
+
+
 # -------------------------- 启动服务 --------------------------
+def run_builder():
+    """独立构建进程入口（gunicorn部署时由 gunicorn.conf.py 启动：python app.py --builder）"""
+    stop_event = threading.Event()
+
+    def handle_stop(signum, frame):
+        write_log(f"构建进程收到信号{signum}，停止认领新任务")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    run_dispatcher(stop_event)
+    log_writer.flush()
+
+
 if __name__ == '__main__':
+    if '--builder' in sys.argv[1:]:
+        run_builder()
+        sys.exit(0)
     write_log("="*50)
     write_log("DeepFlow升级包构建服务启动")
     write_log(f"服务地址：http://0.0.0.0:8000")
     write_log(f"基础目录：{BASE_DIR}")
     write_log("="*50)
-    app.run(host='0.0.0.0', port=8000, debug=False)  # 生产环境关闭debug
\ No newline at end of file
+    ensure_dispatcher()
+    app.run(host='0.0.0.0', port=8000, debug=False)  # 开发/单机调试用；生产环境使用 gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,236 @@
+"""应用日志：构建线程只把日志放入队列，由单独的写入线程批量落盘
+
+- 日志文件为JSON行格式（ts/level/msg/task_id/pid/thread），按任务ID检索无需grep全文；
+  调用方传入的附加字段与保留键同名时改名为 field_<名称>，不会覆盖保留键
+- 文件超过 LOG_MAX_BYTES 时轮转为 app.log.<时间戳>，后台gzip压缩，最多保留 LOG_BACKUP_COUNT 个分段
+- 控制台输出保持原来的 "[时间] [级别] 内容" 格式
+- 多进程安全（gunicorn多worker + 构建进程写同一个app.log）：以追加模式写入，每批写入前检查文件是否
+  已被其他进程轮转（inode变化则重新打开），轮转在 app.log.lock 文件锁内进行并重新确认实际大小
+
+命令行检索（含已压缩的历史分段）：
+    python3 applog.py logs/app.log --task task_1756375683 [--level ERROR]
+"""
+import argparse
+import atexit
+import fcntl
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+LOG_MAX_BYTES = int(os.environ.get('APP_LOG_MAX_BYTES', 100 * 1024 * 1024))  # 单个日志文件上限（100MB）
+LOG_BACKUP_COUNT = int(os.environ.get('APP_LOG_BACKUP_COUNT', 20))           # 保留的历史分段数
+LOG_QUEUE_SIZE = 100000          # 队列上限（写入跟不上时丢弃并计数，不阻塞构建线程）
+LOG_BATCH_SIZE = 1000            # 单次批量写入的最大条数
+LOG_FLUSH_INTERVAL = 0.5         # 队列空闲时的最长等待时间（秒）
+LOG_MAX_MESSAGE = 64 * 1024      # 单条日志最大长度（超出截断，避免整段输出写成一条巨型日志）
+RESERVED_FIELDS = ('ts', 'level', 'msg', 'task_id', 'pid', 'thread')  # 附加字段不能覆盖的保留键
+
+
+class LogWriter(object):
+    """单写入线程：批量写入、按大小轮转、gzip压缩历史分段"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, console=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.console = console
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._dropped = 0
+        self._file = None
+        self._inode = None
+        self._size = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._compress_queue = queue.Queue()
+
+    # ---------- 生产者（热路径，只做入队） ----------
+    def log(self, content, level="INFO", task_id=None, **fields):
+        record = (time.time(), level, content, task_id, threading.current_thread().name, fields)
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._dropped += 1
+
+    # ---------- 写入线程 ----------
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            threading.Thread(target=self._compress_loop, name="log-compress", daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                sys.stderr.write(f"日志写入失败：{e}\n")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch):
+        lines = []
+        console_lines = []
+        if self._dropped:
+            dropped, self._dropped = self._dropped, 0
+            batch.insert(0, (time.time(), "WARN", f"日志队列已满，丢弃{dropped}条日志", None, "log-writer", {}))
+        pid = os.getpid()
+        for ts, level, content, task_id, thread_name, fields in batch:
+            content = str(content)
+            if len(content) > LOG_MAX_MESSAGE:
+                content = content[:LOG_MAX_MESSAGE] + f"...（已截断，原长度{len(content)}）"
+            entry = {
+                'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(ts)) + '.%03d' % (ts % 1 * 1000),
+                'level': level,
+                'msg': content,
+                'pid': pid,
+                'thread': thread_name,
+            }
+            if task_id:
+                entry['task_id'] = task_id
+            for key, value in fields.items():
+                # 与保留键同名的附加字段改名为 field_<名称>，保证 search() 按 task_id/level 检索不受影响
+                entry[f'field_{key}' if key in RESERVED_FIELDS else key] = value
+            # 不可序列化的附加字段（bytes、异常、datetime等）转为字符串，避免整批日志写入失败
+            lines.append(json.dumps(entry, ensure_ascii=False, default=str))
+            if self.console:
+                timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+                console_lines.append(f"[{timestamp}] [{level}] {content}")
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        if self._file is None or self._rotated_elsewhere():
+            self._open()
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate(len(data))
+        self._file.write(data)
+        self._file.flush()
+        self._size = self._file.tell()
+        if console_lines:
+            print('\n'.join(console_lines), flush=True)
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._size = self._file.seek(0, os.SEEK_END)
+
+    def _rotated_elsewhere(self):
+        """日志文件是否已被其他进程轮转（路径指向的inode与已打开的不同）"""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return True
+
+    def _rotate(self, incoming):
+        """轮转（文件锁内进行，多个进程只有一个真正执行）"""
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # 其他进程可能已经轮转过：重新打开并确认实际大小
+                if self._rotated_elsewhere():
+                    self._open()
+                if self._size and self._size + incoming > self.max_bytes:
+                    self._rotate_locked()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate_locked(self):
+        """当前文件改名为带时间戳的分段（瞬间完成），压缩交给后台线程"""
+        now = time.time()
+        segment = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now % 1 * 1000):03d}"
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            time.sleep(0.001)
+            now = time.time()
+            segment = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now % 1 * 1000):03d}"
+        os.rename(self.path, segment)
+        self._open()
+        self._compress_queue.put(segment)
+
+    def _compress_loop(self):
+        while True:
+            segment = self._compress_queue.get()
+            try:
+                with open(segment, 'rb') as src, gzip.open(segment + '.gz.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.rename(segment + '.gz.tmp', segment + '.gz')
+                os.remove(segment)
+                self._prune()
+            except Exception as e:
+                sys.stderr.write(f"日志分段压缩失败：{segment}（{e}）\n")
+
+    def _prune(self):
+        """只保留最新的 backup_count 个历史分段"""
+        segments = sorted(glob.glob(glob.escape(self.path) + '.*.gz'))
+        for old in segments[:max(len(segments) - self.backup_count, 0)]:
+            os.remove(old)
+
+    def flush(self, timeout=5):
+        """等待队列中的日志全部落盘（进程退出前调用）"""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+
+def iter_log_files(path):
+    """按时间顺序返回历史分段（.gz）和当前日志文件"""
+    files = sorted(glob.glob(glob.escape(path) + '.*.gz'))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def search(path, task_id=None, level=None):
+    """检索日志（含已压缩分段），逐条返回匹配的JSON记录"""
+    for file_path in iter_log_files(path):
+        opener = gzip.open if file_path.endswith('.gz') else open
+        with opener(file_path, 'rt', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                # 先做子串预筛，只解析可能匹配的行
+                if task_id and task_id not in line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 旧格式的纯文本日志
+                if task_id and entry.get('task_id') != task_id:
+                    continue
+                if level and entry.get('level') != level:
+                    continue
+                yield entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检索app.log（JSON行格式，含gzip历史分段）")
+    parser.add_argument('path', help="日志文件路径，例如 logs/app.log")
+    parser.add_argument('--task', help="按任务ID过滤")
+    parser.add_argument('--level', help="按级别过滤（INFO/WARN/ERROR）")
+    args = parser.parse_args(argv)
+    for entry in search(args.path, task_id=args.task, level=args.level):
+        print(f"[{entry.get('ts')}] [{entry.get('level')}] {entry.get('msg')}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""离线端到端构建基准测试（不依赖真实镜像仓库和OSS）
+
+在临时目录中部署一份app，PATH中放入 bench/fakebin 下的 fake nerdctl / fake ossutil，
+启动服务后依次请求 /versions、/build（SSE直到完成）、/download，统计：
+    - 构建总耗时（冷缓存 / 热缓存各一次）
+    - 打包吞吐（升级包大小 ÷ 打包阶段耗时，阶段耗时取自 /builds/<id>/trace）
+    - 下载吞吐
+    - 端到端耗时（提交构建 → 升级包下载完成；--stream 时边构建边下载）
+    - 服务进程及其子进程的内存峰值
+    - 升级包是否可复现（冷/热缓存两次构建的镜像相同，升级包的sha256应一致）
+结果写入JSON文件，可用 --compare 与其他版本的结果对比。
+
+用法（在 auto_packing_no_delete 目录下）：
+    myenv/bin/python3 bench/bench_build.py --images 20 --image-size-mb 50 --output bench_result.json
+    myenv/bin/python3 bench/bench_build.py --output new.json --compare old.json
+    myenv/bin/python3 bench/bench_build.py --pull-backend registry   # 直接从仓库下载（bench/fake_registry.py）
+    myenv/bin/python3 bench/bench_build.py --stream                  # 提交后立即开始下载（/build?stream=1）
+    myenv/bin/python3 bench/bench_build.py --virtual                 # 虚拟升级包（PACKAGE_MODE=virtual）
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+FAKEBIN_DIR = os.path.join(BENCH_DIR, 'fakebin')
+APP_FILES = ('*.py', '*.sh', 'index.html')
+READ_CHUNK = 1024 * 1024
+
+
+# -------------------------- 沙箱与服务 --------------------------
+def prepare_sandbox(workdir, image_count):
+    """复制app文件到沙箱目录，并生成镜像列表"""
+    for pattern in APP_FILES:
+        for path in glob.glob(os.path.join(APP_DIR, pattern)):
+            shutil.copy2(path, workdir)
+    list_dir = os.path.join(workdir, 'latest_image_list')
+    os.makedirs(list_dir, exist_ok=True)
+    with open(os.path.join(list_dir, 'patch_image_tag_list.txt'), 'w') as f:
+        for i in range(image_count):
+            f.write(f"bench-image-{i:02d}_tag:v6.6.{1000 + i}\n")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_env(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        'PATH': FAKEBIN_DIR + os.pathsep + env.get('PATH', ''),
+        'AUTO_PACKING_BASE_DIR': workdir,
+        'PYTHON_BIN': sys.executable,
+        'FAKE_NERDCTL_STATE': os.path.join(workdir, 'fake-nerdctl-state'),
+        'DOCKER_CONFIG': os.path.join(workdir, 'docker-config'),
+        'FAKE_IMAGE_SIZE_MB': str(args.image_size_mb),
+        'FAKE_PULL_MBPS': str(args.pull_mbps),
+        'FAKE_SAVE_MBPS': str(args.save_mbps),
+        'FAKE_LATENCY_MS': str(args.latency_ms),
+        'FAKE_IMAGE_COUNT': str(args.images),
+        'PULL_BACKEND': args.pull_backend,
+        'PACKAGE_MODE': 'virtual' if args.virtual else 'zip',
+    })
+    return env
+
+
+def start_registry(env):
+    """启动本地仓库替身，返回 (进程, 地址)"""
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_registry.py'), '--port', str(port)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc, f"127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("仓库替身启动超时")
+
+
+def start_server(workdir, env, port):
+    code = f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f"服务启动失败（退出码{proc.returncode}）")
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("服务启动超时")
+
+
+def peak_rss_kb(pid):
+    """进程内存峰值（VmHWM，KB）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return 0
+
+
+# -------------------------- 各接口测量 --------------------------
+def measure_versions(base_url, repeat=5):
+    latencies = []
+    for _ in range(repeat):
+        start = time.time()
+        with urllib.request.urlopen(f"{base_url}/versions") as resp:
+            data = json.load(resp)
+        latencies.append((time.time() - start) * 1000)
+    latencies.sort()
+    return {
+        "versions_count": len(data.get('versions', [])),
+        "latency_ms_p50": round(latencies[len(latencies) // 2], 2),
+        "latency_ms_max": round(latencies[-1], 2),
+    }
+
+
+def run_build(base_url, current, target, stream=False, on_submitted=None):
+    """请求 /build 并读取SSE直到结束，返回 (最终状态, 构建耗时秒)；收到第一个状态时回调 on_submitted(状态)"""
+    start = time.time()
+    url = f"{base_url}/build?current={current}&target={target}" + ("&stream=1" if stream else "")
+    final = None
+    with urllib.request.urlopen(url, timeout=3600) as resp:
+        for raw in resp:
+            line = raw.decode('utf-8').rstrip('\n')
+            if line.startswith('data: {'):
+                status = json.loads(line[6:])
+                if on_submitted is not None:
+                    on_submitted(status)
+                    on_submitted = None
+                if status.get('complete'):
+                    final = status
+            elif line.startswith('event: close'):
+                break
+    elapsed = time.time() - start
+    if final is None or final.get('status') != 'complete':
+        raise RuntimeError(f"构建失败：{final}")
+    return final, elapsed
+
+
+def stage_durations(base_url, task_id):
+    """从执行轨迹中读取各阶段耗时（秒）"""
+    with urllib.request.urlopen(f"{base_url}/builds/{task_id}/trace") as resp:
+        trace = json.load(resp)
+    stages = {}
+    for event in trace.get('traceEvents', []):
+        if event.get('ph') == 'X' and event.get('cat') == 'stage':
+            stages[event['name']] = round(event['dur'] / 1e6, 3)
+    return stages
+
+
+def measure_download(base_url, download_url):
+    start = time.time()
+    total = 0
+    with urllib.request.urlopen(f"{base_url}{download_url}", timeout=3600) as resp:
+        while True:
+            chunk = resp.read(READ_CHUNK)
+            if not chunk:
+                break
+            total += len(chunk)
+    elapsed = time.time() - start
+    return total, elapsed
+
+
+def package_sha256(base_url, download_url):
+    """升级包内容的sha256（单独下载一次，不计入下载耗时）"""
+    digest = hashlib.sha256()
+    with urllib.request.urlopen(f"{base_url}{download_url}", timeout=3600) as resp:
+        for chunk in iter(lambda: resp.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def measure_build(base_url, label, stream=False):
+    start = time.time()
+    streamed = {}
+
+    def download_stream(stream_url):
+        streamed['size'], streamed['seconds'] = measure_download(base_url, stream_url)
+        streamed['finished'] = time.time()
+
+    downloader = None
+    if stream:
+        def on_submitted(status):
+            nonlocal downloader
+            downloader = threading.Thread(target=download_stream, args=(status['stream_url'],))
+            downloader.start()
+        final, makespan = run_build(base_url, 'bench-current', 'bench-target', stream=True, on_submitted=on_submitted)
+        downloader.join()
+        size, download_seconds = streamed['size'], streamed['seconds']
+        end_to_end = streamed['finished'] - start
+    else:
+        final, makespan = run_build(base_url, 'bench-current', 'bench-target')
+        size, download_seconds = measure_download(base_url, final['download_url'])
+        end_to_end = time.time() - start
+    task_id = final['download_url'].rsplit('/', 1)[-1]
+    stages = stage_durations(base_url, task_id)
+    size_mb = size / 1024 / 1024
+    package_seconds = stages.get('package', 0)
+    result = {
+        "task_id": task_id,
+        "makespan_s": round(makespan, 3),
+        "stages_s": stages,
+        "package_mb": round(size_mb, 2),
+        "packaging_mb_per_s": round(size_mb / package_seconds, 2) if package_seconds else None,
+        "download_s": round(download_seconds, 3),
+        "download_mb_per_s": round(size_mb / download_seconds, 2) if download_seconds else None,
+        "end_to_end_s": round(end_to_end, 3),
+        "package_sha256": package_sha256(base_url, final['download_url']),
+    }
+    print(f"[{label}] 构建{result['makespan_s']}s，升级包{result['package_mb']}MB，"
+          f"打包{result['packaging_mb_per_s']}MB/s，下载{result['download_mb_per_s']}MB/s，"
+          f"端到端{result['end_to_end_s']}s")
+    return result
+
+
+# -------------------------- 结果对比 --------------------------
+def flatten(data, prefix=''):
+    items = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[path] = value
+    return items
+
+
+def compare(old, new):
+    old_items = flatten(old.get('results', {}))
+    new_items = flatten(new.get('results', {}))
+    print(f"\n对比：{old.get('revision')} → {new.get('revision')}")
+    for key in sorted(set(old_items) & set(new_items)):
+        before, after = old_items[key], new_items[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {key:<40} {before:>12} → {after:<12} {change}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线端到端构建基准测试")
+    parser.add_argument('--images', type=int, default=10, help="镜像数量（默认10）")
+    parser.add_argument('--image-size-mb', type=float, default=20, help="每个镜像大小MB（默认20）")
+    parser.add_argument('--pull-mbps', type=float, default=200, help="模拟拉取吞吐MB/s（默认200，0不限速）")
+    parser.add_argument('--save-mbps', type=float, default=0, help="模拟保存吞吐MB/s（默认0不限速）")
+    parser.add_argument('--latency-ms', type=float, default=50, help="模拟仓库延迟ms（默认50）")
+    parser.add_argument('--pull-backend', choices=('nerdctl', 'registry'), default='nerdctl',
+                        help="拉取方式（默认nerdctl；registry使用本地仓库替身）")
+    parser.add_argument('--stream', action='store_true', help="边构建边下载（/build?stream=1，提交后立即开始下载）")
+    parser.add_argument('--virtual', action='store_true', help="虚拟升级包（PACKAGE_MODE=virtual，下载时由镜像tar生成）")
+    parser.add_argument('--workdir', help="沙箱目录（默认临时目录，结束后删除）")
+    parser.add_argument('--output', default='bench_result.json', help="结果文件（默认bench_result.json）")
+    parser.add_argument('--compare', help="与之前的结果文件对比")
+    args = parser.parse_args(argv)
+    if args.stream and args.virtual:
+        parser.error("--stream 与 --virtual 不能同时使用")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='auto_packing_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    prepare_sandbox(workdir, args.images)
+    env = bench_env(args, workdir)
+    registry = None
+    if args.pull_backend == 'registry':
+        registry, registry_address = start_registry(env)
+        env['IMAGE_REPO'] = f"{registry_address}/dev/"
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    server = start_server(workdir, env, port)
+    try:
+        results = {"versions": measure_versions(base_url)}
+        results["cold_build"] = measure_build(base_url, "冷缓存", args.stream)
+        results["warm_build"] = measure_build(base_url, "热缓存", args.stream)
+        results["reproducible"] = results["cold_build"]["package_sha256"] == results["warm_build"]["package_sha256"]
+        print(f"升级包可复现（两次构建逐字节相同）：{'是' if results['reproducible'] else '否'}")
+        results["server_peak_rss_kb"] = peak_rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        if registry is not None:
+            registry.terminate()
+            registry.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    # 已回收的子进程（服务及其回收的pull_save.sh/nerdctl/zip）中的最大内存峰值
+    results["children_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'workdir')},
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入：{args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""本地镜像仓库替身（离线基准测试 / registry_client.py 验证用）
+
+实现 Docker Registry HTTP API v2 的只读部分：
+    GET /v2/                               401 + Bearer认证要求（FAKE_REGISTRY_AUTH=0 时不认证）
+    GET /token?service=&scope=             Basic认证换取token（expires_in = FAKE_TOKEN_TTL）
+    GET /v2/<name>/manifests/<tag|digest>  docker v2 manifest（任意镜像名/标签都存在；
+                                           FAKE_REGISTRY_MANIFEST_LIST=1 时按标签返回 arm64/v8 + amd64 的多架构manifest列表）
+    GET /v2/<name>/blobs/<digest>          配置和layer（FAKE_REGISTRY_REDIRECT=1 时302到 /storage/<digest>；
+                                           FAKE_REGISTRY_CORRUPT=1 时layer第一个字节被改写，大小不变、sha256不符）
+    GET /stats                             请求计数（token/manifest/blob次数、blob重定向次数、blob字节数、TCP连接数）
+
+镜像内容与 fakeimage.py 一样由镜像引用确定：每个镜像 FAKE_REGISTRY_LAYERS 个layer（共 image_size 字节），
+另有 FAKE_BASE_LAYER_MB 大小、所有镜像共用的基础layer（模拟公共基础镜像）。
+按 FAKE_PULL_MBPS 限速、FAKE_LATENCY_MS 模拟延迟。
+测试中可在进程内启动（FakeRegistry(('127.0.0.1', 0))），直接修改上述开关对应的属性，
+revoke_tokens() 使已签发的token全部失效（模拟token被提前吊销，客户端收到401后重新认证）。
+
+用法：
+    python3 bench/fake_registry.py --port 5000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import secrets
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakeimage import env_float, image_size, layer_chunks  # noqa: E402
+
+MANIFEST_RE = re.compile(r'^/v2/(?P<name>.+)/manifests/(?P<reference>[^/]+)$')
+BLOB_RE = re.compile(r'^/v2/(?P<name>.+)/blobs/(?P<digest>sha256:[0-9a-f]{64})$')
+STORAGE_RE = re.compile(r'^/storage/(?P<digest>sha256:[0-9a-f]{64})$')
+DOCKER_MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+DOCKER_MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+DOCKER_CONFIG = 'application/vnd.docker.container.image.v1+json'
+LAYER_TYPE = 'application/vnd.docker.image.rootfs.diff.tar'
+
+
+class ImageCatalog(object):
+    """按镜像引用确定性生成 manifest / 配置 / layer，记录 digest → 内容"""
+
+    def __init__(self):
+        self.layer_count = max(int(env_float('FAKE_REGISTRY_LAYERS', 3)), 1)
+        self.base_size = int(env_float('FAKE_BASE_LAYER_MB', 0) * 1024 * 1024)
+        self._blobs = {}       # digest -> ('layer', 种子, 大小) / ('bytes', 内容)
+        self._manifests = {}   # (name, tag, 架构/'list') -> (manifest字节, digest, mediaType)
+        self._lock = threading.Lock()
+
+    def _layer(self, seed, size):
+        sha256 = hashlib.sha256()
+        for chunk in layer_chunks(seed, size):
+            sha256.update(chunk)
+        digest = 'sha256:' + sha256.hexdigest()
+        with self._lock:
+            self._blobs[digest] = ('layer', seed, size)
+        return {'mediaType': LAYER_TYPE, 'digest': digest, 'size': size}
+
+    def _bytes_blob(self, data, media_type):
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._blobs[digest] = ('bytes', data)
+        return {'mediaType': media_type, 'digest': digest, 'size': len(data)}
+
+    def manifest(self, name, reference, manifest_list=False):
+        """返回 (manifest字节, digest, mediaType)；manifest_list=True 时按标签返回多架构manifest列表"""
+        if reference.startswith('sha256:'):
+            with self._lock:
+                for found in self._manifests.values():
+                    if found[1] == reference:
+                        return found
+            return None
+        if not manifest_list:
+            return self._image_manifest(name, reference, 'amd64')
+        key = (name, reference, 'list')
+        with self._lock:
+            if key in self._manifests:
+                return self._manifests[key]
+        platforms = [('arm64', 'v8'), ('amd64', None)]   # amd64不在第一个，客户端需要按平台选择
+        manifests = []
+        for arch, variant in platforms:
+            body, digest, media_type = self._image_manifest(name, reference, arch)
+            platform = {'architecture': arch, 'os': 'linux'}
+            if variant:
+                platform['variant'] = variant
+            manifests.append({'mediaType': media_type, 'digest': digest, 'size': len(body), 'platform': platform})
+        body = json.dumps({'schemaVersion': 2, 'mediaType': DOCKER_MANIFEST_LIST, 'manifests': manifests},
+                          indent=3).encode()
+        result = (body, 'sha256:' + hashlib.sha256(body).hexdigest(), DOCKER_MANIFEST_LIST)
+        with self._lock:
+            self._manifests[key] = result
+        return result
+
+    def _image_manifest(self, name, reference, arch):
+        key = (name, reference, arch)
+        with self._lock:
+            if key in self._manifests:
+                return self._manifests[key]
+        # amd64 的layer种子与单架构镜像相同（两种模式下同一镜像的amd64内容一致）
+        ref = f"{name}:{reference}" if arch == 'amd64' else f"{name}:{reference}#{arch}"
+        total = image_size(ref)
+        layers = []
+        if self.base_size:
+            layers.append(self._layer('fake-base-layer', self.base_size))
+        for i in range(self.layer_count):
+            size = total // self.layer_count + (total % self.layer_count if i == 0 else 0)
+            layers.append(self._layer(f"{ref}#layer{i}", size))
+        config = json.dumps({
+            "architecture": arch, "os": "linux",
+            "config": {"Labels": {"fake": "true"}},
+            "rootfs": {"type": "layers", "diff_ids": [layer['digest'] for layer in layers]},
+        }, sort_keys=True).encode()
+        body = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': DOCKER_MANIFEST,
+            'config': self._bytes_blob(config, DOCKER_CONFIG),
+            'layers': layers,
+        }, indent=3).encode()
+        result = (body, 'sha256:' + hashlib.sha256(body).hexdigest(), DOCKER_MANIFEST)
+        with self._lock:
+            self._manifests[key] = result
+        return result
+
+    def blob(self, digest):
+        with self._lock:
+            return self._blobs.get(digest)
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # 长连接，客户端可以复用连接
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    # ---------- 响应 ----------
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _json(self, status, data, headers=None):
+        self._send(status, json.dumps(data).encode(), dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+    def _unauthorized(self, scope):
+        host = self.headers.get('Host')
+        challenge = f'Bearer realm="http://{host}/token",service="fake-registry",scope="{scope}"'
+        self._json(401, {'errors': [{'code': 'UNAUTHORIZED'}]}, {'WWW-Authenticate': challenge})
+
+    def _authorized(self):
+        if not self.server.auth:
+            return True
+        auth = self.headers.get('Authorization', '')
+        return auth.startswith('Bearer ') and self.server.token_valid(auth[7:])
+
+    # ---------- 路由 ----------
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        parts = urlsplit(self.path)
+        path = parts.path
+        if path == '/stats':
+            return self._json(200, self.server.stats())
+        if path == '/token':
+            return self._token(parse_qs(parts.query))
+        storage = STORAGE_RE.match(path)
+        if storage:
+            return self._blob(storage.group('digest'))
+        if not path.startswith('/v2/'):
+            return self._send(404)
+
+        match = MANIFEST_RE.match(path) or BLOB_RE.match(path)
+        scope = f"repository:{match.group('name')}:pull" if match else 'registry:catalog:*'
+        if not self._authorized():
+            return self._unauthorized(scope)
+        if path == '/v2/':
+            return self._json(200, {})
+        if match and 'reference' in match.groupdict():
+            return self._manifest(match.group('name'), match.group('reference'))
+        if match:
+            if self.server.redirect:
+                self.server.count('blob_redirects')
+                return self._send(302, headers={'Location': f"/storage/{match.group('digest')}"})
+            return self._blob(match.group('digest'))
+        return self._send(404)
+
+    def _token(self, query):
+        self.server.count('token_requests')
+        auth = self.headers.get('Authorization', '')
+        if self.server.auth and not auth.startswith('Basic '):
+            return self._json(401, {'errors': [{'code': 'UNAUTHORIZED'}]})
+        user = base64.b64decode(auth[6:]).decode().split(':', 1)[0] if auth.startswith('Basic ') else ''
+        token = self.server.issue_token()
+        self._json(200, {'token': token, 'expires_in': self.server.token_ttl, 'user': user,
+                         'scope': query.get('scope', [''])[0]})
+
+    def _manifest(self, name, reference):
+        self.server.count('manifest_requests')
+        found = self.server.catalog.manifest(name, reference, self.server.manifest_list)
+        if found is None:
+            return self._json(404, {'errors': [{'code': 'MANIFEST_UNKNOWN'}]})
+        body, digest, media_type = found
+        self._send(200, body, {'Content-Type': media_type, 'Docker-Content-Digest': digest})
+
+    def _blob(self, digest):
+        self.server.count('blob_requests')
+        blob = self.server.catalog.blob(digest)
+        if blob is None:
+            return self._json(404, {'errors': [{'code': 'BLOB_UNKNOWN'}]})
+        if blob[0] == 'bytes':
+            return self._send(200, blob[1], {'Content-Type': 'application/octet-stream'})
+        _, seed, size = blob
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Docker-Content-Digest', digest)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        start = time.time()
+        sent = 0
+        for chunk in layer_chunks(seed, size):
+            if self.server.corrupt and sent == 0:
+                chunk = bytes([chunk[0] ^ 0xFF]) + chunk[1:]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.server.count('blob_bytes', len(chunk))
+            if self.server.mbps > 0:
+                ahead = sent / (self.server.mbps * 1024 * 1024) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class FakeRegistry(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, RegistryHandler)
+        self.catalog = ImageCatalog()
+        self.auth = os.environ.get('FAKE_REGISTRY_AUTH', '1') != '0'
+        self.redirect = os.environ.get('FAKE_REGISTRY_REDIRECT', '0') == '1'
+        self.manifest_list = os.environ.get('FAKE_REGISTRY_MANIFEST_LIST', '0') == '1'
+        self.corrupt = os.environ.get('FAKE_REGISTRY_CORRUPT', '0') == '1'
+        self.token_ttl = int(env_float('FAKE_TOKEN_TTL', 300))
+        self.latency = env_float('FAKE_LATENCY_MS', 50) / 1000.0
+        self.mbps = env_float('FAKE_PULL_MBPS', 200)
+        self._tokens = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def issue_token(self):
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def revoke_tokens(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def token_valid(self, token):
+        with self._lock:
+            return self._tokens.get(token, 0) > time.time()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地镜像仓库替身")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+    server = FakeRegistry((args.host, args.port))
+    print(f"fake registry listening on {args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""基准测试用的合成镜像（fake nerdctl / fake ossutil 共用）
+
+生成的tar与 nerdctl save 的布局相同（OCI layout + docker manifest.json，配置 + 单个layer），
+内容由镜像引用决定（同一镜像每次生成的字节完全相同），数据不可压缩，大小可配置。
+
+环境变量：
+    FAKE_IMAGE_SIZE_MB   每个镜像的layer大小（MB，默认20）
+    FAKE_PULL_MBPS       模拟拉取吞吐（MB/s，默认200，0表示不限速）
+    FAKE_SAVE_MBPS       模拟保存吞吐（MB/s，默认0不限速）
+    FAKE_LATENCY_MS      每次仓库请求的模拟延迟（毫秒，默认50）
+    FAKE_PULL_FAIL_RATE  拉取失败概率（0~1，默认0，用于验证重试）
+    FAKE_NERDCTL_STATE   fake nerdctl 的状态目录（已拉取/已加载的镜像）
+"""
+import hashlib
+import io
+import json
+import os
+import random
+import tarfile
+import time
+
+CHUNK = 1024 * 1024
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return float(default)
+
+
+def image_size(ref):
+    """镜像layer大小（字节）：FAKE_IMAGE_SIZE_MB，可用 FAKE_IMAGE_SIZES='name=MB,name2=MB' 单独指定"""
+    size_mb = env_float('FAKE_IMAGE_SIZE_MB', 20)
+    name = ref.rsplit('/', 1)[-1].split(':', 1)[0].split('@', 1)[0]
+    for item in os.environ.get('FAKE_IMAGE_SIZES', '').split(','):
+        key, _, value = item.partition('=')
+        if key.strip() == name and value:
+            size_mb = float(value)
+    return int(size_mb * 1024 * 1024)
+
+
+def simulate_transfer(size, mbps):
+    """按吞吐模拟传输耗时"""
+    latency = env_float('FAKE_LATENCY_MS', 50) / 1000.0
+    time.sleep(latency + (size / (mbps * 1024 * 1024) if mbps > 0 else 0))
+
+
+def layer_chunks(ref, size):
+    """确定性、不可压缩的layer数据"""
+    rng = random.Random(hashlib.sha256(ref.encode()).digest())
+    remaining = size
+    while remaining > 0:
+        n = min(CHUNK, remaining)
+        yield rng.getrandbits(n * 8).to_bytes(n, 'little')
+        remaining -= n
+
+
+class _ChunkReader(io.RawIOBase):
+    """把分块生成器包装成tarfile可读取的文件对象"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def layer_digest(ref, size):
+    h = hashlib.sha256()
+    for chunk in layer_chunks(ref, size):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_image_tar(ref, out_path, save_mbps=0.0):
+    """写出与 nerdctl save 相同布局的镜像tar（OCI layout + docker manifest.json），返回镜像ID"""
+    size = image_size(ref)
+    layer_hex = layer_digest(ref, size)
+    config = json.dumps({
+        "architecture": "amd64", "os": "linux",
+        "config": {"Labels": {"fake": "true"}},
+        "rootfs": {"type": "layers", "diff_ids": [f"sha256:{layer_hex}"]},
+    }, sort_keys=True).encode()
+    config_hex = hashlib.sha256(config).hexdigest()
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {"mediaType": "application/vnd.docker.container.image.v1+json",
+                   "digest": f"sha256:{config_hex}", "size": len(config)},
+        "layers": [{"mediaType": "application/vnd.docker.image.rootfs.diff.tar",
+                    "digest": f"sha256:{layer_hex}", "size": size}],
+    }).encode()
+    manifest_hex = hashlib.sha256(manifest).hexdigest()
+    index = json.dumps({
+        "schemaVersion": 2,
+        "manifests": [{"mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                       "digest": f"sha256:{manifest_hex}", "size": len(manifest),
+                       "annotations": {"io.containerd.image.name": ref}}],
+    }).encode()
+    docker_manifest = json.dumps([{
+        "Config": f"blobs/sha256/{config_hex}",
+        "RepoTags": [ref.split('@', 1)[0]],
+        "Layers": [f"blobs/sha256/{layer_hex}"],
+    }]).encode()
+
+    start = time.time()
+    with tarfile.open(out_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        _add_bytes(tar, "oci-layout", b'{"imageLayoutVersion":"1.0.0"}')
+        _add_bytes(tar, "index.json", index)
+        _add_bytes(tar, "manifest.json", docker_manifest)
+        _add_bytes(tar, f"blobs/sha256/{manifest_hex}", manifest)
+        _add_bytes(tar, f"blobs/sha256/{config_hex}", config)
+        info = tarfile.TarInfo(f"blobs/sha256/{layer_hex}")
+        info.size = size
+        info.mtime = 0
+        tar.addfile(info, io.BufferedReader(_ChunkReader(layer_chunks(ref, size)), CHUNK))
+    if save_mbps > 0:
+        remaining = size / (save_mbps * 1024 * 1024) - (time.time() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+    return f"sha256:{config_hex}"
@@ -0,0 +1,355 @@
+"""并发SSE进度流 + 分段下载压测
+
+对一个本地实例同时打开大量SSE进度流，并发起并行的Range下载，统计：
+    - 连接数（发起/建立/失败/被服务端提前断开）
+    - 事件送达延迟（服务端事件时间戳 ts → 客户端收到，log事件为输出产生时刻）
+    - 下载吞吐和每个Range请求的首字节时间
+    - 服务进程的CPU占用、内存、线程数（本地进程，按 /proc 采样）
+用于根据数据确定部署方式（app.run 线程 / gunicorn worker 数量等）。
+
+用法（在 auto_packing_no_delete 目录下）：
+    # 自动在沙箱中启动实例（fake nerdctl），300个 /build 流 + 32个并发Range下载
+    myenv/bin/python3 bench/load_test.py --streams 300 --downloaders 32
+    # 压测已运行的实例（例如gunicorn），提供其主进程pid以采样CPU/内存
+    myenv/bin/python3 bench/load_test.py --url http://127.0.0.1:8000 --server-pid 1234 --mode watch
+模式：
+    build：每个流都是一次 /build 请求（每个流触发一次构建）
+    watch：先发起 --builds 个构建，其余流通过 /builds/<id>/events 订阅这些构建
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_build import bench_env, free_port, prepare_sandbox, start_server  # noqa: E402
+
+READ_CHUNK = 256 * 1024
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return round(values[index], 2)
+
+
+class Stats(object):
+    """各线程共享的统计数据"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams_started = 0
+        self.streams_connected = 0
+        self.streams_failed = 0
+        self.streams_completed = 0
+        self.streams_dropped = 0
+        self.connect_ms = []
+        self.event_latency_ms = []      # 状态事件
+        self.log_latency_ms = []        # 输出行事件
+        self.events = 0
+        self.download_requests = 0
+        self.download_failed = 0
+        self.download_bytes = 0
+        self.ttfb_ms = []
+        self.task_ids = set()
+        self.package_url = None
+
+    def add(self, **kwargs):
+        with self.lock:
+            for key, value in kwargs.items():
+                attr = getattr(self, key)
+                if isinstance(attr, list):
+                    attr.append(value)
+                else:
+                    setattr(self, key, attr + value)
+
+
+# -------------------------- SSE 流 --------------------------
+def open_stream(base, path, stats):
+    """打开一个SSE流并读到结束，记录事件延迟"""
+    stats.add(streams_started=1)
+    parsed = urllib.parse.urlparse(base)
+    start = time.time()
+    try:
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=3600)
+        conn.request('GET', path, headers={'Accept': 'text/event-stream'})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            stats.add(streams_failed=1)
+            return
+    except (OSError, http.client.HTTPException):
+        stats.add(streams_failed=1)
+        return
+    stats.add(streams_connected=1, connect_ms=(time.time() - start) * 1000)
+
+    event_name = None
+    completed = False
+    try:
+        for raw in resp:
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+            now = time.time()
+            if line.startswith('event:'):
+                event_name = line[6:].strip()
+                if event_name == 'close':
+                    completed = True
+            elif line.startswith('data:'):
+                try:
+                    data = json.loads(line[5:])
+                except ValueError:
+                    data = None
+                if isinstance(data, dict):
+                    stats.add(events=1)
+                    if 'ts' in data:
+                        key = 'log_latency_ms' if event_name == 'log' else 'event_latency_ms'
+                        stats.add(**{key: (now - data['ts']) * 1000})
+                    if data.get('task_id'):
+                        with stats.lock:
+                            stats.task_ids.add(data['task_id'])
+                            if data.get('download_url') and not stats.package_url:
+                                stats.package_url = data['download_url']
+            elif not line:
+                event_name = None
+            if completed:
+                break
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        conn.close()
+    stats.add(streams_completed=1 if completed else 0, streams_dropped=0 if completed else 1)
+
+
+# -------------------------- Range 下载 --------------------------
+def package_size(base, url):
+    req = urllib.request.Request(base + url, headers={'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(req) as resp:
+        return int(resp.headers['Content-Range'].rsplit('/', 1)[1])
+
+
+def run_downloader(base, url, size, range_bytes, deadline, stats):
+    parsed = urllib.parse.urlparse(base)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=600)
+    while time.time() < deadline:
+        start = random.randrange(0, max(size - range_bytes, 1))
+        end = min(start + range_bytes, size) - 1
+        begin = time.time()
+        try:
+            conn.request('GET', url, headers={'Range': f"bytes={start}-{end}"})
+            resp = conn.getresponse()
+            first = resp.read(1)
+            stats.add(ttfb_ms=(time.time() - begin) * 1000)
+            received = len(first)
+            while True:
+                chunk = resp.read(READ_CHUNK)
+                if not chunk:
+                    break
+                received += len(chunk)
+            if resp.status != 206:
+                stats.add(download_failed=1)
+            stats.add(download_requests=1, download_bytes=received)
+        except (OSError, http.client.HTTPException):
+            stats.add(download_failed=1)
+            conn.close()
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=600)
+    conn.close()
+
+
+# -------------------------- 服务端资源采样 --------------------------
+class ServerSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super(ServerSampler, self).__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent = []
+        self.rss_kb = []
+        self.threads = []
+        self._stop_event = threading.Event()
+
+    def _read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12])
+        rss = threads = 0
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+        return ticks, rss, threads
+
+    def run(self):
+        clk = os.sysconf('SC_CLK_TCK')
+        try:
+            last_ticks, _, _ = self._read()
+        except (IOError, OSError):
+            return
+        last_time = time.time()
+        while not self._stop_event.wait(self.interval):
+            try:
+                ticks, rss, threads = self._read()
+            except (IOError, OSError):
+                return
+            now = time.time()
+            self.cpu_percent.append((ticks - last_ticks) / clk / (now - last_time) * 100)
+            self.rss_kb.append(rss)
+            self.threads.append(threads)
+            last_ticks, last_time = ticks, now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summary(self):
+        if not self.cpu_percent:
+            return None
+        return {
+            "cpu_percent_avg": round(sum(self.cpu_percent) / len(self.cpu_percent), 1),
+            "cpu_percent_max": round(max(self.cpu_percent), 1),
+            "rss_kb_max": max(self.rss_kb),
+            "threads_max": max(self.threads),
+        }
+
+
+# -------------------------- 主流程 --------------------------
+def start_build(base, stats):
+    """在后台线程中发起一次构建（/build SSE流），task_id从状态事件中收集"""
+    thread = threading.Thread(target=open_stream, args=(base, "/build?current=load-a&target=load-b", stats),
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="并发SSE进度流和Range下载压测")
+    parser.add_argument('--url', help="已运行实例的地址（不指定则在沙箱中启动一个实例）")
+    parser.add_argument('--server-pid', type=int, help="已运行实例的进程pid（用于采样CPU/内存）")
+    parser.add_argument('--mode', choices=('build', 'watch'), default='build', help="SSE流模式（默认build）")
+    parser.add_argument('--streams', type=int, default=200, help="SSE流数量（默认200）")
+    parser.add_argument('--builds', type=int, default=2, help="watch模式下发起的构建数（默认2）")
+    parser.add_argument('--ramp-seconds', type=float, default=5, help="在多少秒内建立全部连接（默认5）")
+    parser.add_argument('--downloaders', type=int, default=16, help="并发Range下载数（默认16）")
+    parser.add_argument('--range-mb', type=float, default=8, help="每个Range请求的大小MB（默认8）")
+    parser.add_argument('--download-seconds', type=float, default=20, help="下载压测持续时间（默认20秒）")
+    parser.add_argument('--images', type=int, default=5, help="沙箱实例的镜像数量（默认5）")
+    parser.add_argument('--image-size-mb', type=float, default=20, help="沙箱实例的镜像大小MB（默认20）")
+    parser.add_argument('--output', default='load_result.json', help="结果文件（默认load_result.json）")
+    args = parser.parse_args(argv)
+
+    server = workdir = None
+    base = args.url.rstrip('/') if args.url else None
+    server_pid = args.server_pid
+    if not base:
+        workdir = tempfile.mkdtemp(prefix='auto_packing_load_')
+        prepare_sandbox(workdir, args.images)
+        sandbox_args = argparse.Namespace(image_size_mb=args.image_size_mb, pull_mbps=500, save_mbps=0,
+                                          latency_ms=20, images=args.images)
+        port = free_port()
+        server = start_server(workdir, bench_env(sandbox_args, workdir), port)
+        base = f"http://127.0.0.1:{port}"
+        server_pid = server.pid
+
+    stats = Stats()
+    sampler = ServerSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    try:
+        # 1. SSE流
+        threads = []
+        delay = args.ramp_seconds / max(args.streams, 1)
+        if args.mode == 'watch':
+            for _ in range(args.builds):
+                threads.append(start_build(base, stats))
+            # 等待每个构建推送第一条状态（带task_id）
+            deadline = time.time() + 60
+            while len(stats.task_ids) < args.builds and time.time() < deadline:
+                if all(not t.is_alive() for t in threads):
+                    break
+                time.sleep(0.1)
+            task_ids = sorted(stats.task_ids)
+            if not task_ids:
+                raise RuntimeError("没有获取到构建任务ID")
+            for i in range(args.streams - args.builds):
+                path = f"/builds/{task_ids[i % len(task_ids)]}/events"
+                t = threading.Thread(target=open_stream, args=(base, path, stats), daemon=True)
+                t.start()
+                threads.append(t)
+                time.sleep(delay)
+        else:
+            for _ in range(args.streams):
+                threads.append(start_build(base, stats))
+                time.sleep(delay)
+        stream_start = time.time()
+        for t in threads:
+            t.join()
+        stream_seconds = time.time() - stream_start
+
+        # 2. Range下载（使用本次构建产出的升级包）
+        download = None
+        if stats.package_url and args.downloaders:
+            size = package_size(base, stats.package_url)
+            deadline = time.time() + args.download_seconds
+            range_bytes = int(args.range_mb * 1024 * 1024)
+            workers = [threading.Thread(target=run_downloader,
+                                        args=(base, stats.package_url, size, range_bytes, deadline, stats),
+                                        daemon=True) for _ in range(args.downloaders)]
+            begin = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.time() - begin
+            download = {
+                "package_mb": round(size / 1024 / 1024, 2),
+                "requests": stats.download_requests,
+                "failed": stats.download_failed,
+                "throughput_mb_per_s": round(stats.download_bytes / 1024 / 1024 / elapsed, 2),
+                "ttfb_ms_p50": percentile(stats.ttfb_ms, 50),
+                "ttfb_ms_p99": percentile(stats.ttfb_ms, 99),
+            }
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != 'output'},
+        "streams": {
+            "started": stats.streams_started,
+            "connected": stats.streams_connected,
+            "failed": stats.streams_failed,
+            "completed": stats.streams_completed,
+            "dropped": stats.streams_dropped,
+            "builds": len(stats.task_ids),
+            "events": stats.events,
+            "duration_s": round(stream_seconds, 2),
+            "connect_ms_p50": percentile(stats.connect_ms, 50),
+            "connect_ms_p99": percentile(stats.connect_ms, 99),
+            "status_latency_ms_p50": percentile(stats.event_latency_ms, 50),
+            "status_latency_ms_p99": percentile(stats.event_latency_ms, 99),
+            "log_latency_ms_p50": percentile(stats.log_latency_ms, 50),
+            "log_latency_ms_p99": percentile(stats.log_latency_ms, 99),
+        },
+        "downloads": download,
+        "server": sampler.summary() if sampler else None,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
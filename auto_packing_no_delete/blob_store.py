@@ -0,0 +1,316 @@
+"""内容寻址的blob存储：镜像的layer/配置/manifest按sha256只保存一份，所有缓存镜像和升级包共用
+
+公共基础镜像等layer在 deepflow-server、deepflow-app 及各个补丁版本之间完全相同，
+存入blob存储后新增一个补丁版本只需要下载/保存它新增的layer。
+
+升级包仍由 image_tar/ 中的完整镜像tar打包（zip_package.py）。镜像tar由存储生成（registry_client.write_image_tar）
+时layer数据按4KB对齐，XFS/btrfs 上用reflink与存储中的blob共享数据块，升级包再以reflink共享镜像tar，
+同一layer在磁盘上只占一份；nerdctl save 的tar导入后同样由存储重新生成（pull_save.sh）。
+不支持reflink的文件系统（ext4等）上镜像tar与存储各占一份：image_tar/ 是可回收的缓存，
+磁盘不足时 disk_admission.py 删除可由存储重新生成的镜像tar。
+
+目录结构（blobs/）：
+    sha256/<hex>                    blob内容（只读）
+    refs/images/<tar文件名>.json      缓存镜像引用的blob {ref, manifest, media_type, blobs}
+    refs/packages/<task_id>.json     升级包引用的blob {package, blobs}
+    tmp/                            写入中的临时文件（校验通过后原子移入 sha256/）
+    store.lock                      写引用/GC时的文件锁（构建进程、pull_save.sh 等多进程共用）
+
+引用计数 = 引用该blob的引用文件数（从引用文件计算，进程崩溃不会留下错误的计数）。
+GC在总大小超过磁盘预算时删除无引用的blob（最久未使用的先删），有引用的blob不会被删除。
+
+命令行：
+    python3 blob_store.py stats                           # 总大小、blob数、各引用
+    python3 blob_store.py gc [--budget-gb 100]            # 回收无引用的blob
+    python3 blob_store.py ingest image.tar --name deepflow-server_v6.6.5550.tar --ref <完整镜像地址>
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+
+BLOB_STORE_BUDGET_BYTES = int(float(os.environ.get('BLOB_STORE_BUDGET_GB', 200)) * 1024 ** 3)  # 磁盘预算
+GC_GRACE_SECONDS = 3600    # 最近一小时内写入/使用过的无引用blob不回收（可能属于正在拉取、尚未记录引用的镜像）
+TMP_MAX_AGE = 86400        # 超过一天的临时文件视为中断的写入，GC时清理
+CHUNK = 1024 * 1024
+
+IMAGE_REFS = 'images'
+PACKAGE_REFS = 'packages'
+
+
+class BlobStoreError(Exception):
+    """blob不存在、校验失败或镜像tar格式不支持"""
+
+
+class BlobStore(object):
+
+    def __init__(self, root, budget_bytes=BLOB_STORE_BUDGET_BYTES):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.blob_dir = os.path.join(root, 'sha256')
+        self.refs_dir = os.path.join(root, 'refs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for directory in (self.blob_dir, self.tmp_dir,
+                          os.path.join(self.refs_dir, IMAGE_REFS), os.path.join(self.refs_dir, PACKAGE_REFS)):
+            os.makedirs(directory, exist_ok=True)
+
+    # ---------- blob ----------
+    def blob_path(self, digest):
+        algorithm, _, hex_digest = digest.partition(':')
+        if algorithm != 'sha256' or len(hex_digest) != 64:
+            raise BlobStoreError(f"不支持的digest：{digest}")
+        return os.path.join(self.blob_dir, hex_digest)
+
+    def has(self, digest, size=None):
+        """blob是否已存在（给出size时同时核对大小）；存在时刷新使用时间（GC按使用时间回收）"""
+        path = self.blob_path(digest)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if size is not None and st.st_size != size:
+            return False
+        self.touch(digest)
+        return True
+
+    def touch(self, digest):
+        try:
+            os.utime(self.blob_path(digest), None)
+        except OSError:
+            pass
+
+    def temp_path(self, digest):
+        """写入blob用的临时文件路径（同一blob被多个进程同时写入时互不影响）"""
+        return os.path.join(self.tmp_dir, f"{digest.split(':', 1)[1]}.{os.getpid()}.{threading.get_ident()}")
+
+    def commit(self, temp_path, digest):
+        """已校验的临时文件移入存储（多个写入者同时完成时后到者覆盖，内容相同）"""
+        os.chmod(temp_path, 0o444)
+        os.replace(temp_path, self.blob_path(digest))
+
+    def add_stream(self, fileobj, expected_digest=None):
+        """从文件对象读取并存入blob，返回 (digest, 大小)；给出 expected_digest 时校验内容"""
+        temp_path = self.temp_path(expected_digest or 'sha256:' + os.urandom(8).hex())
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    chunk = fileobj.read(CHUNK)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+            digest = 'sha256:' + sha256.hexdigest()
+            if expected_digest and digest != expected_digest:
+                raise BlobStoreError(f"blob校验失败：期望{expected_digest}，实际{digest}")
+            self.commit(temp_path, digest)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest, size
+
+    def add_bytes(self, data):
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        if not self.has(digest, len(data)):
+            temp_path = self.temp_path(digest)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            self.commit(temp_path, digest)
+        return digest
+
+    def read_bytes(self, digest):
+        try:
+            with open(self.blob_path(digest), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            raise BlobStoreError(f"blob不存在：{digest}")
+
+    # ---------- 引用 ----------
+    @contextlib.contextmanager
+    def locked(self):
+        with open(os.path.join(self.root, 'store.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _ref_path(self, kind, name):
+        return os.path.join(self.refs_dir, kind, name.replace('/', '%2F') + '.json')
+
+    def put_ref(self, kind, name, blobs, **info):
+        """记录（覆盖）一个引用：kind=images/packages，blobs为引用的digest列表"""
+        data = dict(info, blobs=sorted(set(blobs)), updated=time.time())
+        path = self._ref_path(kind, name)
+        temp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with self.locked():
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+
+    def get_ref(self, kind, name):
+        try:
+            with open(self._ref_path(kind, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def remove_ref(self, kind, name):
+        with self.locked():
+            try:
+                os.remove(self._ref_path(kind, name))
+            except OSError:
+                pass
+
+    def refs(self, kind=None):
+        """逐个返回 (kind, name, 引用内容)"""
+        for ref_kind in ([kind] if kind else (IMAGE_REFS, PACKAGE_REFS)):
+            directory = os.path.join(self.refs_dir, ref_kind)
+            for file_name in sorted(os.listdir(directory)):
+                if not file_name.endswith('.json'):
+                    continue
+                name = file_name[:-len('.json')].replace('%2F', '/')
+                data = self.get_ref(ref_kind, name)
+                if data is not None:
+                    yield ref_kind, name, data
+
+    def refcounts(self):
+        """digest -> 引用数"""
+        counts = {}
+        for _, _, data in self.refs():
+            for digest in data.get('blobs', []):
+                counts[digest] = counts.get(digest, 0) + 1
+        return counts
+
+    def image_complete(self, name):
+        """镜像引用存在且引用的blob都在（可以不访问仓库直接生成镜像tar）"""
+        data = self.get_ref(IMAGE_REFS, name)
+        return data is not None and all(os.path.exists(self.blob_path(d)) for d in data.get('blobs', []))
+
+    # ---------- 统计与回收 ----------
+    def usage(self):
+        """返回 (总字节数, blob数)"""
+        total = count = 0
+        for entry in os.scandir(self.blob_dir):
+            total += entry.stat().st_size
+            count += 1
+        return total, count
+
+    def gc(self, budget_bytes=None):
+        """回收：清理失效的升级包引用和中断的临时文件，总大小超过预算时删除无引用的blob（最久未使用的先删）
+
+        budget_bytes=0 时删除全部无引用的blob（宽限期内的除外）。
+        """
+        budget = self.budget_bytes if budget_bytes is None else budget_bytes
+        now = time.time()
+        removed = freed = stale_refs = 0
+        with self.locked():
+            # 升级包已删除 → 引用失效
+            for _, name, data in list(self.refs(PACKAGE_REFS)):
+                if data.get('package') and not os.path.exists(data['package']):
+                    os.remove(self._ref_path(PACKAGE_REFS, name))
+                    stale_refs += 1
+            for entry in os.scandir(self.tmp_dir):
+                if now - entry.stat().st_mtime > TMP_MAX_AGE:
+                    os.remove(entry.path)
+
+            counts = self.refcounts()
+            total = 0
+            candidates = []
+            for entry in os.scandir(self.blob_dir):
+                st = entry.stat()
+                total += st.st_size
+                if 'sha256:' + entry.name not in counts and now - st.st_mtime > GC_GRACE_SECONDS:
+                    candidates.append((st.st_mtime, st.st_size, entry.path))
+            candidates.sort()
+            for _, size, path in candidates:
+                if total <= budget:
+                    break
+                os.remove(path)
+                total -= size
+                removed += 1
+                freed += size
+        return {
+            'removed_blobs': removed,
+            'freed_bytes': freed,
+            'stale_refs': stale_refs,
+            'total_bytes': total,
+            'referenced_blobs': len(counts),
+        }
+
+    # ---------- 导入 nerdctl save 的镜像tar ----------
+    def ingest_image_tar(self, tar_path, name, ref=None):
+        """把 nerdctl save 输出的镜像tar（OCI layout）中的blob复制到存储并记录镜像引用，返回新增的字节数
+        （镜像tar本身不变，需要与存储共享数据块时由存储重新生成，见 registry_client.write_image_tar）"""
+        digests = []
+        index = None
+        added = 0
+        with tarfile.open(tar_path, 'r:') as tar:
+            for member in tar:
+                if member.isfile() and member.name.startswith('blobs/sha256/'):
+                    digest = 'sha256:' + member.name.rsplit('/', 1)[1]
+                    if not self.has(digest, member.size):
+                        self.add_stream(tar.extractfile(member), expected_digest=digest)
+                        added += member.size
+                    digests.append(digest)
+                elif member.name == 'index.json':
+                    index = json.loads(tar.extractfile(member).read().decode('utf-8'))
+        if not index or not index.get('manifests'):
+            raise BlobStoreError(f"不是OCI layout格式的镜像tar（缺少index.json）：{tar_path}")
+        descriptor = index['manifests'][0]
+        self.put_ref(IMAGE_REFS, name, digests, ref=ref, manifest=descriptor['digest'],
+                     media_type=descriptor.get('mediaType'))
+        return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="内容寻址的blob存储（统计/回收/导入镜像tar）")
+    parser.add_argument('--root', default=os.path.join(
+        os.environ.get('AUTO_PACKING_BASE_DIR', '/home/auto_packing_no_delete'), 'blobs'), help="存储目录")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('stats', help="总大小、blob数和各引用")
+    gc = sub.add_parser('gc', help="回收无引用的blob")
+    gc.add_argument('--budget-gb', type=float, help="磁盘预算（GB，默认 BLOB_STORE_BUDGET_GB）")
+    ingest = sub.add_parser('ingest', help="导入 nerdctl save 输出的镜像tar")
+    ingest.add_argument('tar', help="镜像tar")
+    ingest.add_argument('--name', required=True, help="引用名（镜像tar文件名）")
+    ingest.add_argument('--ref', help="完整镜像地址")
+    args = parser.parse_args(argv)
+
+    store = BlobStore(args.root)
+    if args.command == 'stats':
+        total, count = store.usage()
+        print(f"blob存储：{args.root}，{count}个blob，共{total / 1024 / 1024:.1f}MB")
+        counts = store.refcounts()
+        print(f"被引用的blob：{len(counts)}，无引用：{count - len(counts)}")
+        for kind, name, data in store.refs():
+            print(f"  {kind}/{name}：{len(data.get('blobs', []))}个blob")
+    elif args.command == 'gc':
+        budget = int(args.budget_gb * 1024 ** 3) if args.budget_gb is not None else None
+        result = store.gc(budget)
+        print(f"回收{result['removed_blobs']}个blob，释放{result['freed_bytes'] / 1024 / 1024:.1f}MB，"
+              f"清理失效引用{result['stale_refs']}个，当前{result['total_bytes'] / 1024 / 1024:.1f}MB")
+    elif args.command == 'ingest':
+        try:
+            added = store.ingest_image_tar(args.tar, args.name, args.ref)
+        except (BlobStoreError, tarfile.TarError, OSError, ValueError) as e:
+            print(f"错误：导入失败：{e}", file=sys.stderr)
+            return 1
+        print(f"已导入：{args.name}（新增{added / 1024 / 1024:.1f}MB）")
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
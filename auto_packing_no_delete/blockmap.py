@@ -0,0 +1,166 @@
+"""升级包的块校验文件（zsync式增量下载）：持有旧升级包的现场只下载与旧升级包不同的块
+
+升级包按 BLOCK_SIZE（64KB）分块，每块记录一个弱校验和（可滚动）和一个强校验（md5）。
+弱校验由块内每个4KB子块的adler32按多项式组合，强校验为块内每个4KB子块md5拼接后的md5。
+升级包条目数据按4KB对齐（zip_package.ALIGNMENT），同一镜像在新旧升级包中的偏移都是4KB的整数倍，
+客户端在旧升级包上以4KB为步长滑动窗口（每步O(1)更新），不需要逐字节滚动；弱校验相同时再比较强校验。
+两种校验都由子块记录（adler32 + md5）组合而成，镜像tar的子块记录只计算一次（与sha256同一次读取，
+缓存在 image_tar/.meta/<tar文件名>.blocks，见 image_meta.py），构建时由各镜像的子块记录加上文件头等
+少量字节拼出整个升级包的块校验文件，不再读取整个升级包。
+文件格式：第一行为JSON头（version/size/block_size/sub_block/blocks/etag），
+之后每块20字节（弱校验4字节大端 + 强校验16字节）。upgrade_client.py 中有相同的计算（客户端只依赖标准库）。
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+
+from zip_package import ALIGNMENT
+
+VERSION = 2
+BLOCK_SIZE = 64 * 1024
+SUB_BLOCK = ALIGNMENT
+SPAN = BLOCK_SIZE // SUB_BLOCK
+WEAK_BASE = 65599
+RECORD = struct.Struct('>I16s')       # 块记录：弱校验 + 强校验
+SUB_RECORD = struct.Struct('>I16s')   # 子块记录：adler32 + md5
+CACHE_CHUNK = 4096 * SUB_RECORD.size  # 读取子块记录缓存的单次长度
+
+
+def sub_block_record(data):
+    return SUB_RECORD.pack(zlib.adler32(data), hashlib.md5(data).digest())
+
+
+def block_record(sub_records):
+    """由块内各子块的记录组合出块记录"""
+    weak = 0
+    strong = hashlib.md5()
+    for adler, md5 in SUB_RECORD.iter_unpack(sub_records):
+        weak = (weak * WEAK_BASE + adler) & 0xFFFFFFFF
+        strong.update(md5)
+    return RECORD.pack(weak, strong.digest())
+
+
+class SubBlockHasher(object):
+    """按顺序接收字节（update），为每个完整的4KB子块生成记录；take() 取出已生成的记录，
+    finish() 为最后不足4KB的部分生成记录"""
+
+    def __init__(self):
+        self._records = bytearray()
+        self._pending = b''
+        self.count = 0
+
+    def update(self, data):
+        if self._pending:
+            data = self._pending + data
+        view = memoryview(data)
+        full = len(data) - len(data) % SUB_BLOCK
+        for offset in range(0, full, SUB_BLOCK):
+            self._records += sub_block_record(view[offset:offset + SUB_BLOCK])
+        self.count += full // SUB_BLOCK
+        self._pending = bytes(view[full:])
+
+    def take(self):
+        records, self._records = bytes(self._records), bytearray()
+        return records
+
+    def finish(self):
+        if self._pending:
+            self._records += sub_block_record(self._pending)
+            self.count += 1
+            self._pending = b''
+        return self.take()
+
+
+class _BlockWriter(object):
+    """接收整个升级包按顺序的子块记录，每满一块写出块记录"""
+
+    def __init__(self, f):
+        self._file = f
+        self._pending = b''
+
+    def add(self, sub_records):
+        data = self._pending + sub_records if self._pending else sub_records
+        group = SPAN * SUB_RECORD.size
+        full = len(data) - len(data) % group
+        self._file.write(b''.join(block_record(data[offset:offset + group]) for offset in range(0, full, group)))
+        self._pending = data[full:]
+
+    def finish(self):
+        if self._pending:
+            self._file.write(block_record(self._pending))
+            self._pending = b''
+
+
+def _write(path, size, etag, fill):
+    """写出块校验文件（先写临时文件再改名）：fill(写入器) 按顺序提供整个升级包的子块记录，返回块数"""
+    blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    header = {"version": VERSION, "size": size, "block_size": BLOCK_SIZE, "sub_block": SUB_BLOCK,
+              "blocks": blocks, "etag": etag}
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        writer = _BlockWriter(f)
+        fill(writer)
+        writer.finish()
+    os.replace(tmp_path, path)
+    return blocks
+
+
+def write_blockmap(path, size, read_range, etag, on_chunk=None):
+    """按块读取升级包（read_range(start, end) 按顺序生成 [start, end] 的字节）写出块校验文件，返回块数；
+    on_chunk 按顺序接收读到的每段字节（构建时同一次读取中计算分卷sha256）"""
+    def fill(writer):
+        hasher = SubBlockHasher()
+        for chunk in read_range(0, size - 1):
+            if on_chunk is not None:
+                on_chunk(chunk)
+            hasher.update(chunk)
+            writer.add(hasher.take())
+        writer.add(hasher.finish())
+
+    return _write(path, size, etag, fill)
+
+
+def assemble_blockmap(path, size, read_range, etag, files):
+    """由各文件已缓存的子块记录拼出块校验文件，只读取文件之间的文件头、数据描述符、中央目录等少量字节，返回块数
+
+    files: [(数据在升级包中的偏移, 大小, 子块记录缓存文件)]，按偏移排序，偏移必须按4KB对齐；
+    缓存文件为该文件每个完整4KB子块的记录（最后不足4KB的部分从升级包读取）
+    """
+    def fill(writer):
+        hasher = SubBlockHasher()
+        position = 0
+        for offset, length, cache_path in files:
+            if offset % SUB_BLOCK:
+                raise ValueError(f"条目数据未按{SUB_BLOCK}字节对齐：偏移{offset}")
+            if offset > position:
+                for chunk in read_range(position, offset - 1):
+                    hasher.update(chunk)
+            writer.add(hasher.take())
+            remaining = length // SUB_BLOCK * SUB_RECORD.size
+            with open(cache_path, 'rb') as f:
+                while remaining > 0:
+                    data = f.read(min(CACHE_CHUNK, remaining))
+                    if not data:
+                        raise IOError(f"子块记录缓存比记录的短：{cache_path}")
+                    remaining -= len(data)
+                    writer.add(data)
+            position = offset + length // SUB_BLOCK * SUB_BLOCK
+        if size > position:
+            for chunk in read_range(position, size - 1):
+                hasher.update(chunk)
+        writer.add(hasher.finish())
+
+    return _write(path, size, etag, fill)
+
+
+def read_header(path):
+    """块校验文件的JSON头，文件不存在或格式错误时返回None"""
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
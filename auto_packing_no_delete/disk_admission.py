@@ -0,0 +1,319 @@
+"""构建的磁盘准入控制：开始构建前估算峰值磁盘占用，空间不足时先回收，仍不足则排队等待或拒绝
+
+构建中途磁盘写满（nerdctl save 或 zip 写到一半）会留下截断的tar和失败的任务，
+因此调度在构建开始前估算本次构建最多还要写入多少字节：
+    - 镜像tar：image_tar 中已缓存的不需要写入；blob存储中有完整镜像的按blob大小计（生成tar）；
+      其余按仓库 manifest 的 config+layer 大小计（registry拉取方式、blob存储需要的layer另计一份，
+      nerdctl拉取方式 containerd 内容存储与 image_tar 在同一磁盘时再计一份）；
+      都无法获取时按已知镜像的平均大小（或 ADMISSION_DEFAULT_IMAGE_MB）估算
+    - 升级包：所有镜像tar大小之和 × (1 + PACKAGE_OVERHEAD_RATIO)（tar中的layer已压缩，zip几乎不再变小）
+进行中的构建按其估算值预留空间（保守估计：直到构建结束才释放）。
+
+空间不足时依次回收（都可以恢复，不丢数据）：
+    1. blob存储中无引用的blob
+    2. image_tar 中不在当前镜像列表、且blob存储中有完整副本的镜像tar（需要时从blob存储重新生成）
+    3. 超过保留期（PACKAGE_RETENTION_HOURS）的升级包
+回收后仍不足：有其他构建在执行 → 排队等待它们结束；否则直接拒绝（提示需要和可用的空间）。
+
+环境变量：
+    DISK_RESERVE_GB             始终保留的可用空间（默认5）
+    PACKAGE_RETENTION_HOURS     升级包保留时长，超过后空间不足时可被清理（默认72）
+    ADMISSION_DEFAULT_IMAGE_MB  无法获取大小的镜像的估算值（默认500）
+    ADMISSION_REGISTRY_LOOKUP   是否查询仓库manifest获取镜像大小（默认1；账号取服务进程的 REGISTRY_USERNAME/REGISTRY_PASSWORD）
+
+命令行（oss_patch_processor.sh 后台预取前检查，预取不经过构建进程的准入）：
+    python3 disk_admission.py check -f patch_image_tag_list.txt -d image_tar
+    可用空间（扣除 DISK_RESERVE_GB）足够写入列表中缺少的镜像时退出码为0，不足时为3
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from blob_store import BlobStore, BlobStoreError, IMAGE_REFS
+from image_list import DEFAULT_REPO, ImageListError, load_image_list
+from image_meta import blocks_path, meta_path
+from registry_client import ConnectionPool, RegistryClient, RegistryError, TokenCache, parse_reference
+
+DISK_RESERVE_BYTES = int(float(os.environ.get('DISK_RESERVE_GB', 5)) * 1024 ** 3)
+PACKAGE_RETENTION_SECONDS = float(os.environ.get('PACKAGE_RETENTION_HOURS', 72)) * 3600
+DEFAULT_IMAGE_BYTES = int(float(os.environ.get('ADMISSION_DEFAULT_IMAGE_MB', 500)) * 1024 * 1024)
+REGISTRY_LOOKUP = os.environ.get('ADMISSION_REGISTRY_LOOKUP', '1') != '0'
+REGISTRY_TIMEOUT = 10             # 查询manifest的超时（秒），仓库不可达时不拖慢调度
+PACKAGE_OVERHEAD_RATIO = 0.01     # zip的目录和文件头
+TAR_OVERHEAD_BYTES = 64 * 1024    # 镜像tar中的 manifest/index 和tar头
+CONTAINERD_ROOT = os.environ.get('CONTAINERD_ROOT', '/var/lib/containerd')
+
+
+def format_size(size):
+    return f"{size / 1024 ** 3:.2f}GB" if size >= 1024 ** 3 else f"{size / 1024 ** 2:.1f}MB"
+
+
+class BuildEstimate(object):
+    """一次构建的磁盘占用估算"""
+
+    def __init__(self):
+        self.images = 0
+        self.image_bytes = 0      # 所有镜像tar的大小（升级包的内容）
+        self.write_bytes = 0      # 拉取阶段需要新写入的字节数
+        self.package_bytes = 0
+        self.sources = {}         # 大小来源 -> 镜像数（cached/blob_store/registry/default）
+        self.items = []           # 每个镜像的估算 {file, source, size, write_bytes}
+
+    @property
+    def peak_bytes(self):
+        return self.write_bytes + self.package_bytes
+
+    def add(self, source, size, write_bytes, name=None):
+        self.images += 1
+        self.items.append({"file": name, "source": source, "size": size, "write_bytes": write_bytes})
+        self.image_bytes += size
+        self.write_bytes += write_bytes
+        self.sources[source] = self.sources.get(source, 0) + 1
+
+    def describe(self):
+        sources = '，'.join(f"{name}{count}个" for name, count in sorted(self.sources.items()))
+        return (f"预计峰值占用{format_size(self.peak_bytes)}（镜像写入{format_size(self.write_bytes)}，"
+                f"升级包{format_size(self.package_bytes)}；大小来源：{sources}）")
+
+
+class SizeEstimator(object):
+    """按镜像估算tar大小和拉取时需要写入的字节数；仓库manifest的查询结果在进程内缓存"""
+
+    def __init__(self, image_tar_dir, store, repo, pull_backend='nerdctl', store_enabled=True,
+                 registry_lookup=REGISTRY_LOOKUP, token_cache_path=None):
+        self.image_tar_dir = image_tar_dir
+        self.store = store
+        self.repo = repo
+        self.pull_backend = pull_backend
+        self.store_enabled = store_enabled
+        self.registry_lookup = registry_lookup
+        self.token_cache_path = token_cache_path
+        self._manifests = {}    # 完整镜像地址 -> (tar大小, [(layer digest, 大小)])
+        self._lock = threading.Lock()
+
+    def _containerd_copy(self):
+        """nerdctl拉取方式下，containerd内容存储是否与 image_tar 在同一磁盘（是则拉取时多写一份）"""
+        if self.pull_backend != 'nerdctl':
+            return False
+        try:
+            return os.stat(CONTAINERD_ROOT).st_dev == os.stat(self.image_tar_dir).st_dev
+        except OSError:
+            return False
+
+    def _store_image_size(self, name):
+        if not self.store_enabled or not self.store.image_complete(name):
+            return None
+        data = self.store.get_ref(IMAGE_REFS, name) or {}
+        try:
+            return sum(os.path.getsize(self.store.blob_path(digest)) for digest in data.get('blobs', [])) \
+                + TAR_OVERHEAD_BYTES
+        except (OSError, BlobStoreError):
+            return None
+
+    def _registry_sizes(self, client, refs):
+        """查询仓库manifest，返回 {镜像地址: (tar大小, [(digest, 大小)])}；仓库不可达时停止查询"""
+        found = {}
+        for ref in refs:
+            with self._lock:
+                cached = self._manifests.get(ref)
+            if cached is not None:
+                found[ref] = cached
+                continue
+            try:
+                registry, repository, reference = parse_reference(ref)
+                body = client.get_manifest(registry, repository, reference)[0]
+            except (RegistryError, OSError, ValueError):
+                break   # 其余镜像按平均大小估算
+            manifest = json.loads(body.decode('utf-8'))
+            layers = [(layer['digest'], int(layer.get('size') or 0)) for layer in manifest.get('layers', [])]
+            size = int(manifest.get('config', {}).get('size') or 0) + sum(size for _, size in layers) \
+                + TAR_OVERHEAD_BYTES
+            found[ref] = (size, layers)
+            with self._lock:
+                self._manifests[ref] = found[ref]
+        return found
+
+    def estimate(self, image_entries, offline=False):
+        """offline=True 时不查询仓库（只用进程内已缓存的manifest），用于构建计划等需要立即返回的场景"""
+        estimate = BuildEstimate()
+        containerd_copy = self._containerd_copy()
+        unknown = []
+        for entry in image_entries:
+            path = os.path.join(self.image_tar_dir, entry.tar_name)
+            if os.path.exists(path):
+                estimate.add('cached', os.path.getsize(path), 0, entry.tar_name)
+                continue
+            size = self._store_image_size(entry.tar_name)
+            if size is not None:
+                estimate.add('blob_store', size, size, entry.tar_name)
+                continue
+            unknown.append(entry)
+
+        registry_sizes = {}
+        if unknown and offline:
+            with self._lock:
+                registry_sizes = {ref: self._manifests[ref] for ref in (entry.ref(self.repo) for entry in unknown)
+                                  if ref in self._manifests}
+        elif unknown and self.registry_lookup:
+            client = RegistryClient(pool=ConnectionPool(timeout=REGISTRY_TIMEOUT),
+                                    token_cache=TokenCache(self.token_cache_path) if self.token_cache_path else None)
+            try:
+                registry_sizes = self._registry_sizes(client, [entry.ref(self.repo) for entry in unknown])
+            finally:
+                client.pool.close()
+
+        default_size = estimate.image_bytes // estimate.images if estimate.images else DEFAULT_IMAGE_BYTES
+        for entry in unknown:
+            found = registry_sizes.get(entry.ref(self.repo))
+            if found is not None:
+                size, layers = found
+                source = 'registry'
+            else:
+                size, layers, source = default_size, None, 'default'
+            write_bytes = size
+            if self.store_enabled:
+                # 存入blob存储的layer（已有的不再写入）
+                if layers is None:
+                    write_bytes += size
+                else:
+                    write_bytes += sum(layer_size for digest, layer_size in layers
+                                       if not os.path.exists(self.store.blob_path(digest)))
+            if containerd_copy:
+                write_bytes += size
+            estimate.add(source, size, write_bytes, entry.tar_name)
+
+        estimate.package_bytes = int(estimate.image_bytes * (1 + PACKAGE_OVERHEAD_RATIO))
+        return estimate
+
+
+class DiskAdmission(object):
+    """磁盘空间预留：进行中的构建按估算的峰值占用预留空间，新构建只有在剩余空间足够时才开始"""
+
+    def __init__(self, path, reserve_bytes=DISK_RESERVE_BYTES):
+        self.path = path
+        self.reserve_bytes = reserve_bytes
+        self._reserved = {}   # task_id -> 预留字节数
+        self._lock = threading.Lock()
+
+    def reserved(self):
+        with self._lock:
+            return sum(self._reserved.values())
+
+    def running(self):
+        with self._lock:
+            return len(self._reserved)
+
+    def available(self):
+        """可用于新构建的字节数（可用空间 - 保留空间 - 进行中构建的预留）"""
+        return shutil.disk_usage(self.path).free - self.reserve_bytes - self.reserved()
+
+    def try_admit(self, task_id, needed):
+        with self._lock:
+            available = shutil.disk_usage(self.path).free - self.reserve_bytes - sum(self._reserved.values())
+            if needed > available:
+                return False
+            self._reserved[task_id] = needed
+            return True
+
+    def release(self, task_id):
+        with self._lock:
+            self._reserved.pop(task_id, None)
+
+
+# ---------- 回收 ----------
+def evict_image_tars(image_tar_dir, store, keep_names, needed):
+    """删除不在当前镜像列表、且blob存储中有完整副本的镜像tar（最久未修改的先删），返回 (删除数, 释放字节数)"""
+    candidates = []
+    for path in glob.glob(os.path.join(image_tar_dir, '*.tar')):
+        name = os.path.basename(path)
+        if name in keep_names or not store.image_complete(name):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        candidates.append((st.st_mtime, st.st_size, path))
+    removed = freed = 0
+    for _, size, path in sorted(candidates):
+        if freed >= needed:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        for cache_path in (meta_path(image_tar_dir, os.path.basename(path)),
+                           blocks_path(image_tar_dir, os.path.basename(path))):
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def evict_packages(packages, needed, retention_seconds=PACKAGE_RETENTION_SECONDS):
+    """删除超过保留期的升级包（最早生成的先删）；packages 为 [(task_id, 路径)]，
+    返回 ([被删除升级包的task_id], 释放字节数)"""
+    now = time.time()
+    candidates = []
+    for task_id, path in packages:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if now - st.st_mtime >= retention_seconds:
+            candidates.append((st.st_mtime, st.st_size, task_id, path))
+    evicted = []
+    freed = 0
+    for _, size, task_id, path in sorted(candidates):
+        if freed >= needed:
+            break
+        try:
+            os.remove(path)   # 进行中的下载持有文件句柄，不受影响
+        except OSError:
+            continue
+        evicted.append(task_id)
+        freed += size
+    return evicted, freed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="构建磁盘准入（估算拉取镜像需要写入的空间）")
+    sub = parser.add_subparsers(dest='command')
+    check = sub.add_parser('check', help="可用空间是否足够拉取列表中缺少的镜像（足够时退出码0，不足时3）")
+    check.add_argument('-f', '--file', required=True, help="镜像列表文件")
+    check.add_argument('-d', '--dir', required=True, help="镜像tar保存目录")
+    check.add_argument('--blob-store', default=os.environ.get('BLOB_STORE_DIR') or os.path.join(
+        os.environ.get('AUTO_PACKING_BASE_DIR', '/home/auto_packing_no_delete'), 'blobs'), help="blob存储目录")
+    check.add_argument('--repo', default=os.environ.get('IMAGE_REPO', DEFAULT_REPO), help="镜像仓库前缀")
+    args = parser.parse_args(argv)
+    if args.command != 'check':
+        parser.print_help()
+        return 1
+
+    try:
+        image_entries, _ = load_image_list(args.file)
+    except (ImageListError, IOError, OSError) as e:
+        print(f"错误：镜像列表无法读取：{e}", file=sys.stderr)
+        return 1
+    os.makedirs(args.dir, exist_ok=True)
+    store_enabled = os.environ.get('BLOB_STORE_ENABLED', '1') != '0'
+    estimator = SizeEstimator(args.dir, BlobStore(args.blob_store) if store_enabled else None, args.repo,
+                              pull_backend=os.environ.get('PULL_BACKEND', 'nerdctl'), store_enabled=store_enabled,
+                              token_cache_path=os.environ.get('REGISTRY_TOKEN_CACHE'))
+    estimate = estimator.estimate(image_entries)
+    available = shutil.disk_usage(args.dir).free - DISK_RESERVE_BYTES
+    sources = '，'.join(f"{name}{count}个" for name, count in sorted(estimate.sources.items()))
+    print(f"拉取需要写入{format_size(estimate.write_bytes)}（大小来源：{sources}），"
+          f"可用{format_size(max(available, 0))}（另需保留{format_size(DISK_RESERVE_BYTES)}）")
+    return 0 if estimate.write_bytes <= available else 3
+
+
+if __name__ == '__main__':
+    sys.exit(main())
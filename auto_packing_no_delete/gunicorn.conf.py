@@ -0,0 +1,108 @@
+"""gunicorn 生产部署配置
+
+启动：
+    cd /home/auto_packing_no_delete && myenv/bin/gunicorn -c gunicorn.conf.py app:app
+平滑重载（重新加载代码，进行中的SSE连接和构建不中断）：
+    kill -HUP <gunicorn master pid>
+    - 不使用 preload_app，HUP 后新启动的worker重新导入app（加载新代码），旧worker处理完进行中的连接后退出
+    - 构建进程收到SIGTERM后停止认领新任务，进行中的构建结束后退出，master随即启动新的构建进程（加载新代码）；
+      等待期间新提交的构建在队列中排队，由新构建进程执行
+
+部署结构：
+    - web worker（gthread）：只处理 /versions、/build 提交、SSE进度推送、/download 下载。
+      SSE和大文件下载都是长连接，每个连接占用一个线程，因此用 少量进程 × 大量线程，
+      而不是同步worker（每个连接占用一个进程）。
+    - 构建进程（python app.py --builder）：由 master 在 when_ready 时启动，执行排队的构建任务。
+      构建最长约30分钟，放在web worker中会被 timeout 杀掉、被重载打断，因此与web worker分离；
+      worker 与构建进程之间通过 task_records/ 下的文件交换状态（见 task_store.py）。
+
+环境变量：
+    GUNICORN_BIND            监听地址（默认 0.0.0.0:8000）
+    GUNICORN_WORKERS         worker进程数（默认2）
+    GUNICORN_THREADS         每个worker的线程数，即可同时保持的SSE/下载连接数（默认256）
+    GUNICORN_WORKER_CLASS    worker类型（默认gthread；已安装gevent时可设为gevent）
+    BUILD_CONCURRENCY        构建进程同时执行的构建数（默认2）
+"""
+import os
+import subprocess
+import sys
+import threading
+
+BASE_DIR = os.environ.get('AUTO_PACKING_BASE_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+# 构建由独立的构建进程执行（worker fork 时继承此环境变量）
+os.environ['BUILDER_MODE'] = 'external'
+
+# ---------- 监听与worker ----------
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 256))
+worker_connections = threads
+backlog = 2048
+
+# 不预先导入app：preload_app 时 HUP 只重新读取配置，worker 仍使用 master 中导入的旧代码
+preload_app = False
+
+# ---------- 超时 ----------
+# gthread worker 的心跳与请求处理线程无关，长时间的SSE/下载不会触发 timeout
+timeout = 120
+# 重载/停止时等待进行中的下载和SSE连接结束的时间
+graceful_timeout = 1800
+keepalive = 5
+
+# ---------- 日志 ----------
+accesslog = os.path.join(BASE_DIR, 'logs', 'gunicorn_access.log')
+errorlog = os.path.join(BASE_DIR, 'logs', 'gunicorn_error.log')
+loglevel = 'info'
+capture_output = True
+
+# ---------- 构建进程管理 ----------
+# 重载时本配置文件会被重新执行，构建进程对象挂在 master（server）上保存
+
+
+def _start_builder(server):
+    proc = getattr(server, 'builder_proc', None)
+    if getattr(server, 'builder_stopping', False) or (proc is not None and proc.poll() is None):
+        return
+    server.builder_proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'app.py'), '--builder'],
+                                           cwd=BASE_DIR, env=dict(os.environ, AUTO_PACKING_BASE_DIR=BASE_DIR))
+    server.log.info("构建进程已启动（pid=%s）", server.builder_proc.pid)
+
+
+def when_ready(server):
+    _start_builder(server)
+
+
+def on_reload(server):
+    # 旧构建进程收到SIGTERM后不再认领新任务，进行中的构建结束后退出；后台线程等其退出后启动新的构建进程
+    proc = getattr(server, 'builder_proc', None)
+    if proc is None or proc.poll() is not None:
+        _start_builder(server)
+        return
+    restart = getattr(server, 'builder_restart', None)
+    if restart is not None and restart.is_alive():
+        return   # 上次重载的旧构建进程仍在等待构建结束，届时启动的新进程会加载最新代码
+    server.log.info("重载：等待构建进程（pid=%s）完成进行中的构建后重启", proc.pid)
+    proc.terminate()
+
+    def restart_when_drained():
+        proc.wait()
+        _start_builder(server)
+
+    server.builder_restart = threading.Thread(target=restart_when_drained, name="builder-restart", daemon=True)
+    server.builder_restart.start()
+
+
+def on_exit(server):
+    server.builder_stopping = True
+    proc = getattr(server, 'builder_proc', None)
+    if proc is None or proc.poll() is not None:
+        return
+    # 构建进程收到SIGTERM后停止认领新任务，等待进行中的构建结束
+    proc.terminate()
+    try:
+        proc.wait(graceful_timeout)
+    except subprocess.TimeoutExpired:
+        server.log.warning("构建进程未在%s秒内退出，强制结束", graceful_timeout)
+        proc.kill()
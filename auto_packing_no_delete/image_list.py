@@ -0,0 +1,231 @@
+"""镜像列表解析（app.py 与 pull_save.sh 共用）
+
+支持的行格式（每行一个镜像，# 开头为注释，行尾 " # xxx" 为行内注释）：
+    deepflow-server: v6.6.5550
+    deepflow-agent_tag: v6.6.5602
+    deepflow-app_tag:v6.6.235@sha256:<64位hex>
+    pcap@sha256:<64位hex>
+    hub.deepflow.yunshan.net/dev/deepflow-server:feature-scp-66
+
+命令行用法（供 pull_save.sh 调用，一次进程完成整个列表的解析）：
+    python3 image_list.py -f patch_image_tag_list.txt --repo hub.deepflow.yunshan.net/dev/
+    python3 image_list.py --repo hub.deepflow.yunshan.net/dev/ deepflow-server:v6.6.5550 ...
+输出为制表符分隔的行：
+    I <TAB> 完整镜像地址 <TAB> 保存文件名
+    W <TAB> 行号 <TAB> 诊断信息
+"""
+import argparse
+import re
+import sys
+
+# 默认镜像仓库前缀（与pull_save.sh保持一致）
+DEFAULT_REPO = "hub.deepflow.yunshan.net/dev/"
+
+# 预编译正则（整份列表只编译一次）
+_DIGEST_RE = re.compile(r'@\s*(sha256:[0-9a-fA-F]{64})\s*$')
+_BAD_DIGEST_RE = re.compile(r'@\s*(\S*)\s*$')
+_NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*(?:/[A-Za-z0-9][A-Za-z0-9._-]*)*$')
+_HOST_RE = re.compile(r'^(?:localhost|[A-Za-z0-9.-]+\.[A-Za-z0-9.-]+)(?::\d+)?$')
+_TAG_RE = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]{0,127}$')
+_INLINE_COMMENT_RE = re.compile(r'\s+#.*$')
+_FILE_NAME_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9_-]')
+_FILE_TAG_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
+
+class ImageListError(Exception):
+    """镜像列表无法使用（文件缺失/没有任何有效镜像）"""
+
+
+class ImageEntry(object):
+    """列表中的一个镜像"""
+    __slots__ = ('lineno', 'name', 'tag', 'digest', 'registry')
+
+    def __init__(self, lineno, name, tag, digest=None, registry=None):
+        self.lineno = lineno      # 所在行号（命令行传入时为参数序号）
+        self.name = name          # 镜像名（不含仓库前缀，如 deepflow-server）
+        self.tag = tag            # 标签（可能为空，仅指定digest时）
+        self.digest = digest      # sha256:xxx（可选）
+        self.registry = registry  # 行内自带的完整仓库地址（可选，此时不再拼接默认前缀）
+
+    @property
+    def short_name(self):
+        """镜像名最后一段（deepflow-server）"""
+        return self.name.rsplit('/', 1)[-1]
+
+    def repository(self, repo=DEFAULT_REPO):
+        """完整镜像名（不含标签和digest，与 nerdctl images 的 Repository 列一致）"""
+        prefix = self.registry + '/' if self.registry else repo
+        return prefix + self.name
+
+    def ref(self, repo=DEFAULT_REPO):
+        """完整镜像地址（用于pull）"""
+        ref = self.repository(repo)
+        if self.tag:
+            ref += ':' + self.tag
+        if self.digest:
+            ref += '@' + self.digest
+        return ref
+
+    @property
+    def tar_name(self):
+        """本地保存的tar文件名（deepflow-server_v6.6.5550.tar；带命名空间时为 ns__deepflow-server_v6.6.5550.tar）"""
+        name = '__'.join(_FILE_NAME_UNSAFE_RE.sub('', part) for part in self.name.split('/'))
+        if self.tag:
+            tag = _FILE_TAG_UNSAFE_RE.sub('', self.tag)
+        else:
+            tag = 'sha256-' + self.digest.split(':', 1)[1][:12]
+        return f"{name}_{tag}.tar"
+
+    def to_dict(self, repo=DEFAULT_REPO):
+        return {
+            'name': self.short_name,
+            'tag': self.tag,
+            'digest': self.digest,
+            'ref': self.ref(repo),
+            'tar_name': self.tar_name,
+        }
+
+    def __repr__(self):
+        return f"ImageEntry({self.lineno}, {self.ref('')!r})"
+
+
+class Diagnostic(object):
+    """单行解析诊断信息"""
+    __slots__ = ('lineno', 'level', 'message', 'line')
+
+    def __init__(self, lineno, level, message, line):
+        self.lineno = lineno
+        self.level = level      # "WARN"：已跳过/已去重；"ERROR"：格式错误
+        self.message = message
+        self.line = line
+
+    def __str__(self):
+        return f"第{self.lineno}行 [{self.level}] {self.message}：{self.line.strip()}"
+
+
+def parse_ref(text, lineno=0):
+    """解析单个镜像引用，返回 (ImageEntry, 错误信息)，二者必有一个为None"""
+    text = text.strip()
+    digest = None
+    if '@' in text:
+        match = _DIGEST_RE.search(text)
+        if not match:
+            bad = _BAD_DIGEST_RE.search(text)
+            return None, f"digest格式错误（应为sha256:<64位hex>）：{bad.group(1) if bad else text}"
+        digest = match.group(1).lower()
+        text = text[:match.start()].rstrip()
+
+    # 拆分名称与标签：最后一个冒号之后若含"/"，说明是仓库端口（host:5000/name），不是标签
+    name, sep, tag = text.rpartition(':')
+    if not sep or '/' in tag:
+        name, tag = text, ''
+    name = name.strip()
+    tag = tag.strip()
+    # 兼容 name_tag: vx.x.x 格式
+    if name.endswith('_tag'):
+        name = name[:-4]
+
+    registry = None
+    first, slash, rest = name.partition('/')
+    if slash and _HOST_RE.match(first):
+        registry, name = first, rest
+        # 默认仓库前缀下的完整地址（hub.xxx/dev/name）统一还原为短名，便于与列表去重
+        if (registry + '/' + name).startswith(DEFAULT_REPO):
+            registry, name = None, (registry + '/' + name)[len(DEFAULT_REPO):]
+
+    if not name:
+        return None, "缺少镜像名"
+    if not _NAME_RE.match(name):
+        return None, f"镜像名包含非法字符：{name}"
+    if not tag and not digest:
+        return None, "缺少镜像标签"
+    if tag and not _TAG_RE.match(tag):
+        return None, f"镜像标签格式错误：{tag}"
+    return ImageEntry(lineno, name, tag, digest, registry), None
+
+
+def parse_lines(lines):
+    """逐行解析（单次遍历），返回 (镜像列表, 诊断列表)；重复镜像自动去重，
+    保存文件名与前面的镜像相同（仅仓库地址不同等）的行视为错误并跳过，避免两个镜像共用一个tar"""
+    entries = []
+    diagnostics = []
+    seen = {}
+    seen_tars = {}
+    for lineno, raw in enumerate(lines, 1):
+        line = raw.strip()
+        # 跳过空行和注释（支持开头带空格的注释）
+        if not line or line.startswith('#'):
+            continue
+        line = _INLINE_COMMENT_RE.sub('', line)
+
+        entry, error = parse_ref(line, lineno)
+        if error:
+            diagnostics.append(Diagnostic(lineno, 'ERROR', error, raw))
+            continue
+
+        key = entry.ref('')
+        if key in seen:
+            diagnostics.append(Diagnostic(lineno, 'WARN', f"与第{seen[key]}行重复，已忽略", raw))
+            continue
+        if entry.tar_name in seen_tars:
+            diagnostics.append(Diagnostic(lineno, 'ERROR',
+                                          f"保存文件名{entry.tar_name}与第{seen_tars[entry.tar_name]}行的镜像相同，已忽略", raw))
+            continue
+        seen[key] = lineno
+        seen_tars[entry.tar_name] = lineno
+        entries.append(entry)
+    return entries, diagnostics
+
+
+def parse_image_list(path):
+    """解析镜像列表文件，返回 (镜像列表, 诊断列表)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return parse_lines(f)
+    except (IOError, OSError) as e:
+        raise ImageListError(f"无法读取镜像列表文件：{path}（{e}）")
+
+
+def load_image_list(path):
+    """解析镜像列表文件，没有任何有效镜像时抛出ImageListError"""
+    entries, diagnostics = parse_image_list(path)
+    if not entries:
+        details = '；'.join(str(d) for d in diagnostics[:5])
+        raise ImageListError(f"镜像列表中没有有效镜像：{path}" + (f"（{details}）" if details else ""))
+    return entries, diagnostics
+
+
+# -------------------------- 命令行入口（pull_save.sh 调用） --------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="解析DeepFlow镜像列表，输出完整镜像地址和保存文件名")
+    parser.add_argument('-f', '--file', help="镜像列表文件")
+    parser.add_argument('--repo', default=DEFAULT_REPO, help="镜像仓库前缀（默认：%(default)s）")
+    parser.add_argument('--strict', action='store_true', help="存在格式错误的行时返回非0")
+    parser.add_argument('images', nargs='*', help="直接指定的镜像（与-f二选一）")
+    args = parser.parse_args(argv)
+
+    if args.file and args.images:
+        parser.error("-f 与镜像参数不能同时使用")
+    if args.file:
+        try:
+            entries, diagnostics = parse_image_list(args.file)
+        except ImageListError as e:
+            print(f"E\t0\t{e}")
+            return 2
+    else:
+        entries, diagnostics = parse_lines(args.images)
+
+    out = []
+    for d in diagnostics:
+        out.append(f"W\t{d.lineno}\t{d}")
+    for entry in entries:
+        out.append(f"I\t{entry.ref(args.repo)}\t{entry.tar_name}")
+    sys.stdout.write('\n'.join(out) + ('\n' if out else ''))
+
+    if args.strict and any(d.level == 'ERROR' for d in diagnostics):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
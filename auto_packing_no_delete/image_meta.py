@@ -0,0 +1,130 @@
+"""镜像tar的元数据：大小、sha256、CRC32、镜像manifest/配置的digest
+
+升级包索引（单个镜像下载的校验值、现场比对已有镜像）和虚拟升级包（zip条目的CRC32）都需要读一遍完整的镜像tar。
+一次读取同时计算sha256、CRC32和块校验文件的子块记录（blockmap.py），结果缓存在
+image_tar/.meta/<tar文件名>.json 和 .blocks，镜像tar只新建不覆盖（pull_save.sh 先写临时文件再改名），
+大小或mtime与缓存不一致时重新计算。
+构建进程和web worker共用同一份缓存。
+"""
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import zlib
+
+from blockmap import VERSION as BLOCKMAP_VERSION, SUB_RECORD, SubBlockHasher
+from task_store import write_json, read_json
+
+META_DIR = '.meta'
+CHUNK = 1024 * 1024
+
+
+def file_meta(path, on_chunk=None):
+    """读一遍文件，返回 {name, path, size, mtime, mtime_ns, mode, sha256, crc}；on_chunk 按顺序接收读到的每段字节"""
+    st = os.stat(path)
+    sha256 = hashlib.sha256()
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            sha256.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            if on_chunk is not None:
+                on_chunk(chunk)
+    return {"name": os.path.basename(path), "path": path, "size": st.st_size, "mtime": st.st_mtime,
+            "mtime_ns": st.st_mtime_ns, "mode": st.st_mode, "sha256": sha256.hexdigest(), "crc": crc & 0xFFFFFFFF}
+
+
+def image_ids(path):
+    """镜像tar中的manifest digest（index.json）和配置digest（manifest.json，即镜像ID），读取失败时为None"""
+    manifest = config = None
+    try:
+        with tarfile.open(path, 'r:') as tar:
+            for member in tar:
+                if member.name == 'index.json':
+                    manifests = json.loads(tar.extractfile(member).read().decode('utf-8')).get('manifests') or []
+                    if manifests:
+                        manifest = manifests[0].get('digest')
+                elif member.name == 'manifest.json':
+                    items = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                    if items and items[0].get('Config'):
+                        # OCI layout：blobs/sha256/<hex>；docker save：<hex>.json
+                        name = os.path.basename(items[0]['Config'])
+                        config = 'sha256:' + (name[:-len('.json')] if name.endswith('.json') else name)
+    except (tarfile.TarError, OSError, ValueError, AttributeError):
+        pass
+    return manifest, config
+
+
+def meta_path(image_tar_dir, tar_name):
+    return os.path.join(image_tar_dir, META_DIR, tar_name + '.json')
+
+
+def blocks_path(image_tar_dir, tar_name):
+    return os.path.join(image_tar_dir, META_DIR, tar_name + '.blocks')
+
+
+def cached_image_meta(image_tar_dir, tar_name):
+    """已缓存且与当前文件一致的元数据，没有时返回None（不读取镜像tar）"""
+    path = os.path.join(image_tar_dir, tar_name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    meta = read_json(meta_path(image_tar_dir, tar_name))
+    if meta and meta.get('path') == path and meta.get('size') == st.st_size and meta.get('mtime_ns') == st.st_mtime_ns:
+        return meta
+    return None
+
+
+class _BlocksCache(object):
+    """边读镜像tar边写出子块记录缓存（只含完整的4KB子块，先写临时文件，commit 时改名）"""
+
+    def __init__(self, image_tar_dir, tar_name):
+        self.path = blocks_path(image_tar_dir, tar_name)
+        self._tmp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        self._file = open(self._tmp_path, 'wb')
+        self._hasher = SubBlockHasher()
+
+    def update(self, chunk):
+        self._hasher.update(chunk)
+        self._file.write(self._hasher.take())
+
+    def commit(self, meta):
+        """写完缓存，并在元数据中记录子块数（与缓存文件大小一致时缓存有效）"""
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        meta['sub_blocks'], meta['blockmap_version'] = self._hasher.count, BLOCKMAP_VERSION
+        return meta
+
+
+def image_meta(image_tar_dir, tar_name):
+    """镜像tar的元数据（有缓存时直接返回，否则读一遍文件计算并写入缓存，同时写出子块记录缓存）"""
+    meta = cached_image_meta(image_tar_dir, tar_name)
+    if meta is None:
+        path = os.path.join(image_tar_dir, tar_name)
+        os.makedirs(os.path.join(image_tar_dir, META_DIR), exist_ok=True)
+        blocks = _BlocksCache(image_tar_dir, tar_name)
+        meta = blocks.commit(file_meta(path, on_chunk=blocks.update))
+        meta['manifest'], meta['config'] = image_ids(path)
+        write_json(meta_path(image_tar_dir, tar_name), meta)
+    return meta
+
+
+def image_sub_blocks(image_tar_dir, tar_name):
+    """镜像tar各完整4KB子块的记录缓存文件路径（blockmap.assemble_blockmap 用）；
+    之前版本缓存的元数据没有子块记录时读一遍文件补上"""
+    meta = image_meta(image_tar_dir, tar_name)
+    path = blocks_path(image_tar_dir, tar_name)
+    try:
+        if (meta.get('blockmap_version') == BLOCKMAP_VERSION
+                and os.path.getsize(path) == meta['sub_blocks'] * SUB_RECORD.size):
+            return path
+    except (OSError, KeyError):
+        pass
+    blocks = _BlocksCache(image_tar_dir, tar_name)
+    with open(meta['path'], 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            blocks.update(chunk)
+    write_json(meta_path(image_tar_dir, tar_name), blocks.commit(dict(meta)))
+    return path
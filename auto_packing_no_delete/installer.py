@@ -0,0 +1,180 @@
+"""升级包中的安装脚本（install.sh）：按构建清单生成，在现场并行加载镜像
+
+升级包中原来只有镜像tar和镜像列表，现场需要逐个手动 nerdctl load，40个镜像串行加载要占用大半个升级窗口。
+生成的脚本中内嵌本次构建的镜像清单（文件名、sha256、manifest/配置digest、镜像地址），在现场：
+    - 加载前校验镜像tar的sha256（与构建时计算的一致），避免加载传输中损坏的文件
+    - 本机已有相同digest和标签的镜像跳过加载（--force 时全部加载）
+    - 最多同时加载 -j 个镜像，输出每个镜像的进度、校验和加载耗时，最后汇总
+脚本只依赖 bash、coreutils（sha256sum、date）、flock 和 nerdctl（NERDCTL 环境变量可改为 docker）。
+"""
+import os
+
+INSTALL_SCRIPT = 'install.sh'
+
+_TEMPLATE = r'''#!/bin/bash
+# DeepFlow升级包安装脚本（构建服务按本升级包的镜像清单生成）
+# 在升级包解压目录中执行：
+#   bash install.sh [-j 并行数] [-n 命名空间] [--no-verify] [--force]
+#     -j, --jobs       同时加载的镜像数（默认4，环境变量 INSTALL_JOBS）
+#     -n, --namespace  containerd命名空间（默认k8s.io，环境变量 INSTALL_NAMESPACE）
+#     --no-verify      加载前不校验sha256
+#     --force          本机已有的镜像也重新加载
+# 环境变量 NERDCTL 可指定加载命令（默认nerdctl，可改为docker）
+set -uo pipefail
+
+JOBS="${INSTALL_JOBS:-4}"
+NAMESPACE="${INSTALL_NAMESPACE:-k8s.io}"
+NERDCTL="${NERDCTL:-nerdctl}"
+VERIFY=1
+FORCE=0
+
+usage() {
+    sed -n '3,9p' "$0" | sed 's/^# \{0,1\}//'
+}
+
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -j|--jobs) JOBS="$2"; shift 2 ;;
+        -n|--namespace) NAMESPACE="$2"; shift 2 ;;
+        --no-verify) VERIFY=0; shift ;;
+        --force) FORCE=1; shift ;;
+        -h|--help) usage; exit 0 ;;
+        *) echo "未知参数：$1"; usage; exit 2 ;;
+    esac
+done
+
+cd "$(dirname "$0")" || exit 1
+
+# 镜像清单（制表符分隔：文件名、sha256、manifest digest、配置digest、镜像名、标签；没有的值为 -）
+image_manifest() {
+    cat <<'EOF'
+__IMAGES__
+EOF
+}
+
+now_ms() {
+    date +%s%3N
+}
+
+log() {
+    echo "[$(date '+%H:%M:%S')] $*"
+}
+
+TOTAL=$(image_manifest | grep -c .)
+RESULT_FILE=$(mktemp)
+trap 'rm -f "$RESULT_FILE"' EXIT
+# 本机已有的镜像（每行一个JSON对象，含Repository/Tag/Digest/ID）
+EXISTING=""
+if [ "$FORCE" = 0 ]; then
+    EXISTING=$("$NERDCTL" -n "$NAMESPACE" images --digests --format '{{json .}}' 2>/dev/null || true)
+fi
+
+# 本机是否已有该镜像：同一行中digest（或12位配置ID）和镜像名、标签都一致（只指定digest的镜像不比较标签）
+image_present() {
+    local digest="$1" config="$2" repository="$3" tag="$4" line
+    [ -n "$EXISTING" ] || return 1
+    while IFS= read -r line; do
+        case "$line" in
+            *"\"Repository\":\"$repository\""*) ;;
+            *) continue ;;
+        esac
+        if [ "$tag" != "-" ]; then
+            case "$line" in
+                *"\"Tag\":\"$tag\""*) ;;
+                *) continue ;;
+            esac
+        fi
+        if [ "$digest" != "-" ] && [[ "$line" == *"${digest#sha256:}"* ]]; then
+            return 0
+        fi
+        if [ "$config" != "-" ] && [[ "$line" == *"${config:7:12}"* ]]; then
+            return 0
+        fi
+    done <<< "$EXISTING"
+    return 1
+}
+
+# 记录一个镜像的结果（状态、文件名、校验耗时ms、加载耗时ms）并输出进度
+report() {
+    local status="$1" file="$2" verify_ms="$3" load_ms="$4" message="$5"
+    local finished
+    # 并行的加载任务同时完成时，写结果和计数需要互斥（否则进度序号会重复）
+    exec 9>> "$RESULT_FILE"
+    flock 9
+    printf '%s\t%s\t%s\t%s\n' "$status" "$file" "$verify_ms" "$load_ms" >&9
+    finished=$(wc -l < "$RESULT_FILE")
+    flock -u 9
+    exec 9>&-
+    log "[$finished/$TOTAL] $file：$message"
+}
+
+install_one() {
+    local file="$1" sha256="$2" digest="$3" config="$4" repository="$5" tag="$6"
+    local start verify_ms=0 load_ms output
+    if [ ! -f "$file" ]; then
+        report failed "$file" 0 0 "文件不存在"
+        return
+    fi
+    if [ "$FORCE" = 0 ] && image_present "$digest" "$config" "$repository" "$tag"; then
+        report skipped "$file" 0 0 "本机已有相同digest的镜像，跳过"
+        return
+    fi
+    if [ "$VERIFY" = 1 ]; then
+        start=$(now_ms)
+        if [ "$(sha256sum "$file" | cut -d' ' -f1)" != "$sha256" ]; then
+            report failed "$file" $(( $(now_ms) - start )) 0 "sha256校验失败（文件损坏或不完整）"
+            return
+        fi
+        verify_ms=$(( $(now_ms) - start ))
+    fi
+    start=$(now_ms)
+    if ! output=$("$NERDCTL" -n "$NAMESPACE" load -i "$file" 2>&1); then
+        report failed "$file" "$verify_ms" $(( $(now_ms) - start )) "加载失败：$(echo "$output" | tail -1)"
+        return
+    fi
+    load_ms=$(( $(now_ms) - start ))
+    report loaded "$file" "$verify_ms" "$load_ms" \
+        "加载完成（校验$(( verify_ms / 1000 )).$(( verify_ms % 1000 / 100 ))s，加载$(( load_ms / 1000 )).$(( load_ms % 1000 / 100 ))s）"
+}
+
+log "开始安装：共${TOTAL}个镜像，并行数${JOBS}，命名空间${NAMESPACE}"
+STARTED=$(now_ms)
+while IFS=$'\t' read -r file sha256 digest config repository tag; do
+    [ -n "$file" ] || continue
+    while [ "$(jobs -rp | wc -l)" -ge "$JOBS" ]; do
+        sleep 0.2
+    done
+    install_one "$file" "$sha256" "$digest" "$config" "$repository" "$tag" &
+done < <(image_manifest)
+wait
+
+ELAPSED=$(( $(now_ms) - STARTED ))
+loaded=$(grep -c '^loaded' "$RESULT_FILE")
+skipped=$(grep -c '^skipped' "$RESULT_FILE")
+failed=$(grep -c '^failed' "$RESULT_FILE")
+serial=$(awk -F'\t' '{ sum += $3 + $4 } END { print sum + 0 }' "$RESULT_FILE")
+log "安装结束：加载${loaded}个，跳过${skipped}个，失败${failed}个；"\
+"耗时$(( ELAPSED / 1000 )).$(( ELAPSED % 1000 / 100 ))s（逐个执行约$(( serial / 1000 ))s）"
+if [ "$failed" -gt 0 ]; then
+    log "失败的镜像："
+    grep '^failed' "$RESULT_FILE" | cut -f2 | sed 's/^/    /'
+    exit 1
+fi
+exit 0
+'''
+
+
+def render_install_script(images):
+    """images: [{file, sha256, digest, config, repository, tag}]（升级包索引中的镜像项）；
+    镜像名和标签分开传入：只指定digest或同时带digest的镜像地址（name:tag@sha256:...）无法按冒号拆分；
+    内容只取决于镜像清单（不含任务ID、时间），镜像相同的构建生成相同的脚本"""
+    lines = '\n'.join('\t'.join([image['file'], image['sha256'], image.get('digest') or '-',
+                                 image.get('config') or '-', image['repository'], image.get('tag') or '-'])
+                      for image in images)
+    return _TEMPLATE.replace('__IMAGES__', lines)
+
+
+def write_install_script(path, images):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(render_install_script(images))
+    os.chmod(path, 0o755)
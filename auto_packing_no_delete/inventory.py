@@ -0,0 +1,168 @@
+"""现场已有镜像清单（POST /build 上传）：解析清单，并从镜像列表中排除现场已有的镜像
+
+现场往往已经有部分目标镜像（之前单独推送的补丁），这些镜像不需要拉取也不需要打进升级包。
+支持的清单格式：
+    - nerdctl images --format json / docker images --format '{{json .}}'：每行一个JSON对象（Repository/Tag/Digest/ID）
+    - JSON数组：元素为上述对象或字符串
+    - 文本：每行一个 sha256:<hex>（或12位以上的短ID），或镜像引用 name:tag[@sha256:<hex>]
+匹配规则（任一满足即视为现场已有）：
+    - digest：镜像的manifest digest、多架构index digest、配置digest（镜像ID）之一在清单中（短ID按前缀匹配）
+    - 标签：清单项只有镜像名和标签（没有digest）时，镜像名（最后一段）和标签相同（skipped_images.json 中记为 tag_only）
+镜像的digest依次取自：镜像列表中的 @sha256、已缓存镜像tar的元数据、仓库manifest（只读manifest，不下载layer）。
+无法确定digest（仓库不可达/查询失败）的镜像一律打包：同一标签可能已重新推送了修复版本，只按标签匹配会漏掉。
+"""
+import json
+import re
+
+from image_list import parse_ref
+from image_meta import cached_image_meta
+from registry_client import ConnectionPool, RegistryClient, RegistryError, TokenCache, parse_reference
+
+REGISTRY_TIMEOUT = 10   # 查询manifest的超时（秒）
+MIN_SHORT_ID = 12       # 短ID的最小长度（nerdctl/docker images 显示12位）
+_HEX_RE = re.compile(r'^(?:sha256:)?([0-9a-f]{12,64})$')
+
+
+class InventoryError(Exception):
+    """清单无法解析"""
+
+
+def _hex(value):
+    match = _HEX_RE.match((value or '').strip().lower())
+    return match.group(1) if match else None
+
+
+class Inventory(object):
+    """现场已有镜像：digest（不含sha256:前缀的hex，完整或短ID）和 (镜像名最后一段, 标签)"""
+
+    def __init__(self, digests=(), tags=(), tag_only=(), images=0):
+        self.digests = set(digests)
+        self.tags = set(tags)            # 所有清单项的镜像名和标签
+        self.tag_only = set(tag_only)    # 没有digest的清单项（只能按标签匹配）
+        self.images = images             # 清单项数
+
+    def __len__(self):
+        return self.images
+
+    def _add(self, repository=None, tag=None, digests=()):
+        hexes = [h for h in (_hex(d) for d in digests) if h]
+        self.digests.update(hexes)
+        if repository and tag and tag != '<none>':
+            key = (repository.rsplit('/', 1)[-1], tag)
+            self.tags.add(key)
+            if not hexes:
+                self.tag_only.add(key)
+        self.images += 1
+
+    def _add_item(self, item):
+        if isinstance(item, dict):
+            self._add(item.get('Repository'), item.get('Tag'), [item.get('Digest'), item.get('ID')])
+            return
+        text = str(item).strip()
+        if not text or text.startswith('#'):
+            return
+        if _hex(text):
+            self._add(digests=[text])
+            return
+        entry, error = parse_ref(text)
+        if entry is None:
+            raise InventoryError(f"无法识别的清单项（{error}）：{text}")
+        self._add(entry.name, entry.tag, [entry.digest])
+
+    @classmethod
+    def parse(cls, text):
+        inventory = cls()
+        text = text.strip()
+        if text.startswith('['):
+            try:
+                items = json.loads(text)
+            except ValueError as e:
+                raise InventoryError(f"JSON格式错误：{e}")
+        else:
+            items = []
+            for lineno, line in enumerate(text.splitlines(), 1):
+                line = line.strip()
+                if line.startswith('{'):
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError as e:
+                        raise InventoryError(f"第{lineno}行JSON格式错误：{e}")
+                else:
+                    items.append(line)
+        for item in items:
+            inventory._add_item(item)
+        return inventory
+
+    def to_dict(self):
+        return {"digests": sorted(self.digests), "tags": sorted(self.tags), "tag_only": sorted(self.tag_only),
+                "images": self.images}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('digests', []), [tuple(t) for t in data.get('tags', [])],
+                   [tuple(t) for t in data.get('tag_only', [])], data.get('images', 0))
+
+    def _has_digest(self, digest):
+        value = _hex(digest)
+        if not value:
+            return False
+        return value in self.digests or any(len(d) >= MIN_SHORT_ID and value.startswith(d)
+                                            for d in self.digests if len(d) < 64)
+
+    def match(self, entry, digests):
+        """镜像是否在清单中，返回 (匹配方式 'digest'/'tag_only', 匹配的digest) 或 (None, None)；
+        digests 为None表示无法确定镜像的digest，此时不匹配（镜像照常打包）"""
+        if digests is None:
+            return None, None
+        for digest in digests:
+            if self._has_digest(digest):
+                return 'digest', digest
+        if entry.tag and (entry.short_name, entry.tag) in self.tag_only:
+            return 'tag_only', None
+        return None, None
+
+
+def resolve_digests(entries, image_tar_dir, repo, token_cache_path=None):
+    """每个镜像已知的digest {tar文件名: [digest]}；需要查询仓库但查询失败、且列表中没有指定@sha256的镜像为None
+    （仓库不可达时不再逐个等待超时，其余镜像同样处理）"""
+    found = {}
+    unknown = []
+    for entry in entries:
+        digests = [entry.digest] if entry.digest else []
+        meta = cached_image_meta(image_tar_dir, entry.tar_name)
+        if meta:
+            digests += [d for d in (meta.get('manifest'), meta.get('config')) if d]
+        found[entry.tar_name] = digests
+        if not meta:
+            unknown.append(entry)
+    if not unknown:
+        return found
+    client = RegistryClient(pool=ConnectionPool(timeout=REGISTRY_TIMEOUT),
+                            token_cache=TokenCache(token_cache_path) if token_cache_path else None)
+    try:
+        for index, entry in enumerate(unknown):
+            try:
+                registry, repository, reference = parse_reference(entry.ref(repo))
+                found[entry.tar_name] += client.image_digests(registry, repository, reference)
+            except (RegistryError, ValueError):
+                found[entry.tar_name] = found[entry.tar_name] or None
+            except OSError:
+                for rest in unknown[index:]:
+                    found[rest.tar_name] = found[rest.tar_name] or None
+                break
+    finally:
+        client.pool.close()
+    return found
+
+
+def split_by_inventory(entries, inventory, digests, repo):
+    """按清单拆分镜像列表，返回 (需要打包的镜像, [被跳过的镜像说明])"""
+    kept = []
+    skipped = []
+    for entry in entries:
+        matched, digest = inventory.match(entry, digests.get(entry.tar_name, [entry.digest] if entry.digest else []))
+        if matched is None:
+            kept.append(entry)
+        else:
+            skipped.append(dict(entry.to_dict(repo), matched=matched, matched_digest=digest))
+    return kept, skipped
@@ -0,0 +1,300 @@
+"""Prometheus指标（文件共享，支持gunicorn多worker）
+
+每个进程只在内存中累加自己的指标，由后台线程定期写入 <目录>/<pid>.json（原子替换）；
+/metrics 抓取时汇总目录下所有进程的文件：
+- counter / histogram：所有进程求和；已退出进程的数据合并到 archived.json 后删除其文件
+- gauge：只统计存活进程（进程退出后其连接数/下载数等自动归零）；文件中记录进程启动时间
+  （/proc/<pid>/stat 第22项），pid被新进程复用时启动时间不同，按已退出处理
+"""
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ARCHIVE_FILE = 'archived.json'
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())], ensure_ascii=False)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = []
+    for k, v in pairs:
+        v = str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{k}="{v}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _process_start_time(pid):
+    """进程启动时间（/proc/<pid>/stat 第22项，开机后的时钟滴答数）；读不到时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # 第2项进程名可能含空格和括号，从最后一个')'之后开始数（第3项起）
+    fields = stat[stat.rfind(')') + 2:].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _pid_alive(pid, start_time=None):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if start_time is None:
+        return True
+    # pid已被其他进程复用：启动时间不同
+    current = _process_start_time(pid)
+    return current is None or current == start_time
+
+
+class MetricsRegistry(object):
+    """文件共享的指标注册表"""
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions = {}   # name -> (type, help, buckets)
+        self._collectors = []    # 抓取时计算的指标（磁盘空间、命中率等）
+        self._lock = threading.Lock()
+        self._pid = None
+        self._start_time = None
+        self._values = {}        # key -> 数值（counter/gauge）
+        self._histograms = {}    # key -> {"buckets": [...], "sum": x, "count": n}
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+    # -------------------------- 指标定义 --------------------------
+    def counter(self, name, help_text):
+        self._definitions[name] = (COUNTER, help_text, None)
+
+    def gauge(self, name, help_text):
+        self._definitions[name] = (GAUGE, help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._definitions[name] = (HISTOGRAM, help_text, tuple(sorted(buckets)))
+
+    def register_collector(self, func):
+        """注册抓取时调用的函数，返回 [(name, 类型, 说明, {labels}, 值), ...]"""
+        self._collectors.append(func)
+
+    # -------------------------- 更新（热路径，只改内存） --------------------------
+    def _check_process(self):
+        """fork后（gunicorn preload）子进程丢弃继承的数据，并启动自己的刷盘线程"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._start_time = _process_start_time(self._pid)
+            self._values = {}
+            self._histograms = {}
+            thread = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            thread.start()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._check_process()
+            key = _key(name, labels)
+            self._values[key] = self._values.get(key, 0) + amount
+            self._dirty = True
+
+    def dec(self, name, amount=1, **labels):
+        self.inc(name, -amount, **labels)
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._check_process()
+            self._values[_key(name, labels)] = value
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        with self._lock:
+            self._check_process()
+            key = _key(name, labels)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+            self._dirty = True
+
+    def track(self, name, **labels):
+        """上下文管理器：进入时gauge+1，退出时-1（活跃连接/下载数）"""
+        registry = self
+
+        class _Tracker(object):
+            def __enter__(self):
+                registry.inc(name, **labels)
+
+            def __exit__(self, *exc):
+                registry.dec(name, **labels)
+
+        return _Tracker()
+
+    def timer(self, name, **labels):
+        """上下文管理器：退出时把耗时记入histogram"""
+        registry = self
+
+        class _Timer(object):
+            def __enter__(self):
+                self.start = time.time()
+
+            def __exit__(self, *exc):
+                registry.observe(name, time.time() - self.start, **labels)
+
+        return _Timer()
+
+    # -------------------------- 落盘 --------------------------
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self._pid != os.getpid():
+                return
+            data = {
+                "pid": self._pid,
+                "start_time": self._start_time,
+                "values": dict(self._values),
+                "histograms": {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}
+                               for k, v in self._histograms.items()},
+            }
+            self._dirty = False
+        path = os.path.join(self.directory, f"{data['pid']}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    # -------------------------- 汇总 --------------------------
+    @staticmethod
+    def _merge(total, data, value_filter=None):
+        for key, value in data.get("values", {}).items():
+            if value_filter and not value_filter(key):
+                continue
+            total["values"][key] = total["values"].get(key, 0) + value
+        for key, hist in data.get("histograms", {}).items():
+            agg = total["histograms"].get(key)
+            if agg is None or len(agg["buckets"]) != len(hist["buckets"]):
+                total["histograms"][key] = {"buckets": list(hist["buckets"]), "sum": hist["sum"],
+                                            "count": hist["count"]}
+                continue
+            agg["buckets"] = [a + b for a, b in zip(agg["buckets"], hist["buckets"])]
+            agg["sum"] += hist["sum"]
+            agg["count"] += hist["count"]
+
+    def _is_gauge_key(self, key):
+        name = json.loads(key)[0]
+        return self._definitions.get(name, (None,))[0] == GAUGE
+
+    def collect(self):
+        """汇总所有进程的数据；已退出进程的counter/histogram归档，gauge丢弃"""
+        self.flush()
+        total = {"values": {}, "histograms": {}}
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        lock_path = os.path.join(self.directory, '.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                archive = {"values": {}, "histograms": {}}
+                if os.path.exists(archive_path):
+                    with open(archive_path) as f:
+                        archive = json.load(f)
+                archive_changed = False
+                for file_name in os.listdir(self.directory):
+                    if not file_name.endswith('.json') or file_name == ARCHIVE_FILE:
+                        continue
+                    path = os.path.join(self.directory, file_name)
+                    try:
+                        with open(path) as f:
+                            data = json.load(f)
+                    except (IOError, OSError, ValueError):
+                        continue
+                    if _pid_alive(data.get("pid", 0), data.get("start_time")):
+                        self._merge(total, data)
+                    else:
+                        self._merge(archive, data, value_filter=lambda k: not self._is_gauge_key(k))
+                        archive_changed = True
+                        os.remove(path)
+                if archive_changed:
+                    with open(archive_path + '.tmp', 'w') as f:
+                        json.dump(archive, f)
+                    os.replace(archive_path + '.tmp', archive_path)
+                self._merge(total, archive)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return total
+
+    def get_value(self, total, name, **labels):
+        return total["values"].get(_key(name, labels), 0)
+
+    def exposition(self):
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        total = self.collect()
+        samples = {}   # name -> [(labels pairs, value)]
+        for key, value in total["values"].items():
+            name, pairs = json.loads(key)
+            samples.setdefault(name, []).append((pairs, value))
+        hists = {}
+        for key, hist in total["histograms"].items():
+            name, pairs = json.loads(key)
+            hists.setdefault(name, []).append((pairs, hist))
+
+        extra = {}
+        for collector in self._collectors:
+            for name, metric_type, help_text, labels, value in collector(total):
+                extra.setdefault(name, (metric_type, help_text, []))[2].append((sorted(labels.items()), value))
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == HISTOGRAM:
+                for pairs, hist in sorted(hists.get(name, []), key=lambda x: x[0]):
+                    for bound, count in zip(buckets, hist["buckets"]):
+                        le = pairs + [["le", _format_value(bound)]]
+                        lines.append(f"{name}_bucket{_format_labels(le)} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(pairs + [['le', '+Inf']])} {hist['count']}")
+                    lines.append(f"{name}_sum{_format_labels(pairs)} {_format_value(hist['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(pairs)} {hist['count']}")
+            else:
+                for pairs, value in sorted(samples.get(name, []), key=lambda x: x[0]):
+                    lines.append(f"{name}{_format_labels(pairs)} {_format_value(value)}")
+        for name, (metric_type, help_text, values) in sorted(extra.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for pairs, value in values:
+                lines.append(f"{name}{_format_labels(pairs)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
@@ -11,8 +11,8 @@ WHITE='\033[1;37m'    # 白色：标题/强调文本
 CYAN='\033[0;36m'     # 青色：文件路径/URL高亮
 NC='\033[0m'          # 重置：恢复默认终端颜色
 
-# 项目基础目录（与其他脚本保持一致）
-BASE_DIR="/home/auto_packing_no_delete"
+# 项目基础目录（与其他脚本保持一致，可通过AUTO_PACKING_BASE_DIR覆盖）
+BASE_DIR="${AUTO_PACKING_BASE_DIR:-/home/auto_packing_no_delete}"
 # OSS路径（目标补丁包存放地址）
 OSS_PATH="oss://df-patch-no-delete/patch/6.6/6.6.9/latest/"
 # 临时下载目录（存放下载的tar.gz包和解压文件，可定期清理）
@@ -22,6 +22,21 @@ LATEST_LIST_DIR="$BASE_DIR/latest_image_list"
 # 日志文件（统一存储到项目logs目录）
 LOG_FILE="$BASE_DIR/logs/oss_processor.log"
 
+# 镜像预取配置（镜像列表更新后，后台低优先级拉取新镜像到本地缓存）
+PREFETCH_ENABLED="${PREFETCH_ENABLED:-true}"
+PULL_SCRIPT="$BASE_DIR/pull_save.sh"
+IMAGE_TAR_DIR="$BASE_DIR/image_tar"
+PREFETCH_LOCK="$BASE_DIR/logs/prefetch.lock"
+PREFETCH_LOG="$BASE_DIR/logs/prefetch.log"
+PREFETCH_PENDING="$BASE_DIR/logs/prefetch.pending"     # 待预取标记（列表更新时写入，预取开始时删除）
+PREFETCH_LIST="$BASE_DIR/logs/prefetch_image_list.txt" # 预取开始时的列表副本（预取过程中列表再次更新不受影响）
+SCRIPT_PATH="$(readlink -f "${BASH_SOURCE[0]}")"
+SCRIPT_DIR="$(dirname "$SCRIPT_PATH")"
+PYTHON_BIN="${PYTHON_BIN:-$BASE_DIR/myenv/bin/python3}"
+if [ ! -x "$PYTHON_BIN" ]; then
+    PYTHON_BIN="python3"
+fi
+
 # 重试配置（应对网络波动）
 MAX_RETRIES=3    # 最大重试次数
 RETRY_DELAY=30   # 重试间隔（秒）
@@ -53,8 +68,75 @@ clean_temp_files() {
     log "${GREEN}临时目录清理完成${NC}"
 }
 
+##提交后台预取（低优先级，已缓存的镜像由pull_save.sh自动跳过，只拉取新增/变更的镜像）
+##先写入待预取标记再启动预取进程：已有预取在运行时新进程等待锁，取得锁后按当时的最新列表预取，
+##新列表不会因为旧预取未结束而被丢弃；等锁的多个进程中只有第一个执行（标记已被它删除）
+enqueue_prefetch() {
+    if [ "$PREFETCH_ENABLED" != "true" ]; then
+        log "${YELLOW}镜像预取已关闭（PREFETCH_ENABLED=$PREFETCH_ENABLED），跳过${NC}"
+        return 0
+    fi
+    if [ ! -f "$PULL_SCRIPT" ]; then
+        log "${YELLOW}警告：拉取脚本不存在，跳过预取：$PULL_SCRIPT${NC}"
+        return 0
+    fi
+
+    touch "$PREFETCH_PENDING"
+    # setsid + nohup：脱离当前会话，同步脚本退出后预取继续运行
+    setsid nohup /bin/bash "$SCRIPT_PATH" --prefetch >> "$PREFETCH_LOG" 2>&1 < /dev/null &
+    log "${GREEN}已提交后台镜像预取任务（PID：$!），日志：$PREFETCH_LOG${NC}"
+}
+
+##执行预取（oss_patch_processor.sh --prefetch，由enqueue_prefetch在后台启动）
+run_prefetch() {
+    # 同一时间只有一个预取：等待正在运行的预取结束（不放弃）
+    exec 9>> "$PREFETCH_LOCK"
+    flock 9
+    if [ ! -f "$PREFETCH_PENDING" ]; then
+        log "${YELLOW}最新镜像列表已由之前的预取处理，退出${NC}"
+        return 0
+    fi
+    # 先删标记再读取列表：之后的列表更新会重新写入标记，由下一个预取处理
+    rm -f "$PREFETCH_PENDING"
+    cp "$LATEST_LIST_DIR/patch_image_tag_list.txt" "$PREFETCH_LIST"
+    log "${YELLOW}开始预取镜像：$LATEST_LIST_DIR/patch_image_tag_list.txt（MD5：$(md5sum "$PREFETCH_LIST" | awk '{print $1}')）${NC}"
+
+    # 预取不经过构建进程的磁盘准入：先按列表中缺少的镜像估算写入量，空间不足（扣除保留空间）时不预取，
+    # 由构建时的磁盘准入回收空间后再拉取
+    local rc=0
+    "$PYTHON_BIN" "$SCRIPT_DIR/disk_admission.py" check -f "$PREFETCH_LIST" -d "$IMAGE_TAR_DIR" || rc=$?
+    if [ $rc -ne 0 ]; then
+        if [ $rc -eq 3 ]; then
+            log "${YELLOW}警告：磁盘可用空间不足，跳过本次预取（构建时按磁盘准入回收空间后再拉取）${NC}"
+        else
+            log "${YELLOW}警告：磁盘空间检查失败（退出码$rc），跳过本次预取${NC}"
+        fi
+        return 0
+    fi
+
+    # 降低CPU/IO优先级，避免与前台构建争抢资源；拉取进程不继承锁文件描述符
+    local prio_cmd=(nice -n 19)
+    if command -v ionice &> /dev/null; then
+        prio_cmd+=(ionice -c 3)
+    fi
+    rc=0
+    "${prio_cmd[@]}" /bin/bash "$PULL_SCRIPT" -d "$IMAGE_TAR_DIR" -f "$PREFETCH_LIST" 9>&- || rc=$?
+    if [ $rc -eq 0 ]; then
+        log "${GREEN}镜像预取完成${NC}"
+    else
+        log "${YELLOW}警告：镜像预取未全部完成（退出码$rc），缺少的镜像在构建时拉取${NC}"
+    fi
+}
+
 
 # ------------------------------ 主逻辑 ------------------------------
+# 后台预取模式（enqueue_prefetch 启动）
+if [ "${1:-}" = "--prefetch" ]; then
+    mkdir -p "$(dirname "$LOG_FILE")"
+    run_prefetch
+    exit 0
+fi
+
 # 1. 初始化目录（确保所有目录存在）
 log "===== 开始执行OSS补丁同步脚本 ====="
 mkdir -p "$DOWNLOAD_DIR" "$LATEST_LIST_DIR" "$(dirname "$LOG_FILE")"
@@ -168,6 +250,8 @@ if [ "$NEW_MD5" != "$EXISTING_MD5" ]; then
     log "  - 旧MD5：$EXISTING_MD5"
     log "  - 新MD5：$NEW_MD5"
     log "  - 输出路径：$LATEST_LIST_DIR/patch_image_tag_list.txt"
+    # 新列表生效后立即预取镜像，首次构建只需打包
+    enqueue_prefetch
 else
     # MD5相同，无需更新
     log "${YELLOW}镜像列表文件无更新（MD5一致），跳过覆盖${NC}"
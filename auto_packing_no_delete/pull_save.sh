@@ -12,8 +12,8 @@ CYAN='\033[0;36m'
 BOLD='\033[1m'
 NC='\033[0m'        # 恢复默认
 
-# 项目基础目录（与app.py保持一致）
-BASE_DIR="/home/auto_packing_no_delete"
+# 项目基础目录（与app.py保持一致，app.py调用时通过AUTO_PACKING_BASE_DIR传入）
+BASE_DIR="${AUTO_PACKING_BASE_DIR:-/home/auto_packing_no_delete}"
 # 默认镜像列表文件（由oss脚本生成）
 DEFAULT_IMAGE_LIST="$BASE_DIR/latest_image_list/patch_image_tag_list.txt"
 # 日志文件（统一存储到项目logs目录）
@@ -23,9 +23,44 @@ LOG_FILE="$BASE_DIR/logs/pull_save.log"
 #container_cmd="docker"
 container_cmd="nerdctl"
 # 镜像仓库前缀（默认DeepFlow仓库）
-repo="hub.deepflow.yunshan.net/dev/"
+repo="${IMAGE_REPO:-hub.deepflow.yunshan.net/dev/}"
+# 仓库地址与账号（可通过环境变量覆盖）
+REGISTRY_HOST="${REGISTRY_HOST:-hub.deepflow.yunshan.net}"
+REGISTRY_USERNAME="${REGISTRY_USERNAME:-acrpush@yunshan}"
+REGISTRY_PASSWORD="${REGISTRY_PASSWORD:-35lRrgBcLhF}"
+# 登录状态复用：nerdctl登录凭证（docker config）在有效期内不再重复登录，registry方式的token缓存到文件
+# 并发构建共用同一份登录状态（flock保证同一时间只有一个进程登录/获取token）
+REGISTRY_AUTH_DIR="${REGISTRY_AUTH_DIR:-$BASE_DIR/registry_auth}"
+REGISTRY_LOGIN_TTL="${REGISTRY_LOGIN_TTL:-43200}"   # 登录有效期（秒，超过后重新登录）
+export REGISTRY_TOKEN_CACHE="${REGISTRY_TOKEN_CACHE:-$REGISTRY_AUTH_DIR/tokens.json}"
+# 认证失败的输出特征（出现时重新登录后立即重试）
+AUTH_ERROR_PATTERN='401 Unauthorized|unauthorized|authentication required|denied: requested access'
+# 拉取方式：nerdctl（pull + save，经过containerd）/ registry（registry_client.py直接下载blob写出tar）
+pull_backend="${PULL_BACKEND:-nerdctl}"
 # 镜像保存目录（默认空，需通过--dir指定）
 save_dir=""
+# 镜像列表解析器（与app.py共用，一次进程解析整个列表）
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+IMAGE_LIST_PARSER="$SCRIPT_DIR/image_list.py"
+# 仓库客户端（registry拉取方式）
+REGISTRY_CLIENT="$SCRIPT_DIR/registry_client.py"
+# blob存储（按sha256保存layer，所有镜像和升级包共用；BLOB_STORE_ENABLED=0 关闭）
+BLOB_STORE_CLI="$SCRIPT_DIR/blob_store.py"
+BLOB_STORE_DIR="${BLOB_STORE_DIR:-$BASE_DIR/blobs}"
+BLOB_STORE_ENABLED="${BLOB_STORE_ENABLED:-1}"
+# 失败重试（单个镜像的pull/save失败时按指数退避+随机抖动重试）
+PULL_RETRIES="${PULL_RETRIES:-3}"              # 每个命令最多执行次数
+PULL_BACKOFF_BASE="${PULL_BACKOFF_BASE:-2}"    # 第一次重试前等待秒数（之后每次翻倍）
+PULL_BACKOFF_MAX="${PULL_BACKOFF_MAX:-60}"     # 单次等待上限（秒）
+# 单个命令的超时（秒，超时后终止卡住的 pull/save 进程并按失败重试）
+PULL_TIMEOUT="${PULL_TIMEOUT:-1200}"
+SAVE_TIMEOUT="${SAVE_TIMEOUT:-1200}"
+# 失败处理策略：continue（继续处理其余镜像，最后统一重试失败的镜像）/ fail-fast（第一个失败即退出）
+failure_policy="${PULL_FAILURE_POLICY:-continue}"
+PYTHON_BIN="${PYTHON_BIN:-$BASE_DIR/myenv/bin/python3}"
+if [ ! -x "$PYTHON_BIN" ]; then
+    PYTHON_BIN="python3"
+fi
 
 
 # ------------------------------ 工具函数 ------------------------------
@@ -48,7 +83,9 @@ show_help() {
     echo -e "${WHITE}选项说明:${NC}"
     echo -e "  ${GREEN}-h, --help     ${NC}显示此帮助信息"
     echo -e "  ${GREEN}-c, --cmd      ${NC}指定容器工具（${BOLD}docker${NC}/${BOLD}nerdctl${NC}，默认docker）"
+    echo -e "  ${GREEN}-b, --backend  ${NC}拉取方式（${BOLD}nerdctl${NC}：pull+save / ${BOLD}registry${NC}：直接从仓库下载，不经过containerd，默认nerdctl）"
     echo -e "  ${GREEN}-d, --dir      ${NC}指定镜像保存目录（必填，例如：$BASE_DIR/image_tar）"
+    echo -e "  ${GREEN}-p, --policy   ${NC}失败处理策略（${BOLD}continue${NC}：处理完其余镜像后重试失败的镜像 / ${BOLD}fail-fast${NC}：立即退出，默认continue）"
     echo -e "  ${GREEN}-f, --file     ${NC}指定镜像列表文件（默认：$DEFAULT_IMAGE_LIST）\n"
     
     echo -e "${WHITE}使用示例:${NC}"
@@ -69,56 +106,264 @@ show_help() {
     exit 0
 }
 
+##登录记录文件（按仓库地址和账号区分，mtime为登录时间）
+login_stamp_file() {
+    echo "$REGISTRY_AUTH_DIR/login_${REGISTRY_HOST//[^A-Za-z0-9._-]/_}_${REGISTRY_USERNAME//[^A-Za-z0-9._-]/_}"
+}
+
+##已有可用的登录凭证：登录记录比 $1（时间戳，默认为有效期起点）新，且容器工具的配置中有该仓库的凭证
+login_reusable() {
+    local since="${1:-$(( $(date +%s) - REGISTRY_LOGIN_TTL ))}"
+    local stamp
+    stamp="$(login_stamp_file)"
+    [ -f "$stamp" ] || return 1
+    [ "$(stat -c %Y "$stamp")" -gt "$since" ] || return 1
+    local config="${DOCKER_CONFIG:-$HOME/.docker}/config.json"
+    [ -f "$config" ] && grep -qE "\"$REGISTRY_HOST\"|\"credsStore\"" "$config"
+}
+
 ##镜像仓库登录（使用预设账号密码）
+##有效期内的登录凭证直接复用；$1 为认证失败的时间戳时强制重新登录（其他进程在此之后已重新登录的除外）
 repo_login() {
-    log "${YELLOW}开始登录镜像仓库：hub.deepflow.yunshan.net${NC}"
+    local failed_at="${1:-}"
     # 检查容器工具是否存在
     if ! command -v "$container_cmd" &> /dev/null; then
         log "${RED}错误：容器工具 $container_cmd 未安装或未配置到环境变量${NC}"
-        exit 1
+        return 1
     fi
+    mkdir -p "$REGISTRY_AUTH_DIR"
+    chmod 700 "$REGISTRY_AUTH_DIR"
 
-    # 执行登录（密码通过管道传递，避免明文暴露）
-    if ! echo "35lRrgBcLhF" | "$container_cmd" login --username=acrpush@yunshan --password-stdin hub.deepflow.yunshan.net; then
+    local rc=0
+    (
+        # 并发构建串行登录：等锁期间其他进程完成的登录可以直接复用
+        if command -v flock &> /dev/null; then
+            flock 9
+        fi
+        if login_reusable ${failed_at:+"$failed_at"}; then
+            log "${GREEN}复用已有的仓库登录凭证：$REGISTRY_HOST${NC}"
+            exit 0
+        fi
+        log "${YELLOW}开始登录镜像仓库：$REGISTRY_HOST${NC}"
+        # 执行登录（密码通过管道传递，避免明文暴露）
+        if ! echo "$REGISTRY_PASSWORD" | "$container_cmd" login --username="$REGISTRY_USERNAME" --password-stdin "$REGISTRY_HOST"; then
+            exit 1
+        fi
+        touch "$(login_stamp_file)"
+        log "${GREEN}仓库登录成功${NC}"
+    ) 9>"$REGISTRY_AUTH_DIR/login.lock" || rc=$?
+    if [ $rc -ne 0 ]; then
         log "${RED}错误：仓库登录失败！请检查账号密码或网络连接${NC}"
-        exit 1
+        return 1
     fi
-    log "${GREEN}仓库登录成功${NC}"
 }
 
-##拉取并保存单个镜像
+##带超时和重试执行命令：run_with_retry <描述> <超时秒数> <命令...>
+##失败后等待 min(基数×2^(n-1), 上限) 秒再加0~50%随机抖动（多个构建同时重试时错开），全部失败返回1
+run_with_retry() {
+    local desc="$1"
+    local timeout_seconds="$2"
+    shift 2
+    local attempt=1
+    local rc delay started
+    local output_file
+    output_file="$(mktemp)"
+    while true; do
+        rc=0
+        started=$(date +%s)
+        # 输出同时写入临时文件，用于识别认证失败
+        if command -v timeout &> /dev/null; then
+            # 超时先发SIGTERM，30秒后仍未退出则SIGKILL
+            timeout --kill-after=30 "$timeout_seconds" "$@" 2>&1 | tee "$output_file" || rc=$?
+        else
+            "$@" 2>&1 | tee "$output_file" || rc=$?
+        fi
+        if [ $rc -eq 0 ]; then
+            rm -f "$output_file"
+            return 0
+        fi
+        if [ $rc -eq 124 ] || [ $rc -eq 137 ]; then
+            log "${YELLOW}警告：${desc}超时（${timeout_seconds}秒），已终止${NC}"
+        fi
+        if [ $attempt -ge "$PULL_RETRIES" ]; then
+            log "${RED}错误：${desc}失败（已尝试${attempt}次，退出码$rc）${NC}"
+            rm -f "$output_file"
+            return 1
+        fi
+        # 登录凭证失效（密码修改、凭证被清理）：重新登录后立即重试
+        if [ "$pull_backend" = "nerdctl" ] && grep -qiE "$AUTH_ERROR_PATTERN" "$output_file"; then
+            log "${YELLOW}警告：${desc}认证失败，重新登录镜像仓库后重试${NC}"
+            if repo_login "$started"; then
+                attempt=$((attempt + 1))
+                continue
+            fi
+        fi
+        delay=$(( PULL_BACKOFF_BASE * (1 << (attempt - 1)) ))
+        if [ $delay -gt "$PULL_BACKOFF_MAX" ]; then
+            delay=$PULL_BACKOFF_MAX
+        fi
+        delay=$(( delay + RANDOM % (delay / 2 + 1) ))
+        log "${YELLOW}警告：${desc}失败（第${attempt}/${PULL_RETRIES}次，退出码$rc），${delay}秒后重试${NC}"
+        sleep "$delay"
+        attempt=$((attempt + 1))
+    done
+}
+
+##拉取并保存单个镜像（失败返回1，由调用方按失败处理策略决定是否继续）
 pull_and_save_single() {
     local full_image_name="$1"
-    
+    # 保存文件名由image_list.py统一生成（示例：deepflow-server_v6.6.5550.tar）
+    local save_file="$save_dir/$2"
+    # 临时文件带PID后缀，避免与后台预取/其他构建同时保存同一镜像时互相覆盖
+    local partial_file="${save_file}.partial.$$"
+
+    # 0. 命中本地缓存（预取或历史构建已保存完整tar）则跳过拉取和保存
+    if [ -s "$save_file" ]; then
+        log "${CYAN}镜像已缓存，跳过拉取：$save_file${NC}"
+        return 0
+    fi
+    # blob存储中已有该镜像的全部blob：直接生成tar，不访问仓库
+    if [ "$BLOB_STORE_ENABLED" = "1" ] && "$PYTHON_BIN" "$REGISTRY_CLIENT" materialize \
+            --blob-store "$BLOB_STORE_DIR" --name "$2" --ref "$full_image_name" -o "$partial_file"; then
+        mv -f "$partial_file" "$save_file"
+        log "${CYAN}镜像已缓存（blob存储），跳过拉取：$save_file${NC}"
+        return 0
+    fi
+
+    if [ "$pull_backend" = "registry" ]; then
+        pull_via_registry "$full_image_name" "$save_file" "$partial_file"
+        return $?
+    fi
+
     # 1. 拉取镜像
     log "${GREEN}开始拉取镜像：$full_image_name${NC}"
-    if ! "$container_cmd" pull "$full_image_name"; then
+    if ! run_with_retry "拉取镜像$full_image_name" "$PULL_TIMEOUT" "$container_cmd" pull "$full_image_name"; then
         log "${RED}错误：拉取镜像失败：$full_image_name${NC}"
-        exit 1
+        return 1
     fi
     log "${GREEN}镜像拉取成功：$full_image_name${NC}"
 
-    # 2. 提取镜像名和标签（处理特殊字符，避免文件名异常）
-    # 示例：hub.deepflow.yunshan.net/dev/deepflow-server:v6.6.5550 → 提取为 deepflow-server_v6.6.5550.tar
-    local image_name=$(echo "$full_image_name" | awk -F':' '{print $1}' | awk -F'/' '{print $NF}' | sed 's/[^a-zA-Z0-9_-]//g')
-    local image_tag=$(echo "$full_image_name" | awk -F':' '{print $2}' | sed 's/[^a-zA-Z0-9._-]//g')
-    local save_file="$save_dir/${image_name}_${image_tag}.tar"
-
-    # 3. 保存镜像为tar文件
+    # 2. 保存镜像为tar文件（先写临时文件，成功后原子重命名，保证缓存中只有完整tar）
     log "${GREEN}开始保存镜像到：$save_file${NC}"
-    if ! "$container_cmd" save -o "$save_file" "$full_image_name"; then
+    if ! run_with_retry "保存镜像$full_image_name" "$SAVE_TIMEOUT" \
+            "$container_cmd" save -o "$partial_file" "$full_image_name"; then
         log "${RED}错误：保存镜像失败：$full_image_name${NC}"
-        # 清理失败的空文件
-        if [ -f "$save_file" ]; then
-            rm -f "$save_file"
-            log "${YELLOW}已清理无效文件：$save_file${NC}"
+        # 清理失败的临时文件
+        if [ -f "$partial_file" ]; then
+            rm -f "$partial_file"
+            log "${YELLOW}已清理无效文件：$partial_file${NC}"
+        fi
+        return 1
+    fi
+
+    # 3. layer存入blob存储（后续版本中相同的layer不再重复保存；失败不影响本次构建）。
+    #    文件系统支持reflink时由存储重新生成镜像tar，layer与存储共享数据块，镜像在磁盘上只占一份；
+    #    不支持时保留 nerdctl save 的tar（与存储各占一份，磁盘不足时由 disk_admission.py 回收可由存储重新生成的tar）。
+    #    在宣告保存成功之前完成，之后读取镜像tar的校验、打包不会读到被替换的文件
+    if [ "$BLOB_STORE_ENABLED" = "1" ]; then
+        if ! "$PYTHON_BIN" "$BLOB_STORE_CLI" --root "$BLOB_STORE_DIR" ingest "$partial_file" \
+                --name "$2" --ref "$full_image_name"; then
+            log "${YELLOW}警告：镜像存入blob存储失败：$save_file${NC}"
+        elif "$PYTHON_BIN" "$REGISTRY_CLIENT" materialize --clone-only --blob-store "$BLOB_STORE_DIR" \
+                --name "$2" --ref "$full_image_name" -o "${partial_file}.store" 2>/dev/null; then
+            mv -f "${partial_file}.store" "$partial_file"
+        else
+            rm -f "${partial_file}.store"
         fi
-        exit 1
     fi
+    mv -f "$partial_file" "$save_file" || return 1
     log "${GREEN}镜像保存成功：$save_file${NC}"
 }
 
-##从列表文件拉取镜像（支持两种格式：name: tag / name_tag: tag）
+##直接从仓库下载镜像并写出tar（manifest/blob直接写入tar，不经过containerd，也不需要nerdctl save）
+pull_via_registry() {
+    local full_image_name="$1"
+    local save_file="$2"
+    local partial_file="$3"
+
+    local -a store_args=()
+    if [ "$BLOB_STORE_ENABLED" = "1" ]; then
+        # 已在blob存储中的layer不再下载
+        store_args=(--blob-store "$BLOB_STORE_DIR" --name "$(basename "$save_file")")
+    fi
+
+    log "${GREEN}开始拉取镜像：$full_image_name${NC}"
+    # 账号密码通过环境变量传给客户端（不出现在进程参数中）
+    # 重试时已存入blob存储的layer不会重复下载
+    if ! REGISTRY_USERNAME="$REGISTRY_USERNAME" REGISTRY_PASSWORD="$REGISTRY_PASSWORD" \
+            run_with_retry "拉取镜像$full_image_name" "$PULL_TIMEOUT" \
+            "$PYTHON_BIN" "$REGISTRY_CLIENT" pull "$full_image_name" -o "$partial_file" \
+            ${store_args[@]+"${store_args[@]}"}; then
+        log "${RED}错误：拉取镜像失败：$full_image_name${NC}"
+        rm -f "$partial_file"
+        return 1
+    fi
+    log "${GREEN}镜像拉取成功：$full_image_name${NC}"
+    # 下载时已写成完整tar，保存只需原子重命名
+    log "${GREEN}开始保存镜像到：$save_file${NC}"
+    mv -f "$partial_file" "$save_file" || return 1
+    log "${GREEN}镜像保存成功：$save_file${NC}"
+}
+
+##解析镜像列表并逐个拉取（参数原样传给image_list.py：-f 列表文件 或 镜像名列表）
+##解析器输出：I<TAB>完整镜像地址<TAB>保存文件名 / W<TAB>行号<TAB>诊断信息
+pull_parsed() {
+    local parsed
+    if ! parsed=$("$PYTHON_BIN" "$IMAGE_LIST_PARSER" --repo "$repo" "$@"); then
+        log "${RED}错误：镜像列表解析失败：$parsed${NC}"
+        exit 1
+    fi
+
+    local kind field1 field2
+    local -a images=()
+    local -a save_names=()
+    while IFS=$'\t' read -r kind field1 field2; do
+        case "$kind" in
+            I)
+                images+=("$field1")
+                save_names+=("$field2")
+                ;;
+            W)
+                log "${YELLOW}警告：$field2${NC}"
+                ;;
+        esac
+    done <<< "$parsed"
+
+    if [ ${#images[@]} -eq 0 ]; then
+        log "${RED}错误：没有可拉取的镜像${NC}"
+        exit 1
+    fi
+
+    local i
+    local -a failed=()
+    for i in "${!images[@]}"; do
+        if ! pull_and_save_single "${images[$i]}" "${save_names[$i]}"; then
+            if [ "$failure_policy" = "fail-fast" ]; then
+                log "${RED}错误：镜像处理失败：${images[$i]}（fail-fast，停止处理其余镜像）${NC}"
+                exit 1
+            fi
+            log "${YELLOW}警告：镜像处理失败：${images[$i]}，继续处理其余镜像，最后统一重试${NC}"
+            failed+=("$i")
+        fi
+    done
+
+    # 统一重试失败的镜像（其余镜像已完成，网络的短暂故障多半已恢复）
+    if [ ${#failed[@]} -gt 0 ]; then
+        log "${YELLOW}开始重试失败的镜像（${#failed[@]}个）${NC}"
+        local -a still_failed=()
+        for i in "${failed[@]}"; do
+            if ! pull_and_save_single "${images[$i]}" "${save_names[$i]}"; then
+                still_failed+=("${images[$i]}")
+            fi
+        done
+        if [ ${#still_failed[@]} -gt 0 ]; then
+            log "${RED}错误：以下${#still_failed[@]}个镜像拉取失败：${still_failed[*]}${NC}"
+            exit 1
+        fi
+    fi
+}
+
+##从列表文件拉取镜像（支持两种格式：name: tag / name_tag: tag，以及digest和行内注释）
 pull_from_file() {
     local image_list_path="$1"
     
@@ -130,37 +375,7 @@ pull_from_file() {
     log "${YELLOW}开始从列表文件拉取镜像：$image_list_path${NC}"
     log "${YELLOW}镜像保存目录：$save_dir${NC}"
 
-    # 逐行处理列表文件
-    while IFS= read -r line || [[ -n "$line" ]]; do
-        # 跳过空行和注释（支持开头带空格的注释）
-        if [[ -z "$line" || "$line" =~ ^[[:space:]]*# ]]; then
-            continue
-        fi
-
-        # 解析镜像名和标签（兼容两种格式）
-        if [[ "$line" =~ _tag:[[:space:]]* ]]; then
-            # 格式1：name_tag: vx.x.x → 提取为 name: vx.x.x
-            image_name=$(echo "$line" | sed 's/_tag:[[:space:]]*v[0-9].*//' | xargs)
-            image_tag=$(echo "$line" | grep -oP '_tag:[[:space:]]*\Kv?[0-9.]+' | xargs)
-        else
-            # 格式2：name: vx.x.x → 直接分割
-            image_name=$(echo "$line" | awk -F':' '{print $1}' | xargs)
-            image_tag=$(echo "$line" | awk -F':' '{print $2}' | xargs)
-        fi
-
-        # 校验解析结果（跳过格式错误的行）
-        if [[ -z "$image_name" || -z "$image_tag" ]]; then
-            log "${YELLOW}警告：跳过无效行（格式错误）：$line${NC}"
-            continue
-        fi
-
-        # 构建完整镜像名（去掉 _tag 后缀，添加仓库前缀）
-        clean_image_name=$(echo "$image_name" | sed 's/_tag$//')
-        full_image_name="${repo}${clean_image_name}:${image_tag}"
-
-        # 调用单镜像处理函数
-        pull_and_save_single "$full_image_name"
-    done < "$image_list_path"
+    pull_parsed -f "$image_list_path"
 }
 
 
@@ -181,6 +396,17 @@ while [[ $# -gt 0 ]]; do
             log "${YELLOW}已指定容器工具：$container_cmd${NC}"
             shift 2
             ;;
+        -b|--backend)
+            # 指定拉取方式（nerdctl/registry）
+            pull_backend="$2"
+            log "${YELLOW}已指定拉取方式：$pull_backend${NC}"
+            shift 2
+            ;;
+        -p|--policy)
+            # 指定失败处理策略（continue/fail-fast）
+            failure_policy="$2"
+            shift 2
+            ;;
         -d|--dir)
             # 指定镜像保存目录（必填）
             save_dir="$2"
@@ -221,8 +447,19 @@ if [ -z "$save_dir" ]; then
     exit 1
 fi
 
-# 登录仓库（所有拉取流程的前置操作）
-repo_login
+# 登录仓库（nerdctl拉取方式的前置操作；registry方式由客户端按需获取token）
+case "$pull_backend" in
+    nerdctl)
+        repo_login || exit 1
+        ;;
+    registry)
+        log "${YELLOW}拉取方式：直接从仓库下载（$REGISTRY_CLIENT）${NC}"
+        ;;
+    *)
+        log "${RED}错误：未知的拉取方式：$pull_backend（可选 nerdctl / registry）${NC}"
+        exit 1
+        ;;
+esac
 
 # 分支逻辑：按不同模式执行拉取
 if [ $# -eq 0 ]; then
@@ -231,17 +468,8 @@ if [ $# -eq 0 ]; then
 else
     # 模式2：有额外参数 → 按指定镜像拉取（自动补仓库前缀）
     log "${YELLOW}开始处理指定镜像列表：$*${NC}"
-    for image in "$@"; do
-        # 若镜像名不含仓库地址，自动添加默认前缀
-        if [[ ! "$image" =~ ^hub\.deepflow\.yunshan\.net ]]; then
-            full_image="${repo}${image}"
-            log "${YELLOW}自动添加仓库前缀：$image → $full_image${NC}"
-        else
-            full_image="$image"
-        fi
-        # 调用单镜像处理函数
-        pull_and_save_single "$full_image"
-    done
+    # 不含仓库地址的镜像名由解析器自动添加默认前缀
+    pull_parsed "$@"
 fi
 
 # 流程结束
@@ -0,0 +1,755 @@
+"""镜像仓库客户端：不经过 nerdctl/containerd，直接从仓库下载 manifest 和 blob，写出可直接 nerdctl load 的镜像tar
+
+nerdctl pull + nerdctl save 会把每个layer写两遍（containerd内容存储一遍、导出tar一遍），且需要root和登录。
+本客户端：
+    - 按仓库地址复用HTTP长连接（连接池），token按仓库scope缓存到过期前
+    - 指定 REGISTRY_TOKEN_CACHE 时token同时缓存到文件（flock保护），多次运行、并发构建共用，
+      过期前或收到401时才重新获取
+    - 多个layer并发下载，直接写入预先算好偏移的tar中（每个layer只落盘一次），边下载边校验sha256
+    - 输出格式与 nerdctl save 相同（OCI layout + docker manifest.json），nerdctl load / docker load 均可加载
+    - 使用blob存储（blob_store.py）时，已有的layer不再下载，镜像tar从存储生成：layer数据在tar中按4KB对齐，
+      XFS/btrfs 上用reflink与存储中的blob共享数据块（镜像在磁盘上只占一份），不支持reflink时由内核复制
+
+命令行（pull_save.sh 在 PULL_BACKEND=registry 时调用，账号密码通过环境变量传入）：
+    python3 registry_client.py pull hub.deepflow.yunshan.net/dev/deepflow-server:v6.6.5550 -o deepflow-server_v6.6.5550.tar \\
+        [--blob-store blobs --name deepflow-server_v6.6.5550.tar]
+    python3 registry_client.py materialize --blob-store blobs --name deepflow-server_v6.6.5550.tar -o out.tar [--clone-only]
+
+环境变量：
+    REGISTRY_USERNAME / REGISTRY_PASSWORD  仓库账号
+    REGISTRY_PLAIN_HTTP                    使用http访问的仓库地址，逗号分隔（localhost/127.0.0.1 默认使用http）
+    REGISTRY_CONCURRENCY                   单个镜像同时下载的blob数（默认4）
+    REGISTRY_TOKEN_CACHE                   token缓存文件（默认不缓存到文件）
+"""
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import re
+import ssl
+import struct
+import sys
+import tarfile
+import threading
+import time
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from blob_store import BlobStore, BlobStoreError, IMAGE_REFS
+from zip_package import ALIGNMENT, FICLONERANGE
+
+DOCKER_MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+DOCKER_MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+MANIFEST_ACCEPT = ', '.join((DOCKER_MANIFEST, OCI_MANIFEST, DOCKER_MANIFEST_LIST, OCI_INDEX))
+
+DEFAULT_PLATFORM = 'linux/amd64'
+DEFAULT_CONCURRENCY = int(os.environ.get('REGISTRY_CONCURRENCY', 4))
+HTTP_TIMEOUT = 60           # 单次读写超时（秒）
+MAX_IDLE_CONNECTIONS = 8    # 每个仓库地址保留的空闲连接数
+MAX_REDIRECTS = 5
+TOKEN_EXPIRY_MARGIN = 30    # token提前过期的秒数（避免下载途中过期）
+CHUNK = 1024 * 1024
+
+_CHALLENGE_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+class RegistryError(Exception):
+    """仓库请求失败（认证失败、镜像不存在、内容校验失败等）"""
+
+
+def parse_reference(ref):
+    """完整镜像地址 → (仓库地址, 镜像路径, tag或digest)；同时带tag和digest时按digest拉取"""
+    name, _, digest = ref.partition('@')
+    registry, sep, path = name.partition('/')
+    if not sep or not ('.' in registry or ':' in registry or registry == 'localhost'):
+        raise RegistryError(f"镜像地址缺少仓库地址：{ref}")
+    tag = None
+    if ':' in path.rsplit('/', 1)[-1]:
+        path, tag = path.rsplit(':', 1)
+    if not path:
+        raise RegistryError(f"镜像地址格式错误：{ref}")
+    return registry, path, digest or tag or 'latest'
+
+
+# ---------- HTTP连接池 ----------
+class ConnectionPool(object):
+    """按 (scheme, host) 复用HTTP长连接（同一镜像的manifest、config、layer共用连接，省去重复的TCP/TLS握手）"""
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, timeout=HTTP_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def _connect(self, key):
+        scheme, host = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def request(self, method, url, headers):
+        """发送请求，返回 (响应, 归还函数)；响应体读完后调用归还函数，连接回到池中"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # 空闲连接已被服务端关闭，换新连接重试一次
+                conn.close()
+                conn = None
+        if conn is None:
+            conn = self._connect(key)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                raise RegistryError(f"请求失败：{method} {url}（{e}）")
+
+        def release():
+            if response.isclosed() and not response.will_close:
+                with self._lock:
+                    idle = self._idle.setdefault(key, [])
+                    if len(idle) < self.max_idle:
+                        idle.append(conn)
+                        return
+            conn.close()
+        return response, release
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+# ---------- token文件缓存 ----------
+class TokenCache(object):
+    """Bearer token 的文件缓存：{"账号@仓库地址/镜像路径": {"auth", "expires"}}，权限0600
+
+    获取token时持有文件锁：并发构建同时发现token过期时只有一个去仓库获取，其余等锁后直接读取新token。
+    只缓存有过期时间的Bearer token，Basic凭证（含密码）不落盘。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """未过期的token，返回 (Authorization头, 过期时间)，没有时返回None"""
+        entry = self._load().get(key)
+        if entry and entry.get('expires', 0) > time.time():
+            return entry['auth'], entry['expires']
+        return None
+
+    def put(self, key, auth, expires):
+        """写入token并清理已过期的条目（调用方持有锁）"""
+        now = time.time()
+        data = {k: v for k, v in self._load().items() if v.get('expires', 0) > now}
+        data[key] = {'auth': auth, 'expires': expires}
+        temp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+
+# ---------- 仓库客户端 ----------
+class RegistryClient(object):
+    """Docker Registry HTTP API v2 客户端（只读）"""
+
+    def __init__(self, username=None, password=None, plain_http=None, concurrency=DEFAULT_CONCURRENCY, pool=None,
+                 token_cache=None):
+        self.username = username if username is not None else os.environ.get('REGISTRY_USERNAME')
+        self.password = password if password is not None else os.environ.get('REGISTRY_PASSWORD')
+        if plain_http is None:
+            plain_http = [h.strip() for h in os.environ.get('REGISTRY_PLAIN_HTTP', '').split(',') if h.strip()]
+        self.plain_http = set(plain_http)
+        self.concurrency = max(int(concurrency), 1)
+        self.pool = pool or ConnectionPool()
+        self._tokens = {}   # (仓库地址, 镜像路径) -> (Authorization头, 过期时间)
+        self._lock = threading.Lock()
+        if token_cache is None and os.environ.get('REGISTRY_TOKEN_CACHE'):
+            token_cache = TokenCache(os.environ['REGISTRY_TOKEN_CACHE'])
+        self.token_cache = token_cache
+
+    def _base_url(self, registry):
+        host = registry.split(':', 1)[0]
+        plain = registry in self.plain_http or host in self.plain_http or host in ('localhost', '127.0.0.1')
+        return f"{'http' if plain else 'https'}://{registry}"
+
+    # ---------- 认证 ----------
+    def _basic_auth(self):
+        if not self.username:
+            return None
+        raw = f"{self.username}:{self.password or ''}".encode('utf-8')
+        return 'Basic ' + base64.b64encode(raw).decode('ascii')
+
+    def _cache_key(self, registry, repository):
+        return f"{self.username or ''}@{registry}/{repository}"
+
+    def _cached_auth(self, registry, repository):
+        with self._lock:
+            cached = self._tokens.get((registry, repository))
+        if cached and cached[1] > time.time():
+            return cached[0]
+        if self.token_cache is not None:
+            cached = self.token_cache.get(self._cache_key(registry, repository))
+            if cached:
+                with self._lock:
+                    self._tokens[(registry, repository)] = cached
+                return cached[0]
+        return None
+
+    def _authenticate(self, registry, repository, challenge, rejected=None):
+        """按401响应的 WWW-Authenticate 获取凭证（Bearer token 或 Basic），缓存到过期前；
+        rejected 为刚被拒绝的凭证，文件缓存中是同一个时不再使用"""
+        scheme = challenge.partition(' ')[0].lower()
+        if scheme != 'bearer' or self.token_cache is None:
+            return self._request_auth(registry, repository, challenge)
+        key = self._cache_key(registry, repository)
+        with self.token_cache.locked():
+            # 等锁期间其他进程可能已获取了新token
+            cached = self.token_cache.get(key)
+            if cached and cached[0] != rejected:
+                with self._lock:
+                    self._tokens[(registry, repository)] = cached
+                return cached[0]
+            auth = self._request_auth(registry, repository, challenge)
+            with self._lock:
+                expires = self._tokens[(registry, repository)][1]
+            self.token_cache.put(key, auth, expires)
+        return auth
+
+    def _request_auth(self, registry, repository, challenge):
+        scheme, _, params = challenge.partition(' ')
+        scheme = scheme.lower()
+        if scheme == 'basic':
+            auth, expires = self._basic_auth(), float('inf')
+            if auth is None:
+                raise RegistryError(f"仓库{registry}需要账号密码（REGISTRY_USERNAME/REGISTRY_PASSWORD）")
+        elif scheme == 'bearer':
+            params = dict(_CHALLENGE_PARAM_RE.findall(params))
+            if 'realm' not in params:
+                raise RegistryError(f"无法识别的认证要求：{challenge}")
+            query = {k: v for k, v in params.items() if k in ('service', 'scope')}
+            query.setdefault('scope', f"repository:{repository}:pull")
+            headers = {}
+            basic = self._basic_auth()
+            if basic:
+                headers['Authorization'] = basic
+            status, _, body = self._fetch('GET', f"{params['realm']}?{urlencode(query)}", headers)
+            if status != 200:
+                raise RegistryError(f"获取仓库token失败（HTTP {status}）：{body[:200]!r}")
+            data = json.loads(body.decode('utf-8'))
+            token = data.get('token') or data.get('access_token')
+            if not token:
+                raise RegistryError("仓库token响应中没有token")
+            auth = 'Bearer ' + token
+            expires = time.time() + max(int(data.get('expires_in') or 60) - TOKEN_EXPIRY_MARGIN, 10)
+        else:
+            raise RegistryError(f"不支持的认证方式：{challenge}")
+        with self._lock:
+            self._tokens[(registry, repository)] = (auth, expires)
+        return auth
+
+    # ---------- 请求 ----------
+    def _fetch(self, method, url, headers):
+        """读取完整响应体的请求（token、manifest、config等小对象）"""
+        response, release = self.pool.request(method, url, headers)
+        try:
+            body = response.read()
+        finally:
+            release()
+        return response.status, response.headers, body
+
+    def _open(self, registry, repository, path, headers=None):
+        """带认证和重定向的GET请求，返回 (响应, 归还函数)；非2xx时抛出 RegistryError"""
+        url = self._base_url(registry) + path
+        headers = dict(headers or {})
+        auth = self._cached_auth(registry, repository)
+        authenticated = False
+        for _ in range(MAX_REDIRECTS + 2):
+            request_headers = dict(headers)
+            if auth and urlsplit(url).netloc == registry:
+                request_headers['Authorization'] = auth
+            response, release = self.pool.request('GET', url, request_headers)
+            if response.status == 401 and not authenticated:
+                challenge = response.headers.get('WWW-Authenticate', '')
+                response.read()
+                release()
+                auth = self._authenticate(registry, repository, challenge, rejected=auth)
+                authenticated = True
+                continue
+            if response.status in (301, 302, 303, 307, 308):
+                # blob通常重定向到对象存储/CDN：其他主机不携带仓库凭证
+                location = response.headers.get('Location')
+                response.read()
+                release()
+                if not location:
+                    raise RegistryError(f"重定向缺少Location：{url}")
+                url = urljoin(url, location)
+                continue
+            if response.status >= 300:
+                body = response.read()
+                release()
+                raise RegistryError(f"请求失败（HTTP {response.status}）：{url} {body[:200]!r}")
+            return response, release
+        raise RegistryError(f"重定向或认证次数过多：{url}")
+
+    def _read(self, registry, repository, path, headers=None):
+        response, release = self._open(registry, repository, path, headers)
+        try:
+            return response.headers, response.read()
+        finally:
+            release()
+
+    # ---------- manifest / blob ----------
+    def get_manifest(self, registry, repository, reference, platform=DEFAULT_PLATFORM):
+        """返回 (manifest字节, mediaType, digest)；多架构镜像按platform选择对应的manifest"""
+        headers, body = self._read(registry, repository, f"/v2/{repository}/manifests/{reference}",
+                                   {'Accept': MANIFEST_ACCEPT})
+        manifest = json.loads(body.decode('utf-8'))
+        media_type = manifest.get('mediaType') or headers.get('Content-Type', '').split(';', 1)[0]
+        if media_type in (DOCKER_MANIFEST_LIST, OCI_INDEX) or 'manifests' in manifest:
+            descriptor = select_platform(manifest.get('manifests', []), platform)
+            if descriptor is None:
+                raise RegistryError(f"镜像{repository}:{reference}没有{platform}平台的manifest")
+            return self.get_manifest(registry, repository, descriptor['digest'], platform)
+        if manifest.get('schemaVersion') != 2 or 'layers' not in manifest:
+            raise RegistryError(f"不支持的manifest格式：{media_type}")
+        digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+        if reference.startswith('sha256:') and reference != digest:
+            raise RegistryError(f"manifest校验失败：期望{reference}，实际{digest}")
+        return body, media_type or DOCKER_MANIFEST, digest
+
+    def image_digests(self, registry, repository, reference, platform=DEFAULT_PLATFORM):
+        """镜像的digest（不下载layer）：引用指向的manifest/多架构index的digest、平台manifest的digest、配置digest（镜像ID）"""
+        _, body = self._read(registry, repository, f"/v2/{repository}/manifests/{reference}",
+                             {'Accept': MANIFEST_ACCEPT})
+        digests = ['sha256:' + hashlib.sha256(body).hexdigest()]
+        manifest = json.loads(body.decode('utf-8'))
+        if 'manifests' in manifest:
+            descriptor = select_platform(manifest['manifests'], platform)
+            if descriptor is None:
+                raise RegistryError(f"镜像{repository}:{reference}没有{platform}平台的manifest")
+            body, _, digest = self.get_manifest(registry, repository, descriptor['digest'], platform)
+            digests.append(digest)
+            manifest = json.loads(body.decode('utf-8'))
+        if manifest.get('config', {}).get('digest'):
+            digests.append(manifest['config']['digest'])
+        return digests
+
+    def get_blob(self, registry, repository, descriptor):
+        """下载小blob（镜像配置）到内存并校验"""
+        _, body = self._read(registry, repository, f"/v2/{repository}/blobs/{descriptor['digest']}")
+        verify_digest(descriptor, hashlib.sha256(body).hexdigest(), len(body))
+        return body
+
+    def download_blob(self, registry, repository, descriptor, fd, offset, cancelled=None):
+        """下载blob并写入文件fd的offset处（pwrite，多个blob可并发写同一文件），边写边校验sha256"""
+        response, release = self._open(registry, repository, f"/v2/{repository}/blobs/{descriptor['digest']}")
+        sha256 = hashlib.sha256()
+        written = 0
+        try:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise RegistryError("下载已取消")
+                chunk = response.read(CHUNK)
+                if not chunk:
+                    break
+                if written + len(chunk) > descriptor['size']:
+                    raise RegistryError(f"blob大小超出manifest声明：{descriptor['digest']}")
+                os.pwrite(fd, chunk, offset + written)
+                sha256.update(chunk)
+                written += len(chunk)
+        finally:
+            release()
+        verify_digest(descriptor, sha256.hexdigest(), written)
+        return written
+
+    # ---------- 拉取镜像 ----------
+    def _download_all(self, registry, repository, jobs):
+        """并发下载 [(描述符, fd, 偏移)]，任一失败时取消其余下载"""
+        if not jobs:
+            return
+        cancelled = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, len(jobs))) as pool:
+            futures = [pool.submit(self.download_blob, registry, repository, descriptor, fd, offset, cancelled)
+                       for descriptor, fd, offset in jobs]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                cancelled.set()
+                raise
+
+    def pull(self, ref, output_path, platform=DEFAULT_PLATFORM, store=None, name=None):
+        """拉取镜像并写出镜像tar，返回统计信息 {'digest', 'blobs', 'reused', 'bytes', 'downloaded', 'seconds'}
+
+        给出blob存储（store）时：已有的blob不再下载，新blob先存入存储，镜像引用记为name，
+        再从存储生成镜像tar；否则layer直接下载到tar中。
+        """
+        start = time.time()
+        registry, repository, reference = parse_reference(ref)
+        manifest_bytes, media_type, manifest_digest = self.get_manifest(registry, repository, reference, platform)
+        manifest = json.loads(manifest_bytes.decode('utf-8'))
+        layers = unique_layers(manifest['layers'])
+        stats = {
+            'digest': manifest_digest,
+            'blobs': len(layers) + 2,
+            'reused': 0,
+            'bytes': sum(layer['size'] for layer in layers) + manifest['config']['size'] + len(manifest_bytes),
+        }
+
+        if store is None:
+            config_bytes = self.get_blob(registry, repository, manifest['config'])
+            layout = ImageTarLayout(ref, manifest_bytes, media_type, manifest_digest,
+                                    manifest['config'], config_bytes, layers)
+            fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                layout.write_metadata(fd)
+                self._download_all(registry, repository,
+                                   [(layer, fd, layout.offsets[layer['digest']]) for layer in layers])
+                os.fsync(fd)
+            except BaseException:
+                os.close(fd)
+                os.remove(output_path)
+                raise
+            os.close(fd)
+            stats['downloaded'] = stats['bytes']
+        else:
+            config = manifest['config']
+            if not store.has(config['digest'], config['size']):
+                store.add_bytes(self.get_blob(registry, repository, config))
+            missing = [layer for layer in layers if not store.has(layer['digest'], layer['size'])]
+            jobs = []
+            try:
+                for layer in missing:
+                    temp_path = store.temp_path(layer['digest'])
+                    jobs.append((layer, os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644), temp_path))
+                self._download_all(registry, repository, [(layer, fd, 0) for layer, fd, _ in jobs])
+                for layer, fd, temp_path in jobs:
+                    os.close(fd)
+                    store.commit(temp_path, layer['digest'])
+                jobs = []
+            finally:
+                for _, fd, temp_path in jobs:
+                    os.close(fd)
+                    os.remove(temp_path)
+            store.add_bytes(manifest_bytes)
+            store.put_ref(IMAGE_REFS, name or os.path.basename(output_path), [manifest_digest, config['digest']] +
+                          [layer['digest'] for layer in layers], ref=ref, manifest=manifest_digest,
+                          media_type=media_type)
+            write_image_tar(store, name or os.path.basename(output_path), output_path)
+            stats['reused'] = len(layers) - len(missing)
+            stats['downloaded'] = sum(layer['size'] for layer in missing)
+        stats['seconds'] = time.time() - start
+        return stats
+
+
+def unique_layers(layers):
+    """去掉重复的layer（同一layer在manifest中出现多次时只下载/写入一份）"""
+    seen = set()
+    result = []
+    for layer in layers:
+        if layer['digest'] not in seen:
+            seen.add(layer['digest'])
+            result.append(layer)
+    return result
+
+
+def repo_tag(ref):
+    """加载后的镜像名（只有digest时不打tag，没有tag时为latest）"""
+    name = ref.split('@', 1)[0]
+    if ':' in name.rsplit('/', 1)[-1]:
+        return name
+    return None if '@' in ref else name + ':latest'
+
+
+def write_image_tar(store, name, output_path, ref=None, clone_only=False):
+    """按镜像引用从blob存储生成镜像tar（不访问仓库）；给出ref时要求与引用记录的镜像地址一致
+
+    layer优先用reflink与存储中的blob共享数据块；clone_only 时文件系统不支持reflink即失败（不复制）。
+    """
+    data = store.get_ref(IMAGE_REFS, name)
+    if data is None or (ref and data.get('ref') != ref):
+        raise BlobStoreError(f"blob存储中没有镜像：{ref or name}")
+    manifest_bytes = store.read_bytes(data['manifest'])
+    manifest = json.loads(manifest_bytes.decode('utf-8'))
+    layers = unique_layers(manifest['layers'])
+    layout = ImageTarLayout(data['ref'], manifest_bytes, data.get('media_type') or DOCKER_MANIFEST, data['manifest'],
+                            manifest['config'], store.read_bytes(manifest['config']['digest']), layers)
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, layout.size)
+        for layer in layers:
+            if not clone_into(fd, layout.offsets[layer['digest']], store.blob_path(layer['digest']), layer['size']):
+                if clone_only:
+                    raise BlobStoreError(f"文件系统不支持reflink：{output_path}")
+                copy_into(fd, layout.offsets[layer['digest']], store.blob_path(layer['digest']), layer['size'])
+            store.touch(layer['digest'])
+        # reflink按整块共享，layer最后一块之后的tar头在其后写入
+        layout.write_metadata(fd)
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(output_path)
+        raise
+    os.close(fd)
+
+
+def clone_into(fd, offset, src_path, size):
+    """用reflink把文件src_path共享到fd的offset处（offset按4KB对齐），文件系统不支持时返回False"""
+    with open(src_path, 'rb') as src:
+        if os.fstat(src.fileno()).st_size != size:
+            raise BlobStoreError(f"blob大小与manifest不一致：{src_path}")
+        if not size or offset % ALIGNMENT:
+            return False
+        try:
+            fcntl.ioctl(fd, FICLONERANGE, struct.pack('=qQQQ', src.fileno(), 0, size, offset))
+        except OSError:
+            return False
+    return True
+
+
+def copy_into(fd, offset, src_path, size):
+    """把文件src_path的内容复制到fd的offset处（sendfile，在内核中完成复制）"""
+    with open(src_path, 'rb') as src:
+        if os.fstat(src.fileno()).st_size != size:
+            raise BlobStoreError(f"blob大小与manifest不一致：{src_path}")
+        os.lseek(fd, offset, os.SEEK_SET)
+        copied = 0
+        while copied < size:
+            sent = os.sendfile(fd, src.fileno(), copied, min(size - copied, 1 << 30))
+            if sent == 0:
+                raise BlobStoreError(f"复制blob时文件被截断：{src_path}")
+            copied += sent
+
+
+def select_platform(descriptors, platform):
+    """从多架构镜像的manifest列表中选择platform（os/arch[/variant]）"""
+    os_name, _, arch = platform.partition('/')
+    arch, _, variant = arch.partition('/')
+    for descriptor in descriptors:
+        p = descriptor.get('platform', {})
+        if p.get('os') == os_name and p.get('architecture') == arch and (not variant or p.get('variant') == variant):
+            return descriptor
+    return None
+
+
+def verify_digest(descriptor, hex_digest, size):
+    expected = descriptor['digest']
+    if not expected.startswith('sha256:'):
+        raise RegistryError(f"不支持的digest算法：{expected}")
+    if size != descriptor['size'] or expected != 'sha256:' + hex_digest:
+        raise RegistryError(f"blob校验失败：{expected}（期望{descriptor['size']}字节，实际{size}字节，sha256:{hex_digest}）")
+
+
+# ---------- 镜像tar布局 ----------
+class ImageTarLayout(object):
+    """nerdctl save 格式的镜像tar（OCI layout + docker manifest.json）
+
+    所有blob的大小在manifest中已知，因此可以先算出每个成员在tar中的偏移：元数据先写入，
+    layer由下载线程直接写到各自的偏移处，不需要临时文件。
+    layer数据按4KB对齐（需要时在layer前加一个只含comment的PAX扩展头作为填充，解包时忽略），
+    从blob存储生成时可以用reflink共享数据块。
+        oci-layout
+        index.json
+        manifest.json
+        blobs/sha256/<manifest>
+        blobs/sha256/<config>
+        blobs/sha256/<layer>...
+    """
+
+    def __init__(self, ref, manifest_bytes, media_type, manifest_digest, config, config_bytes, layers):
+        tag = repo_tag(ref)
+        annotations = {'io.containerd.image.name': ref}
+        if tag:
+            annotations['org.opencontainers.image.ref.name'] = tag.rsplit(':', 1)[1]
+        index = {
+            'schemaVersion': 2,
+            'mediaType': OCI_INDEX,
+            'manifests': [{
+                'mediaType': media_type,
+                'digest': manifest_digest,
+                'size': len(manifest_bytes),
+                'annotations': annotations,
+            }],
+        }
+        docker_manifest = [{
+            'Config': blob_path(config['digest']),
+            'RepoTags': [tag] if tag else [],
+            'Layers': [blob_path(layer['digest']) for layer in layers],
+        }]
+        self.files = [
+            ('oci-layout', json.dumps({'imageLayoutVersion': '1.0.0'}).encode()),
+            ('index.json', json.dumps(index, sort_keys=True).encode()),
+            ('manifest.json', json.dumps(docker_manifest, sort_keys=True).encode()),
+            (blob_path(manifest_digest), manifest_bytes),
+            (blob_path(config['digest']), config_bytes),
+        ]
+        self.headers = []    # [(偏移, tar头)]
+        self.offsets = {}    # layer digest -> 数据偏移
+        offset = 0
+        for name, data in self.files:
+            header = tar_header(name, len(data))
+            self.headers.append((offset, header + data))
+            offset += len(header) + padded(len(data))
+        for layer in layers:
+            padding = -(offset + tarfile.BLOCKSIZE) % ALIGNMENT
+            if padding:
+                padding += ALIGNMENT if padding < 2 * tarfile.BLOCKSIZE else 0   # PAX头至少占两块
+                self.headers.append((offset, pax_padding(padding)))
+                offset += padding
+            header = tar_header(blob_path(layer['digest']), layer['size'])
+            self.headers.append((offset, header))
+            self.offsets[layer['digest']] = offset + len(header)
+            offset += len(header) + padded(layer['size'])
+        self.size = offset + 2 * tarfile.BLOCKSIZE   # 结尾两个全零块
+
+    def write_metadata(self, fd):
+        """写入全部tar头和小文件，并把文件扩展到最终大小（layer数据区和填充由下载线程写入/保持为零）"""
+        os.ftruncate(fd, self.size)
+        for offset, data in self.headers:
+            os.pwrite(fd, data, offset)
+
+
+def check_image_tar(path):
+    """检查镜像tar是否完整（只读tar头，不读layer数据），返回问题描述，完好时返回None
+
+    检查：每个成员的数据都在文件范围内（未被截断），manifest.json 中的配置和layer都存在。
+    """
+    try:
+        file_size = os.path.getsize(path)
+        members = {}
+        with tarfile.open(path, 'r:') as tar:
+            for member in tar:
+                if member.offset_data + member.size > file_size:
+                    return f"文件被截断（{member.name}）"
+                members[member.name] = member
+            if 'manifest.json' not in members:
+                return "缺少manifest.json"
+            manifest = json.loads(tar.extractfile(members['manifest.json']).read().decode('utf-8'))
+    except (tarfile.TarError, OSError, ValueError) as e:
+        return f"无法读取（{e}）"
+    for item in manifest:
+        for name in [item.get('Config')] + list(item.get('Layers') or []):
+            if name not in members:
+                return f"缺少{name}"
+    return None
+
+
+def blob_path(digest):
+    return 'blobs/' + digest.replace(':', '/', 1)
+
+
+def tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o444
+    info.mtime = 0
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def pax_padding(length):
+    """占length字节（512的整数倍，至少两块）的PAX扩展头，内容只有一条comment记录"""
+    size = length - tarfile.BLOCKSIZE
+    prefix = f"{size} comment="
+    info = tarfile.TarInfo('././@PaxHeader')
+    info.type = tarfile.XHDTYPE
+    info.size = size
+    info.mtime = 0
+    return info.tobuf(tarfile.USTAR_FORMAT) + (prefix + 'x' * (size - len(prefix) - 1) + '\n').encode()
+
+
+def padded(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="直接从镜像仓库拉取镜像并保存为tar（nerdctl load 可加载）")
+    sub = parser.add_subparsers(dest='command')
+    pull = sub.add_parser('pull', help="拉取镜像")
+    pull.add_argument('ref', help="完整镜像地址，例如 hub.deepflow.yunshan.net/dev/deepflow-server:v6.6.5550")
+    pull.add_argument('-o', '--output', required=True, help="输出的tar文件")
+    pull.add_argument('--platform', default=DEFAULT_PLATFORM, help=f"多架构镜像选择的平台（默认{DEFAULT_PLATFORM}）")
+    pull.add_argument('-j', '--jobs', type=int, default=DEFAULT_CONCURRENCY, help="同时下载的blob数")
+    pull.add_argument('--blob-store', help="blob存储目录（已有的blob不再下载，新blob存入存储）")
+    pull.add_argument('--name', help="blob存储中的镜像引用名（默认为输出文件名）")
+    pull.add_argument('--token-cache', default=os.environ.get('REGISTRY_TOKEN_CACHE'),
+                      help="token缓存文件（多次运行、并发构建共用token）")
+    materialize = sub.add_parser('materialize', help="从blob存储生成镜像tar（不访问仓库；存储中没有该镜像时退出码为2）")
+    materialize.add_argument('--blob-store', required=True, help="blob存储目录")
+    materialize.add_argument('--name', required=True, help="镜像引用名")
+    materialize.add_argument('--ref', help="完整镜像地址（与存储中记录的不一致时视为没有该镜像）")
+    materialize.add_argument('-o', '--output', required=True, help="输出的tar文件")
+    materialize.add_argument('--clone-only', action='store_true',
+                             help="layer只用reflink共享存储中的blob（文件系统不支持reflink时失败，不复制）")
+    args = parser.parse_args(argv)
+
+    if args.command == 'materialize':
+        store = BlobStore(args.blob_store)
+        if not store.image_complete(args.name):
+            return 2
+        try:
+            write_image_tar(store, args.name, args.output, args.ref, clone_only=args.clone_only)
+        except BlobStoreError as e:
+            print(f"{e}", file=sys.stderr)
+            return 2
+        except (OSError, ValueError, KeyError) as e:
+            print(f"错误：生成镜像tar失败：{args.name}（{e}）", file=sys.stderr)
+            return 1
+        return 0
+    if args.command != 'pull':
+        parser.print_help()
+        return 1
+
+    client = RegistryClient(concurrency=args.jobs,
+                            token_cache=TokenCache(args.token_cache) if args.token_cache else None)
+    store = BlobStore(args.blob_store) if args.blob_store else None
+    try:
+        result = client.pull(args.ref, args.output, args.platform, store=store, name=args.name)
+    except (RegistryError, BlobStoreError, OSError, ValueError, KeyError) as e:
+        print(f"错误：拉取镜像失败：{args.ref}（{e}）", file=sys.stderr)
+        return 1
+    finally:
+        client.pool.close()
+    print(f"{args.ref}: {result['digest']}，{result['blobs']}个blob（复用{result['reused']}个），"
+          f"共{result['bytes'] / 1024 / 1024:.1f}MB，下载{result['downloaded'] / 1024 / 1024:.1f}MB，"
+          f"耗时{result['seconds']:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
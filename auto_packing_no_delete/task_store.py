@@ -0,0 +1,304 @@
+"""构建任务的文件存储（web worker 与构建进程之间共享）
+
+目录结构（task_records/）：
+    queue/<时间戳>_<task_id>.json   待构建的任务（构建进程按文件名顺序认领）
+    <task_id>/status.json          任务状态（SSE、下载接口读取）
+    <task_id>/output.log           子进程输出（JSON行：seq/line/ts，SSE按偏移增量读取）
+    <task_id>/trace.json           执行轨迹（Chrome trace-event）
+    <task_id>/request.json         已认领的构建请求（构建中断后据此重新排队）
+    <task_id>/journal.jsonl        构建日志（started/pulled/saved/packaged/complete，重启后从断点恢复）
+    <task_id>/stream.json          边构建边下载的升级包路径和文件名（/build?stream=1 提交时写入）
+    <task_id>/package.json         虚拟升级包清单（各文件的路径、大小、mtime、CRC32，下载时据此拼出zip）
+    <task_id>/patch_image_tag_list.txt  构建时的镜像列表副本（打包到升级包中）
+    <task_id>/index.json           升级包索引（每个镜像的大小、sha256、digest、单独下载地址）
+    <task_id>/inventory.json       现场已有镜像清单（POST /build 上传，解析后的digest和标签）
+    <task_id>/skipped_images.json  现场已有、未打包的镜像（打包到升级包中）
+    <task_id>/install.sh           升级包中的安装脚本（installer.py 按镜像清单生成，打包到升级包中）
+    <task_id>/blockmap.bin         升级包的块校验文件（构建时生成，增量下载用）
+    <task_id>/volumes.json         分卷清单（/build?volume_mb= 提交时生成：每卷的偏移、大小、sha256）
+    builder.heartbeat              构建进程心跳（mtime）
+    build_history.jsonl            已完成构建的耗时和字节数（JSON行，构建计划据此估算耗时）
+所有JSON文件均先写临时文件再原子替换，读取方不会读到半个文件。
+"""
+import collections
+import json
+import os
+import threading
+import time
+
+STATUS_FILE = 'status.json'
+OUTPUT_FILE = 'output.log'
+TRACE_FILE = 'trace.json'
+REQUEST_FILE = 'request.json'
+JOURNAL_FILE = 'journal.jsonl'
+STREAM_FILE = 'stream.json'
+PACKAGE_FILE = 'package.json'
+INDEX_FILE = 'index.json'
+INVENTORY_FILE = 'inventory.json'
+SKIPPED_FILE = 'skipped_images.json'
+BLOCKMAP_FILE = 'blockmap.bin'
+VOLUMES_FILE = 'volumes.json'
+QUEUE_DIR = 'queue'
+HEARTBEAT_FILE = 'builder.heartbeat'
+HISTORY_FILE = 'build_history.jsonl'
+
+
+def write_json(path, data):
+    """原子写入JSON文件"""
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+class StatusStore(object):
+    """任务状态（字典接口：build_status[task_id] = {...}），状态保存在 <task_id>/status.json"""
+
+    def __init__(self, root):
+        self.root = root
+        self._cache = {}   # task_id -> ((mtime_ns, size), status)，状态文件未变化时不重复解析
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def task_dir(self, task_id):
+        return os.path.join(self.root, task_id)
+
+    def _path(self, task_id):
+        return os.path.join(self.root, task_id, STATUS_FILE)
+
+    def __contains__(self, task_id):
+        return os.path.exists(self._path(task_id))
+
+    def __getitem__(self, task_id):
+        status = self.get(task_id)
+        if status is None:
+            raise KeyError(task_id)
+        return status
+
+    def __setitem__(self, task_id, status):
+        os.makedirs(self.task_dir(task_id), exist_ok=True)
+        write_json(self._path(task_id), status)
+
+    def get(self, task_id, default=None):
+        path = self._path(task_id)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return default
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._cache.get(task_id)
+            if cached and cached[0] == key:
+                return cached[1]
+        status = read_json(path)
+        if status is None:
+            return default
+        with self._lock:
+            self._cache[task_id] = (key, status)
+        return status
+
+    def task_ids(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [name for name in os.listdir(self.root) if os.path.exists(self._path(name))]
+
+
+class OutputLog(object):
+    """任务的子进程输出：逐行追加到 output.log，内存中只保留最近N行（错误报告用）"""
+
+    def __init__(self, path, maxlen=200):
+        self.path = path
+        self._tail = collections.deque(maxlen=maxlen)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, line):
+        ts = time.time()
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._seq = _count_lines(self.path)  # 恢复的任务接着之前的序号继续
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._seq += 1
+            self._tail.append(line)
+            self._file.write(json.dumps({'seq': self._seq, 'line': line, 'ts': ts}, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def tail(self, count=20):
+        with self._lock:
+            return list(self._tail)[-count:]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @staticmethod
+    def read_from(path, offset, max_bytes=1024 * 1024):
+        """从字节偏移offset开始读取完整的行，返回 ([{seq, line, ts}, ...], 新偏移)"""
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(max_bytes)
+        except (IOError, OSError):
+            return [], offset
+        end = data.rfind(b'\n')
+        if end < 0:
+            return [], offset
+        items = []
+        for raw in data[:end].split(b'\n'):
+            try:
+                items.append(json.loads(raw.decode('utf-8')))
+            except ValueError:
+                continue
+        return items, offset + end + 1
+
+
+def _count_lines(path):
+    try:
+        with open(path, 'rb') as f:
+            return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
+    except (IOError, OSError):
+        return 0
+
+
+class BuildJournal(object):
+    """构建日志：每完成一步追加一行JSON {step, ts, ...}并落盘，构建进程重启后据此从断点恢复"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, step, **fields):
+        line = json.dumps(dict(fields, step=step, ts=time.time()), ensure_ascii=False) + '\n'
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def entries(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # 写入中断的最后一行
+        return entries
+
+    def steps(self, step):
+        return [entry for entry in self.entries() if entry.get('step') == step]
+
+
+class BuildHistory(object):
+    """构建历史：每次构建成功后追加一行JSON（耗时、镜像数、拉取字节数等），只保留最近 keep 条"""
+
+    def __init__(self, root, keep=200):
+        self.path = os.path.join(root, HISTORY_FILE)
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            records = self.recent()
+            if len(records) > self.keep * 2:
+                # 超过两倍保留条数时重写一次，避免每次追加都重写
+                tmp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.writelines(json.dumps(item, ensure_ascii=False) + '\n' for item in records[-self.keep:])
+                os.replace(tmp_path, self.path)
+
+    def recent(self, count=None):
+        """最近的构建记录（按完成顺序），count为None时返回全部"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records if count is None else records[-count:]
+
+
+class BuildQueue(object):
+    """基于目录的构建队列：web worker 提交，构建进程按提交顺序认领"""
+
+    def __init__(self, root):
+        self.root = root
+        self.queue_dir = os.path.join(root, QUEUE_DIR)
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def submit(self, task_id, request):
+        name = f"{time.time():017.6f}_{task_id}.json"
+        write_json(os.path.join(self.queue_dir, name), dict(request, task_id=task_id))
+
+    def pending(self):
+        """排队中的任务ID（按提交顺序）"""
+        try:
+            names = sorted(n for n in os.listdir(self.queue_dir) if n.endswith('.json'))
+        except OSError:
+            return []
+        return [n.split('_', 1)[1][:-len('.json')] for n in names]
+
+    def claim(self):
+        """认领最早提交的任务（rename保证多个构建进程不会重复认领），无任务时返回None"""
+        try:
+            names = sorted(n for n in os.listdir(self.queue_dir) if n.endswith('.json'))
+        except OSError:
+            return None
+        for name in names:
+            task_id = name.split('_', 1)[1][:-len('.json')]
+            task_dir = os.path.join(self.root, task_id)
+            os.makedirs(task_dir, exist_ok=True)
+            target = os.path.join(task_dir, REQUEST_FILE)
+            try:
+                os.rename(os.path.join(self.queue_dir, name), target)
+            except OSError:
+                continue  # 已被其他构建进程认领
+            request = read_json(target)
+            if request is not None:
+                return request
+        return None
+
+    def requeue(self, task_id):
+        """把已认领但未完成的任务重新放回队列（排在最前面），返回是否成功"""
+        request = read_json(os.path.join(self.root, task_id, REQUEST_FILE))
+        if request is None:
+            return False
+        write_json(os.path.join(self.queue_dir, f"{0:017.6f}_{task_id}.json"), request)
+        return True
+
+    # ---------- 构建进程心跳 ----------
+    def heartbeat(self):
+        path = os.path.join(self.root, HEARTBEAT_FILE)
+        with open(path, 'a'):
+            os.utime(path, None)
+
+    def builder_alive(self, max_age=30):
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.root, HEARTBEAT_FILE)) < max_age
+        except OSError:
+            return False
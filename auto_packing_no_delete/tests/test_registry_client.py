@@ -0,0 +1,279 @@
+"""registry_client.py 对本地仓库替身（bench/fake_registry.py）的拉取测试
+
+仓库替身在测试进程内启动（随机端口、不限速、无延迟），每个镜像3个layer共256KB。
+运行：cd auto_packing_no_delete && python3 -m pytest -q tests（或 python3 -m unittest discover tests）
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, 'bench'))
+
+from blob_store import BlobStore, IMAGE_REFS  # noqa: E402
+from registry_client import (ALIGNMENT, ConnectionPool, RegistryClient, RegistryError, TokenCache,  # noqa: E402
+                             check_image_tar)
+
+FAKE_ENV = {'FAKE_LATENCY_MS': '0', 'FAKE_PULL_MBPS': '0', 'FAKE_IMAGE_SIZE_MB': '0.25', 'FAKE_REGISTRY_LAYERS': '3',
+            'FAKE_BASE_LAYER_MB': '0', 'FAKE_REGISTRY_AUTH': '1', 'FAKE_REGISTRY_REDIRECT': '0'}
+
+
+class RegistryClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._saved_env = {key: os.environ.get(key) for key in FAKE_ENV}
+        os.environ.update(FAKE_ENV)
+        from fake_registry import FakeRegistry
+        cls.server = FakeRegistry(('127.0.0.1', 0))
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.registry = f"127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        for key, value in cls._saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    def setUp(self):
+        self.server.redirect = False
+        self.server.manifest_list = False
+        self.server.corrupt = False
+        self.server.token_ttl = 300
+        self.tmp = tempfile.mkdtemp(prefix='registry-client-test-')
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.pool.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    # ---------- 工具 ----------
+    def client(self, **kwargs):
+        client = RegistryClient(username='tester', password='secret', pool=ConnectionPool(timeout=10), **kwargs)
+        self.clients.append(client)
+        return client
+
+    def ref(self, name, tag='v1'):
+        return f"{self.registry}/dev/{name}:{tag}"
+
+    def stat(self, name):
+        return self.server.stats().get(name, 0)
+
+    def registry_manifest(self, name, tag='v1', arch='amd64'):
+        """仓库替身中的平台manifest：(manifest字节, digest, manifest)"""
+        body, digest, _ = self.server.catalog._image_manifest(f"dev/{name}", tag, arch)
+        return body, digest, json.loads(body.decode('utf-8'))
+
+    def read_tar(self, path):
+        """镜像tar的成员名（按顺序）和内容"""
+        with tarfile.open(path, 'r:') as tar:
+            members = tar.getmembers()
+            return [m.name for m in members], {m.name: tar.extractfile(m).read() for m in members}
+
+    def assert_image_tar(self, path, name, tag='v1', arch='amd64'):
+        """镜像tar与仓库中的镜像逐字节一致（元数据文件、manifest、配置、每个layer）"""
+        self.assertIsNone(check_image_tar(path))
+        body, digest, manifest = self.registry_manifest(name, tag, arch)
+        names, files = self.read_tar(path)
+        layers = [layer['digest'] for layer in manifest['layers']]
+        blob = lambda d: 'blobs/sha256/' + d.split(':', 1)[1]
+        self.assertEqual(names, ['oci-layout', 'index.json', 'manifest.json', blob(digest),
+                                 blob(manifest['config']['digest'])] + [blob(d) for d in layers])
+        self.assertEqual(files['oci-layout'], b'{"imageLayoutVersion": "1.0.0"}')
+        self.assertEqual(files[blob(digest)], body)
+        for descriptor in [manifest['config']] + manifest['layers']:
+            data = files[blob(descriptor['digest'])]
+            self.assertEqual(len(data), descriptor['size'])
+            self.assertEqual('sha256:' + hashlib.sha256(data).hexdigest(), descriptor['digest'])
+        return digest, manifest, files
+
+    # ---------- 拉取 ----------
+    def test_pull_without_store(self):
+        output = os.path.join(self.tmp, 'demo_v1.tar')
+        tokens = self.stat('token_requests')
+        stats = self.client().pull(self.ref('demo'), output)
+        digest, manifest, _ = self.assert_image_tar(output, 'demo')
+        self.assertEqual(stats['digest'], digest)
+        self.assertEqual(stats['blobs'], len(manifest['layers']) + 2)
+        self.assertEqual(stats['reused'], 0)
+        self.assertEqual(stats['downloaded'], stats['bytes'])
+        self.assertEqual(self.stat('token_requests'), tokens + 1)   # 同一镜像的所有请求共用一个token
+
+    def test_pull_with_store(self):
+        store = BlobStore(os.path.join(self.tmp, 'blobs'))
+        plain = os.path.join(self.tmp, 'plain.tar')
+        output = os.path.join(self.tmp, 'stored.tar')
+        client = self.client()
+        client.pull(self.ref('stored'), plain)
+        stats = client.pull(self.ref('stored'), output, store=store, name='stored_v1.tar')
+        digest, manifest, _ = self.assert_image_tar(output, 'stored')
+        self.assertEqual(stats['downloaded'], sum(layer['size'] for layer in manifest['layers']))
+        with open(plain, 'rb') as f1, open(output, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())   # 经过blob存储生成的tar与直接下载的相同
+        ref = store.get_ref(IMAGE_REFS, 'stored_v1.tar')
+        self.assertEqual(ref['ref'], self.ref('stored'))
+        self.assertEqual(ref['manifest'], digest)
+        self.assertTrue(store.image_complete('stored_v1.tar'))
+        self.assertEqual(os.listdir(store.tmp_dir), [])
+
+        # 再次拉取：layer全部复用，不再下载blob
+        blobs = self.stat('blob_requests')
+        again = os.path.join(self.tmp, 'again.tar')
+        stats = client.pull(self.ref('stored'), again, store=store, name='stored_v1.tar')
+        self.assertEqual(stats['reused'], len(manifest['layers']))
+        self.assertEqual(stats['downloaded'], 0)
+        self.assertEqual(self.stat('blob_requests'), blobs)
+        self.assert_image_tar(again, 'stored')
+
+    # ---------- 认证 ----------
+    def test_token_reauth_after_revocation(self):
+        client = self.client()
+        client.get_manifest(self.registry, 'dev/auth', 'v1')
+        tokens = self.stat('token_requests')
+        client.get_manifest(self.registry, 'dev/auth', 'v1')
+        self.assertEqual(self.stat('token_requests'), tokens)   # token未过期时复用
+        self.server.revoke_tokens()
+        # 缓存的token被拒绝（401）后重新获取token，请求成功
+        output = os.path.join(self.tmp, 'auth.tar')
+        client.pull(self.ref('auth'), output)
+        self.assertEqual(self.stat('token_requests'), tokens + 1)
+        self.assert_image_tar(output, 'auth')
+
+    def test_token_file_cache_skips_rejected_token(self):
+        cache_path = os.path.join(self.tmp, 'tokens', 'cache.json')
+        first = self.client(token_cache=TokenCache(cache_path))
+        first.get_manifest(self.registry, 'dev/shared', 'v1')
+        tokens = self.stat('token_requests')
+        # 其他进程（新客户端）从文件缓存取得token，不再请求仓库
+        self.client(token_cache=TokenCache(cache_path)).get_manifest(self.registry, 'dev/shared', 'v1')
+        self.assertEqual(self.stat('token_requests'), tokens)
+        # token被吊销：文件缓存中的仍是被拒绝的token，不能再用，重新获取并写回缓存
+        self.server.revoke_tokens()
+        self.client(token_cache=TokenCache(cache_path)).get_manifest(self.registry, 'dev/shared', 'v1')
+        self.assertEqual(self.stat('token_requests'), tokens + 1)
+        self.client(token_cache=TokenCache(cache_path)).get_manifest(self.registry, 'dev/shared', 'v1')
+        self.assertEqual(self.stat('token_requests'), tokens + 1)
+
+    def test_second_401_fails(self):
+        # 新获取的token也被拒绝（立即过期）：只重新认证一次，不无限重试
+        self.server.token_ttl = -1
+        with self.assertRaises(RegistryError) as context:
+            self.client().get_manifest(self.registry, 'dev/denied', 'v1')
+        self.assertIn('HTTP 401', str(context.exception))
+
+    def test_missing_credentials(self):
+        client = RegistryClient(username='', password='', pool=ConnectionPool(timeout=10))
+        self.clients.append(client)
+        with self.assertRaises(RegistryError):
+            client.get_manifest(self.registry, 'dev/anonymous', 'v1')
+
+    # ---------- 重定向 ----------
+    def test_blob_redirect(self):
+        self.server.redirect = True
+        redirects = self.stat('blob_redirects')
+        output = os.path.join(self.tmp, 'redirect.tar')
+        self.client().pull(self.ref('redirect'), output)
+        _, manifest, _ = self.assert_image_tar(output, 'redirect')
+        self.assertEqual(self.stat('blob_redirects'), redirects + len(manifest['layers']) + 1)   # layer和配置
+
+    # ---------- 多架构 ----------
+    def test_manifest_list_selects_platform(self):
+        self.server.manifest_list = True
+        client = self.client()
+        output = os.path.join(self.tmp, 'multi.tar')
+        stats = client.pull(self.ref('multi'), output)
+        digest, _, files = self.assert_image_tar(output, 'multi')
+        self.assertEqual(stats['digest'], digest)
+        arm = os.path.join(self.tmp, 'multi-arm64.tar')
+        stats = client.pull(self.ref('multi'), arm, platform='linux/arm64/v8')
+        digest, manifest, files = self.assert_image_tar(arm, 'multi', arch='arm64')
+        self.assertEqual(stats['digest'], digest)
+        config = json.loads(files['blobs/sha256/' + manifest['config']['digest'].split(':', 1)[1]].decode())
+        self.assertEqual(config['architecture'], 'arm64')
+        # 镜像digest：manifest列表、平台manifest、配置
+        digests = client.image_digests(self.registry, 'dev/multi', 'v1')
+        self.assertEqual(digests[1:], [self.registry_manifest('multi')[1],
+                                       self.registry_manifest('multi')[2]['config']['digest']])
+        with self.assertRaises(RegistryError):
+            client.pull(self.ref('multi'), os.path.join(self.tmp, 'multi-s390x.tar'), platform='linux/s390x')
+
+    # ---------- 镜像tar格式 ----------
+    def test_layout_metadata_bytes(self):
+        output = os.path.join(self.tmp, 'layout.tar')
+        ref = self.ref('layout', 'v6.6.1')
+        self.client().pull(ref, output)
+        body, digest, manifest = self.registry_manifest('layout', 'v6.6.1')
+        _, files = self.read_tar(output)
+        hexes = [layer['digest'].split(':', 1)[1] for layer in manifest['layers']]
+        self.assertEqual(files['index.json'].decode(), (
+            '{"manifests": [{"annotations": {"io.containerd.image.name": "%s", '
+            '"org.opencontainers.image.ref.name": "v6.6.1"}, "digest": "%s", '
+            '"mediaType": "application/vnd.docker.distribution.manifest.v2+json", "size": %d}], '
+            '"mediaType": "application/vnd.oci.image.index.v1+json", "schemaVersion": 2}') % (ref, digest, len(body)))
+        self.assertEqual(files['manifest.json'].decode(), (
+            '[{"Config": "blobs/sha256/%s", "Layers": [%s], "RepoTags": ["%s"]}]') % (
+            manifest['config']['digest'].split(':', 1)[1], ', '.join(f'"blobs/sha256/{h}"' for h in hexes), ref))
+        # 同一镜像再次拉取，tar逐字节相同
+        again = os.path.join(self.tmp, 'layout-again.tar')
+        self.client().pull(ref, again)
+        with open(output, 'rb') as f1, open(again, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_layer_data_aligned(self):
+        output = os.path.join(self.tmp, 'aligned.tar')
+        self.client().pull(self.ref('aligned'), output)
+        self.assert_image_tar(output, 'aligned')
+        with tarfile.open(output, 'r:') as tar:
+            layers = [m for m in tar.getmembers() if m.name.startswith('blobs/')][2:]
+        self.assertTrue(layers)
+        for member in layers:
+            self.assertEqual(member.offset_data % ALIGNMENT, 0)   # reflink要求按块对齐
+
+    def test_digest_only_ref_has_no_repo_tag(self):
+        _, digest, _ = self.registry_manifest('pinned')
+        ref = f"{self.registry}/dev/pinned@{digest}"
+        output = os.path.join(self.tmp, 'pinned.tar')
+        self.client().pull(ref, output)
+        _, files = self.read_tar(output)
+        self.assertEqual(json.loads(files['manifest.json'].decode())[0]['RepoTags'], [])
+        annotations = json.loads(files['index.json'].decode())['manifests'][0]['annotations']
+        self.assertEqual(annotations, {'io.containerd.image.name': ref})
+
+    # ---------- 校验 ----------
+    def test_sha256_mismatch_rejected(self):
+        self.server.corrupt = True
+        output = os.path.join(self.tmp, 'corrupt.tar')
+        with self.assertRaises(RegistryError) as context:
+            self.client().pull(self.ref('corrupt'), output)
+        self.assertIn('blob校验失败', str(context.exception))
+        self.assertFalse(os.path.exists(output))
+
+    def test_sha256_mismatch_not_stored(self):
+        self.server.corrupt = True
+        store = BlobStore(os.path.join(self.tmp, 'blobs'))
+        output = os.path.join(self.tmp, 'corrupt-stored.tar')
+        with self.assertRaises(RegistryError):
+            self.client().pull(self.ref('corrupt-stored'), output, store=store, name='corrupt-stored_v1.tar')
+        self.assertFalse(os.path.exists(output))
+        _, _, manifest = self.registry_manifest('corrupt-stored')
+        for layer in manifest['layers']:
+            self.assertFalse(store.has(layer['digest']))
+        self.assertEqual(os.listdir(store.tmp_dir), [])
+        self.assertIsNone(store.get_ref(IMAGE_REFS, 'corrupt-stored_v1.tar'))
+
+
+if __name__ == '__main__':
+    unittest.main()
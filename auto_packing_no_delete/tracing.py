@@ -0,0 +1,296 @@
+"""构建任务执行轨迹（Chrome trace-event 格式，可直接在 chrome://tracing / Perfetto 中打开）
+
+- TaskTrace：记录阶段/镜像级别的区间（"X"事件）和计数器（"C"事件）
+- ProcessSampler：后台定期采样子进程树（pull_save.sh → timeout → nerdctl pull/save、zip），
+  为根进程及其直接子进程各生成一个区间，记录pid、命令、CPU时间和 /proc/<pid>/io 读写字节数；
+  更深层的子孙进程不单独成行，其CPU时间和IO计入所属直接子进程的区间（timeout 等包装命令的区间以实际执行的
+  命令命名，如 nerdctl），区间起点取自 /proc/<pid>/stat 中的进程启动时间，不受采样间隔影响
+- 轨迹大小有上限：IO计数器只在变化时记录且间隔不小于 COUNTER_INTERVAL，每个任务最多 MAX_COUNTER_EVENTS 个，
+  超出后丢弃并在 otherData.dropped_counters 中计数（长时间构建的 trace.json 不会无限增长）
+"""
+import os
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.2       # 进程树采样间隔（秒）
+COUNTER_INTERVAL = 1.0      # IO计数器的最小记录间隔（秒）
+MAX_COUNTER_EVENTS = 10000  # 每个任务最多记录的计数器事件数
+_CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+WRAPPER_COMMANDS = ('timeout', 'nice', 'ionice', 'env', 'setsid', 'stdbuf')   # 区间以其启动的命令命名
+
+
+def _us(ts):
+    """秒级时间戳 → 微秒（trace-event 的时间单位）"""
+    return int(ts * 1000000)
+
+
+class TaskTrace(object):
+    """单个构建任务的执行轨迹"""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.pid = os.getpid()
+        self._events = []
+        self._lock = threading.Lock()
+        self._track_names = {}
+        self._counters = 0
+        self._dropped_counters = 0
+
+    def add_span(self, name, cat, start, end, tid=0, **args):
+        """记录一个已结束的区间"""
+        event = {"name": name, "cat": cat, "ph": "X", "ts": _us(start), "dur": max(_us(end) - _us(start), 0),
+                 "pid": self.pid, "tid": tid}
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+
+    def add_counter(self, name, ts, tid=0, **values):
+        """记录计数器；超过 MAX_COUNTER_EVENTS 后丢弃并计数"""
+        with self._lock:
+            if self._counters >= MAX_COUNTER_EVENTS:
+                self._dropped_counters += 1
+                return
+            self._counters += 1
+            self._events.append({"name": name, "ph": "C", "ts": _us(ts), "pid": self.pid, "tid": tid,
+                                 "args": values})
+
+    def name_track(self, tid, name):
+        """为时间线上的一行（tid）命名，例如"阶段""镜像""pid 1234 nerdctl"""
+        self._track_names[tid] = name
+
+    def span(self, name, cat, tid=0, **args):
+        """上下文管理器：记录 with 块的执行区间"""
+        trace = self
+
+        class _Span(object):
+            def __enter__(self):
+                self.start = time.time()
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                if exc_type is not None:
+                    args["error"] = str(exc)
+                trace.add_span(name, cat, self.start, time.time(), tid=tid, **args)
+
+        return _Span()
+
+    def to_chrome(self):
+        with self._lock:
+            events = list(self._events)
+            dropped = self._dropped_counters
+        metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+                     "args": {"name": f"构建任务 {self.task_id}"}}]
+        for tid, name in sorted(self._track_names.items()):
+            metadata.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}})
+            metadata.append({"name": "thread_sort_index", "ph": "M", "pid": self.pid, "tid": tid,
+                             "args": {"sort_index": tid}})
+        other = {"task_id": self.task_id}
+        if dropped:
+            other["dropped_counters"] = dropped
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms", "otherData": other}
+
+
+# -------------------------- /proc 采样 --------------------------
+def read_proc_io(pid):
+    """读取 /proc/<pid>/io（read_bytes/write_bytes 为实际落到块设备的字节数）"""
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                stats[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return stats
+
+
+def read_proc_stat(pid):
+    """读取 /proc/<pid>/stat：命令名、用户态/内核态CPU时间、已回收子进程的CPU时间（秒）和启动时间（开机后秒数）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    # comm 字段可能包含空格，以最后一个 ')' 为界
+    comm = data[data.index('(') + 1:data.rindex(')')]
+    fields = data[data.rindex(')') + 2:].split()
+    utime, stime, cutime, cstime = (int(value) / _CLK_TCK for value in fields[11:15])
+    return {"comm": comm, "cpu": (utime, stime), "cpu_children": (cutime, cstime),
+            "started": int(fields[19]) / _CLK_TCK}
+
+
+def _boot_time():
+    """开机时刻的时间戳（time.time() 减去 /proc/uptime）"""
+    try:
+        with open("/proc/uptime") as f:
+            return time.time() - float(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _read_cmdline(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+    except (IOError, OSError):
+        return ''
+
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except (IOError, OSError):
+        return []
+
+
+class ProcessSampler(object):
+    """采样以root_pid为根的进程树，结束后把根进程和每个直接子进程（含其子孙进程的资源）写成trace区间"""
+
+    def __init__(self, trace, root_pid, stage, tid_base):
+        self.trace = trace
+        self.root_pid = root_pid
+        self.stage = stage
+        self.tid_base = tid_base
+        # pid -> {"start", "last", "comm", "cmdline", "cpu", "cpu_children", "io", "descendants"}
+        # descendants：子孙进程pid -> 最后一次采样的 {"comm", "cpu", "io"}（进程结束后保留）
+        self._procs = {}
+        self._last_counter = None   # (时间, read_bytes, write_bytes)
+        self._root_reaped = None    # 根进程上次采样的 (已回收子进程CPU时间, IO)，用于补全直接子进程退出前的最后一段
+        self._boot_time = _boot_time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"trace-sampler-{root_pid}", daemon=True)
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def root_io(self):
+        """根进程当前的累计IO（包含已回收子进程的IO）"""
+        info = self._procs.get(self.root_pid)
+        return dict(info["io"]) if info else {}
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        now = time.time()
+        pending = [(self.root_pid, None)]   # (pid, 所属直接子进程；根进程及直接子进程为None)
+        while pending:
+            pid, owner = pending.pop()
+            stat = read_proc_stat(pid)
+            if stat is None:
+                continue
+            if owner is not None:
+                # 更深层的子孙进程：记录最后一次采样的资源，结束时计入所属直接子进程
+                owner["descendants"][pid] = {"comm": stat["comm"], "cpu": stat["cpu"],
+                                             "io": read_proc_io(pid) or owner["descendants"].get(pid, {}).get("io", {})}
+                pending.extend((child, owner) for child in _children(pid))
+                continue
+            info = self._procs.get(pid)
+            if info is None:
+                start = now if self._boot_time is None else min(self._boot_time + stat["started"], now)
+                info = self._procs[pid] = {"start": start, "comm": stat["comm"], "cmdline": _read_cmdline(pid),
+                                           "descendants": {}}
+            if info["comm"] != stat["comm"]:
+                # fork后尚未exec时采样到的是父进程的命令名
+                info["comm"], info["cmdline"] = stat["comm"], _read_cmdline(pid)
+            info["last"] = now
+            info["cpu"] = stat["cpu"]
+            info["cpu_children"] = stat["cpu_children"]
+            info["io"] = read_proc_io(pid) or info.get("io", {})
+            owner = None if pid == self.root_pid else info
+            pending.extend((child, owner) for child in _children(pid))
+        self._account_exited(now)
+        root = self._procs.get(self.root_pid)
+        if root and root.get("io"):
+            read_bytes, write_bytes = root["io"].get("read_bytes", 0), root["io"].get("write_bytes", 0)
+            last = self._last_counter
+            if last is None or (now - last[0] >= COUNTER_INTERVAL and (read_bytes, write_bytes) != last[1:]):
+                self._last_counter = (now, read_bytes, write_bytes)
+                self.trace.add_counter(f"{self.stage} IO", now, read_bytes=read_bytes, write_bytes=write_bytes)
+
+    def _account_exited(self, now):
+        """本次采样发现已退出的直接子进程：退出前最后一段的CPU和IO无法再读取，但子进程被根进程回收时会计入根进程的
+        cutime/cstime 和 /proc/<pid>/io，按根进程的增量减去已采样的部分，补给其中做实际工作的进程（CPU时间最多的）"""
+        root = self._procs.get(self.root_pid)
+        if root is None or root["last"] != now:
+            return
+        previous = self._root_reaped
+        self._root_reaped = (root["cpu_children"], dict(root["io"]))
+        exited = [info for pid, info in self._procs.items()
+                  if pid != self.root_pid and info["last"] != now and "extra" not in info]
+        if not exited:
+            return
+        for info in exited:
+            info["extra"] = {}
+        if previous is None:
+            return
+        totals = [self._totals(info) for info in exited]
+        delta = {
+            "cpu_user_s": root["cpu_children"][0] - previous[0][0],
+            "cpu_sys_s": root["cpu_children"][1] - previous[0][1],
+            "read_bytes": root["io"].get("read_bytes", 0) - previous[1].get("read_bytes", 0),
+            "write_bytes": root["io"].get("write_bytes", 0) - previous[1].get("write_bytes", 0),
+        }
+        worker = max(range(len(exited)), key=lambda i: totals[i]["cpu_user_s"] + totals[i]["cpu_sys_s"])
+        exited[worker]["extra"] = {key: max(value - sum(t[key] for t in totals), 0) for key, value in delta.items()}
+
+    @staticmethod
+    def _totals(info):
+        """直接子进程及其子孙进程的CPU时间和IO合计。
+        子孙进程被回收后计入父进程的 cutime/cstime 和 /proc/<pid>/io，与采样到的子孙进程数值取较大者，避免重复计算"""
+        descendants = info["descendants"].values()
+        sampled_user = sum(d["cpu"][0] for d in descendants)
+        sampled_sys = sum(d["cpu"][1] for d in descendants)
+        totals = {
+            "cpu_user_s": round(info["cpu"][0] + max(info["cpu_children"][0], sampled_user), 3),
+            "cpu_sys_s": round(info["cpu"][1] + max(info["cpu_children"][1], sampled_sys), 3),
+        }
+        for key in ("read_bytes", "write_bytes"):
+            totals[key] = max(info["io"].get(key, 0), sum(d["io"].get(key, 0) for d in descendants))
+        for key, value in info.get("extra", {}).items():
+            totals[key] = round(totals[key] + value, 3)
+        return totals
+
+    def stop(self, rusage=None):
+        """停止采样并写入根进程和直接子进程的区间；rusage 为 os.wait4 返回的根进程资源统计（含已回收子进程）"""
+        self._stop.set()
+        self._thread.join(timeout=SAMPLE_INTERVAL * 5)
+        now = time.time()
+        root = self._procs.get(self.root_pid)
+        if root is not None and rusage is not None:
+            # 最后一次采样之后退出的直接子进程：根进程的 wait4 统计包含所有已回收子进程（IO以512字节块计）
+            root["last"] = now
+            root["cpu_children"] = (max(rusage.ru_utime - root["cpu"][0], 0), max(rusage.ru_stime - root["cpu"][1], 0))
+            root["io"] = {"read_bytes": max(rusage.ru_inblock * 512, root["io"].get("read_bytes", 0)),
+                          "write_bytes": max(rusage.ru_oublock * 512, root["io"].get("write_bytes", 0))}
+            self._account_exited(now)
+        for index, (pid, info) in enumerate(sorted(self._procs.items(), key=lambda x: x[1]["start"])):
+            is_root = pid == self.root_pid
+            end = now if is_root else info["last"]
+            name = info["comm"]
+            args = {"pid": pid, "cmdline": info["cmdline"]}
+            if is_root:
+                args.update(cpu_user_s=info["cpu"][0], cpu_sys_s=info["cpu"][1],
+                            read_bytes=info["io"].get("read_bytes", 0), write_bytes=info["io"].get("write_bytes", 0))
+            else:
+                args.update(self._totals(info))
+                if info["descendants"]:
+                    args["subprocesses"] = len(info["descendants"])
+                    if name in WRAPPER_COMMANDS:
+                        # 包装命令以其启动的命令命名（子孙进程中最先启动的，即pid最小的）
+                        args["wrapper"] = name
+                        name = info["descendants"][min(info["descendants"])]["comm"]
+            args["wall_s"] = round(end - info["start"], 3)
+            if is_root and rusage is not None:
+                # 根进程以 wait4 的资源统计为准（采样可能错过进程退出前最后一段时间）
+                args["cpu_user_s"] = rusage.ru_utime
+                args["cpu_sys_s"] = rusage.ru_stime
+                args["max_rss_kb"] = rusage.ru_maxrss
+            tid = self.tid_base + index
+            self.trace.name_track(tid, f"{self.stage} pid {pid} {name}")
+            self.trace.add_span(name, "process", info["start"], end, tid=tid, **args)
@@ -0,0 +1,60 @@
+"""分卷升级包：按固定大小把升级包切成若干卷（不另存文件，下载时按字节范围从升级包读取）
+
+有单文件大小限制的传输系统、不稳定的链路（大文件传输失败要从头开始）按卷传输，各卷可以并行下载。
+分卷清单记录每卷的偏移、大小和sha256，以及整个升级包的sha256；现场校验后按顺序拼接即为升级包
+（cat <升级包>.001 <升级包>.002 ... > <升级包>，或 upgrade_client.py --assemble <分卷清单>）。
+"""
+import hashlib
+
+MIN_VOLUME_MB = 16   # 每卷最小大小（MB）
+
+
+def volume_name(package_name, number):
+    """第number卷（从1开始）的文件名：<升级包>.001"""
+    return f"{package_name}.{number:03d}"
+
+
+class VolumeDigest(object):
+    """按顺序接收升级包的字节（update），计算每卷和整个升级包的sha256；
+    构建时分卷与块校验文件共用一次读取（blockmap.write_blockmap 的 on_chunk）"""
+
+    def __init__(self, task_id, package_name, size, volume_size):
+        self.task_id = task_id
+        self.package_name = package_name
+        self.size = size
+        self.volume_size = volume_size
+        self._package = hashlib.sha256()
+        self._volume = hashlib.sha256()
+        self._filled = 0      # 当前卷已接收的字节数
+        self._volumes = []
+
+    def _volume_end(self):
+        number = len(self._volumes) + 1
+        self._volumes.append({
+            "number": number,
+            "file": volume_name(self.package_name, number),
+            "offset": (number - 1) * self.volume_size,
+            "size": self._filled,
+            "sha256": self._volume.hexdigest(),
+            "url": f"/download/{self.task_id}?volume={number}",
+        })
+        self._volume = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        self._package.update(data)
+        view = memoryview(data)
+        while len(view):
+            take = min(self.volume_size - self._filled, len(view))
+            self._volume.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.volume_size:
+                self._volume_end()
+
+    def manifest(self):
+        if self._filled:
+            self._volume_end()
+        return {"task_id": self.task_id, "package_name": self.package_name, "size": self.size,
+                "sha256": self._package.hexdigest(), "volume_size": self.volume_size, "volumes": self._volumes}
+
@@ -0,0 +1,297 @@
+"""升级包zip：顺序写出（StreamingZipWriter）和由已有文件拼出的虚拟升级包（VirtualZip）
+
+zip -j 要等所有镜像tar都保存完才开始打包，且压缩已压缩过的layer几乎没有收益。
+StreamingZipWriter 按镜像完成的顺序逐个追加条目：
+    - 条目不压缩（stored），边复制边计算CRC，每个文件只读一遍
+    - 本地文件头中不写CRC和大小（通用标志位3），写完数据后追加数据描述符（data descriptor）
+    - 始终使用zip64格式的本地扩展字段和数据描述符，单个镜像和整个升级包都可以超过4GB
+    - 已写出的字节不会再修改，下载端可以在写入过程中读取已写出的部分（边构建边下载）
+unzip、python zipfile、7z 均按中央目录读取，与 zip -j 生成的升级包解压结果相同。
+
+VirtualZip 不写文件：条目数据直接引用 image_tar 中的镜像tar，各部分（文件头、数据、数据描述符、中央目录）
+的偏移在创建时算好，可以按任意字节范围读取（支持Range续传），内容与 StreamingZipWriter 写出的逐字节相同。
+
+确定性输出：条目的修改时间固定为1980-01-01 00:00（与文件mtime、服务器时区无关），权限只区分可执行（755）
+和普通文件（644），write_package 和虚拟升级包按条目名排序。文件内容相同的两次构建生成逐字节相同的升级包，
+package_digest 由条目名、大小和sha256算出，可以在不读取升级包的情况下作为升级包的内容标识（ETag）。
+
+增量生成：条目数据在升级包中按4KB对齐（本地文件头中加填充扩展字段），write_package 使用已缓存的CRC，
+不再读取镜像tar：XFS/btrfs 上用reflink（FICLONERANGE）与 image_tar 中的镜像tar共享数据块，只写文件头；
+不支持reflink的文件系统由内核复制（sendfile），数据不经过用户态。镜像列表只改动少数镜像时，
+重新构建的耗时主要是变化镜像的拉取和校验。
+"""
+import bisect
+import fcntl
+import hashlib
+import os
+import struct
+import zlib
+
+CHUNK = 1024 * 1024
+SENDFILE_CHUNK = 64 * 1024 * 1024
+
+LOCAL_HEADER_SIG = 0x04034b50
+DATA_DESCRIPTOR_SIG = 0x08074b50
+CENTRAL_HEADER_SIG = 0x02014b50
+ZIP64_END_SIG = 0x06064b50
+ZIP64_LOCATOR_SIG = 0x07064b50
+END_SIG = 0x06054b50
+
+VERSION_ZIP64 = 45
+VERSION_MADE_BY = (3 << 8) | VERSION_ZIP64   # 3 = Unix（外部属性中保存文件权限）
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+ZIP64_EXTRA_ID = 0x0001
+UINT32_MAX = 0xFFFFFFFF
+UINT16_MAX = 0xFFFF
+ALIGNMENT = 4096                      # 条目数据的对齐（文件系统块大小，reflink要求按块对齐）
+PADDING_EXTRA_ID = 0xD935             # 填充扩展字段（与 Android zipalign 相同，解压工具忽略）
+FICLONERANGE = 0x4020940D             # _IOW(0x94, 13, struct file_clone_range)
+
+ENTRY_DOS_TIME = 0                    # 00:00:00
+ENTRY_DOS_DATE = (1 << 5) | 1         # 1980-01-01（DOS日期的最小值）
+FORMAT_VERSION = 'stored-zip64-aligned-v2'    # 升级包格式版本（参与 package_digest，格式变化时摘要随之变化）
+
+
+def entry_mode(mode):
+    """条目权限：可执行文件755，其余644（不保留属主、umask等与构建环境有关的差异）"""
+    return 0o100755 if mode & 0o111 else 0o100644
+
+
+def package_digest(entries):
+    """升级包内容摘要 sha256:<hex>，entries: [{name, size, sha256}]（与条目顺序无关）"""
+    digest = hashlib.sha256(FORMAT_VERSION.encode('ascii') + b'\n')
+    for entry in sorted(entries, key=lambda item: item['name']):
+        digest.update(f"{entry['name']}\t{entry['size']}\t{entry['sha256']}\n".encode('utf-8'))
+    return 'sha256:' + digest.hexdigest()
+
+
+class ZipEntry(object):
+    """已写出的条目（生成中央目录用）"""
+    __slots__ = ('name', 'offset', 'crc', 'size', 'mode')
+
+    def __init__(self, name, offset, mode):
+        self.name = name
+        self.offset = offset      # 本地文件头的偏移
+        self.crc = 0
+        self.size = 0
+        self.mode = entry_mode(mode)
+
+
+def _encode_name(name):
+    try:
+        return name.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return name.encode('utf-8'), FLAG_UTF8
+
+
+def local_header(name, offset):
+    """条目的本地文件头（CRC和大小在数据描述符中），offset 为文件头在升级包中的偏移，填充到条目数据按块对齐"""
+    raw_name, flags = _encode_name(name)
+    extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, 0, 0)
+    padding = -(offset + 30 + len(raw_name) + len(extra) + 4) % ALIGNMENT
+    extra += struct.pack('<HH', PADDING_EXTRA_ID, padding) + b'\0' * padding
+    return struct.pack('<IHHHHHIIIHH', LOCAL_HEADER_SIG, VERSION_ZIP64, flags | FLAG_DATA_DESCRIPTOR, 0,
+                       ENTRY_DOS_TIME, ENTRY_DOS_DATE, 0, UINT32_MAX, UINT32_MAX, len(raw_name), len(extra)) + raw_name + extra
+
+
+def data_descriptor(crc, size):
+    return struct.pack('<IIQQ', DATA_DESCRIPTOR_SIG, crc, size, size)
+
+
+def central_header(entry):
+    raw_name, flags = _encode_name(entry.name)
+    extra_values = []
+    size = entry.size
+    offset = entry.offset
+    if size >= UINT32_MAX:
+        extra_values += [size, size]
+        size = UINT32_MAX
+    if offset >= UINT32_MAX:
+        extra_values.append(offset)
+        offset = UINT32_MAX
+    extra = b''
+    if extra_values:
+        extra = struct.pack('<HH', ZIP64_EXTRA_ID, 8 * len(extra_values)) + struct.pack(f'<{len(extra_values)}Q',
+                                                                                         *extra_values)
+    return struct.pack('<IHHHHHHIIIHHHHHII', CENTRAL_HEADER_SIG, VERSION_MADE_BY, VERSION_ZIP64,
+                       flags | FLAG_DATA_DESCRIPTOR, 0, ENTRY_DOS_TIME, ENTRY_DOS_DATE, entry.crc, size, size,
+                       len(raw_name), len(extra), 0, 0, 0, (entry.mode & 0xFFFF) << 16, offset) + raw_name + extra
+
+
+def end_records(count, directory_offset, directory_size):
+    """中央目录之后的结束记录（条目数或偏移超出限制时加zip64结束记录和定位符）"""
+    data = b''
+    if count >= UINT16_MAX or directory_offset >= UINT32_MAX or directory_size >= UINT32_MAX:
+        zip64_end_offset = directory_offset + directory_size
+        data += struct.pack('<IQHHIIQQQQ', ZIP64_END_SIG, 44, VERSION_MADE_BY, VERSION_ZIP64, 0, 0,
+                            count, count, directory_size, directory_offset)
+        data += struct.pack('<IIQI', ZIP64_LOCATOR_SIG, 0, zip64_end_offset, 1)
+        count = min(count, UINT16_MAX)
+        directory_offset = min(directory_offset, UINT32_MAX)
+        directory_size = min(directory_size, UINT32_MAX)
+    data += struct.pack('<IHHHHIIH', END_SIG, 0, 0, count, count, directory_size, directory_offset, 0)
+    return data
+
+
+class StreamingZipWriter(object):
+    """顺序写出的zip：add_file/add_bytes 逐个追加条目，close 写出中央目录"""
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._offset = 0
+        self._clone = True
+        self.entries = []
+        self.cloned_bytes = 0     # reflink共享的字节数
+        self.copied_bytes = 0     # 内核复制的字节数
+
+    @property
+    def bytes_written(self):
+        return self._offset
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _begin(self, name, mode):
+        entry = ZipEntry(name, self._offset, mode)
+        self._write(local_header(name, self._offset))
+        return entry
+
+    def _end(self, entry):
+        self._write(data_descriptor(entry.crc, entry.size))
+        self._file.flush()
+        self.entries.append(entry)
+
+    def add_file(self, path, arcname=None, crc=None):
+        """追加一个文件（条目名默认为文件名，即 zip -j）；已知CRC时不读取文件内容"""
+        st = os.stat(path)
+        entry = self._begin(arcname or os.path.basename(path), st.st_mode)
+        if crc is None:
+            crc = 0
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    self._write(chunk)
+                    entry.size += len(chunk)
+            entry.crc = crc & 0xFFFFFFFF
+        else:
+            self._copy(path, st.st_size)
+            entry.crc = crc
+            entry.size = st.st_size
+        self._end(entry)
+        return entry
+
+    def _copy(self, path, size):
+        """文件内容原样写入升级包：优先reflink共享数据块，文件系统不支持时由内核复制"""
+        self._file.flush()
+        out_fd = self._file.fileno()
+        with open(path, 'rb') as src:
+            if self._clone and size:
+                try:
+                    fcntl.ioctl(out_fd, FICLONERANGE, struct.pack('=qQQQ', src.fileno(), 0, size, self._offset))
+                    self.cloned_bytes += size
+                except OSError:
+                    self._clone = False   # 不支持reflink（ext4、跨文件系统等），之后的条目直接复制
+                else:
+                    self._file.seek(self._offset + size)
+                    self._offset += size
+                    return
+            copied = 0
+            while copied < size:
+                sent = os.sendfile(out_fd, src.fileno(), copied, min(size - copied, SENDFILE_CHUNK))
+                if not sent:
+                    raise IOError(f"文件比记录的短：{path}")
+                copied += sent
+        self._file.seek(self._offset + size)
+        self._offset += size
+        self.copied_bytes += size
+
+    def add_bytes(self, arcname, data, mode=0o100644):
+        entry = self._begin(arcname, mode)
+        self._write(data)
+        entry.crc = zlib.crc32(data) & 0xFFFFFFFF
+        entry.size = len(data)
+        self._end(entry)
+        return entry
+
+    def close(self):
+        """写出中央目录和结束记录，返回升级包总大小"""
+        directory_offset = self._offset
+        for entry in self.entries:
+            self._write(central_header(entry))
+        self._write(end_records(len(self.entries), directory_offset, self._offset - directory_offset))
+        self._file.flush()
+        return self._offset
+
+
+def write_package(path, entries):
+    """按条目名排序写成升级包（先写临时文件再改名）
+
+    entries: [{name, path, crc}]（文件元数据，CRC已知，不读取文件内容）
+    返回 (升级包大小, reflink共享的字节数, 复制的字节数)
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        writer = StreamingZipWriter(f)
+        for entry in sorted(entries, key=lambda item: item['name']):
+            writer.add_file(entry['path'], entry['name'], crc=entry['crc'])
+        size = writer.close()
+    os.replace(tmp_path, path)
+    return size, writer.cloned_bytes, writer.copied_bytes
+
+
+class VirtualZip(object):
+    """由已有文件拼出的不压缩zip（不落盘）
+
+    entries: [{name, path, size, crc, mode}]（升级包清单中记录的文件信息，按此顺序排列，文件内容必须与记录一致）
+    self.entries 为各条目的 ZipEntry（offset 为本地文件头的偏移），与 write_package 按相同顺序写出的升级包一致
+    """
+
+    def __init__(self, entries):
+        self._offsets = []    # 各部分的起始偏移（二分查找用）
+        self._parts = []      # (长度, bytes) 或 (长度, 文件路径)
+        offset = 0
+        written = []
+        for item in entries:
+            entry = ZipEntry(item['name'], offset, item['mode'])
+            entry.crc = item['crc']
+            entry.size = item['size']
+            offset = self._add(offset, local_header(entry.name, offset))
+            offset = self._add(offset, item['path'], entry.size)
+            offset = self._add(offset, data_descriptor(entry.crc, entry.size))
+            written.append(entry)
+        directory = b''.join(central_header(entry) for entry in written)
+        self.entries = written
+        self.size = self._add(offset, directory + end_records(len(written), offset, len(directory)))
+
+    def _add(self, offset, part, length=None):
+        length = len(part) if length is None else length
+        if length:
+            self._offsets.append(offset)
+            self._parts.append((length, part))
+        return offset + length
+
+    def iter_range(self, start, end, chunk_size=CHUNK):
+        """按顺序生成 [start, end] 范围（含end）内的字节"""
+        index = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+        position = start
+        while position <= end and index < len(self._parts):
+            part_offset = self._offsets[index]
+            length, part = self._parts[index]
+            begin = position - part_offset
+            stop = min(length, end - part_offset + 1)
+            if isinstance(part, bytes):
+                yield part[begin:stop]
+            else:
+                with open(part, 'rb') as f:
+                    f.seek(begin)
+                    remaining = stop - begin
+                    while remaining > 0:
+                        data = f.read(min(chunk_size, remaining))
+                        if not data:
+                            raise IOError(f"文件比记录的短：{part}")
+                        remaining -= len(data)
+                        yield data
+            position = part_offset + stop
+            index += 1